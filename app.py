@@ -1,10 +1,19 @@
-from flask import Flask, request, jsonify, send_file
+from contextlib import closing
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context, url_for
+import itertools
+import json
 import os
 import config
+import time
 import traceback
 
 from pipeline import run_pipeline
-from utils.file_utils import load_cleaned_data, load_merged_data, load_dataframe
+from scripts.data_aggregation import get_output_file, normalize_spec
+from utils.file_utils import get_cleaned_paths, get_stored_columns, load_cleaned_data, load_dataframe, load_households, iter_dataframe, iter_delimited, iter_json_items, iter_json_records, to_json_lines, write_stage_output
+from utils.job_utils import JobQueue, QueueFullError
+from utils.metrics_utils import list_run_ids, load_run_report, summarize_run_report
+from utils.query_utils import AggregationCache, QueryTableCache
+from utils.response_utils import ResponseCache, file_version, get_etag
 
 app = Flask(__name__)
 
@@ -13,22 +22,289 @@ os.environ["FLASK_RUN_HOST"] = config.FLASK_RUN_HOST
 os.environ["FLASK_RUN_PORT"] = str(config.FLASK_RUN_PORT)
 os.environ["FLASK_DEBUG"] = str(config.FLASK_DEBUG)
 
+# Background pipeline runs
+job_queue = JobQueue(run_pipeline, config.JOB_QUEUE_SIZE,
+                     config.JOB_HISTORY_SIZE)
+
+# Serialized responses of data endpoints, kept until their files change
+response_cache = ResponseCache(config.RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+
+# Typed and indexed copies of aggregation files for filter queries
+query_table_cache = QueryTableCache(config.QUERY_CACHE_TABLES)
+
+# Memory-resident merged data and aggregations computed on demand
+aggregation_cache = AggregationCache(config.MERGED_TABLE_PATH, config.AGGREGATION_CACHE_RESULTS)
+
+# Query parameters that are not filters
+PAGE_ARGS = ('limit', 'cursor', 'columns', 'format', 'dataset')
+QUERY_ARGS = ('sort', 'top')
+
+
+def cached_json_response(name, paths, load=None, generate=None):
+    """
+    Returns a JSON response of the data returned by `load`, reusing the serialized response
+    while the files at `paths` are unchanged.
+
+    The ETag of the response is derived from the versions of the files, so a request with
+    a matching If-None-Match header gets a 304 response without loading anything.
+
+    Instead of `load`, `generate` may yield the serialized body in chunks. When the files
+    are larger than the response cache, the body is then streamed without being cached,
+    so it is never held in memory.
+    """
+    version = tuple(file_version(path) for path in paths)
+    etag = get_etag(version)
+    if request.if_none_match.contains(etag.strip('"')):
+        return Response(status=304, headers={'ETag': etag})
+
+    entry = response_cache.get(name, version)
+    if entry is None:
+        if generate is not None and sum(size for _, size, _ in version) > response_cache.max_bytes:
+            return Response(stream_with_context(generate()), mimetype='application/json',
+                            headers={'ETag': etag})
+        body = ''.join(generate()).encode('utf-8') if generate is not None else jsonify(load()).get_data()
+        if tuple(file_version(path) for path in paths) == version:
+            entry = response_cache.put(name, version, body)
+        else:
+            # Files were rewritten while loading, the body may not match `version`
+            return Response(body, mimetype='application/json')
+
+    headers = {'ETag': entry['etag'], 'Vary': 'Accept-Encoding'}
+    body = entry['body']
+    if config.RESPONSE_CACHE_GZIP and 'gzip' in request.accept_encodings:
+        body = response_cache.get_gzip(name, entry)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def merged_json_chunks(chunk_bytes=1 << 20):
+    """
+    Yields the merged data serialized like `jsonify`, in chunks of about `chunk_bytes`,
+    parsing one household of the merged JSON file at a time.
+    """
+    others = {}
+    chunk = ['{"data":[']
+    size = 0
+    separator = ''
+    for key, value in iter_json_items(config.MERGED_JSON_PATH, 'data'):
+        if key != 'data':
+            others[key] = value
+            continue
+        record = separator + app.json.dumps(value, separators=(',', ':'))
+        separator = ','
+        chunk.append(record)
+        size += len(record)
+        if size >= chunk_bytes:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+
+    # Keys are sorted like in `jsonify`, so 'schema' follows 'data'
+    chunk.append(']' + ''.join(',' + json.dumps(key) + ':' + app.json.dumps(value, separators=(',', ':'))
+                               for key, value in sorted(others.items())) + '}\n')
+    yield ''.join(chunk)
+
+
+def get_page_args():
+    """
+    Returns the pagination arguments of a request, or None if it asks for the whole data.
+
+    Query Parameters:
+    - limit (int): Maximum number of rows. Defaults to config.PAGE_SIZE for JSON pages.
+    - cursor (int): Position to start from, as returned in 'next_cursor' (default: start of the data).
+    - columns (str): Comma-separated columns to return.
+    - format (str): 'json' for a page of rows, or 'ndjson' to stream one row per line.
+
+    Raises
+    ------
+    ValueError
+        If an argument is invalid.
+    """
+    if not any(key in request.args for key in PAGE_ARGS):
+        return None
+
+    def to_int(key, default, minimum):
+        value = request.args.get(key)
+        if value is None:
+            return default
+        if not value.isdigit() or int(value) < minimum:
+            raise ValueError(
+                f'Invalid {key} {value}. Expected an integer from {minimum}')
+        return int(value)
+
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'ndjson'):
+        raise ValueError(
+            f"Invalid format {output_format}. Allowed formats are ['json', 'ndjson']")
+    limit = to_int('limit', None if output_format ==
+                   'ndjson' else config.PAGE_SIZE, 1)
+    if output_format == 'json' and limit > config.MAX_PAGE_SIZE:
+        raise ValueError(
+            f'Invalid limit {limit}. JSON pages hold at most {config.MAX_PAGE_SIZE} rows, use format=ndjson for more')
+    columns = request.args.get('columns')
+    return {'limit': limit,
+            'cursor': to_int('cursor', 0, 0),
+            'columns': columns.split(',') if columns else None,
+            'stream': output_format == 'ndjson'}
+
+
+def get_query_args(columns):
+    """
+    Returns the filters, sort order and row limit of a query, or None if the request has none.
+
+    Query Parameters:
+    - <column>=<value>: Rows where the column equals the value. Repeat to match any of several values.
+    - <column>__<operator>=<value>: Rows where the column compares to the value with one of
+      the operators 'ne', 'gt', 'gte', 'lt' or 'lte'.
+    - sort (str): Comma-separated columns to sort by, descending if prefixed with '-'.
+    - top (int): Maximum number of rows, after sorting.
+
+    Other parameters, e.g. cache busters, are ignored.
+
+    Parameters
+    ----------
+    columns : list
+        Columns of the queried table, the only parameters read as filters.
+
+    Raises
+    ------
+    ValueError
+        If an argument is invalid.
+    """
+    filters = []
+    for key in request.args:
+        if key in PAGE_ARGS + QUERY_ARGS:
+            continue
+        if key in columns:
+            col, op = key, 'eq'
+        else:
+            col, separator, op = key.rpartition('__')
+            if not separator or col not in columns:
+                continue
+        values = request.args.getlist(key)
+        filters.append((col, op, values if op in ('eq', 'ne') else values[-1]))
+    if not filters and not any(key in request.args for key in QUERY_ARGS):
+        return None
+
+    top = request.args.get('top')
+    if top is not None and not top.isdigit():
+        raise ValueError(f'Invalid top {top}. Expected an integer from 0')
+    sort = request.args.get('sort')
+    return {'filters': filters,
+            'sort': sort.split(',') if sort else None,
+            'top': int(top) if top is not None else None}
+
+
+def frame_records(df, cursor):
+    """
+    Yields the JSON string of each row of a DataFrame from row `cursor`, and the cursor of the row after it.
+    """
+    for start in range(cursor, len(df), config.STREAM_CHUNK_ROWS):
+        for line in to_json_lines(df.iloc[start:start + config.STREAM_CHUNK_ROWS]):
+            cursor += 1
+            yield line, cursor
+
+
+def table_records(path, columns, cursor):
+    """
+    Yields the JSON string of each row of a table file from `cursor`, and the cursor of the row after it.
+    The cursor is the byte offset of a row in TSV and CSV files, so a page is read from there
+    without parsing the rows before it, and the row number in other files.
+    Only `config.STREAM_CHUNK_ROWS` rows are held in memory at once.
+    """
+    if os.path.splitext(path)[1] in ('.tsv', '.csv'):
+        chunks = iter_delimited(
+            path, config.STREAM_CHUNK_ROWS, columns=columns, offset=cursor)
+    else:
+        chunks = ((chunk, None) for chunk in iter_dataframe(
+            path, config.STREAM_CHUNK_ROWS, columns=columns, start=cursor))
+    with closing(chunks):
+        for chunk, offsets in chunks:
+            if columns:
+                chunk = chunk[columns]
+            for position, line in enumerate(to_json_lines(chunk)):
+                cursor = cursor + 1 if offsets is None else int(offsets[position])
+                yield line, cursor
+
+
+def merged_records(columns, cursor):
+    """
+    Yields the JSON string of each household of the merged data from byte offset `cursor`, and the cursor of the household after it.
+    """
+    for line, next_cursor in iter_json_records(config.MERGED_JSON_PATH, cursor):
+        if columns:
+            record = json.loads(line)
+            missing = [col for col in columns if col not in record]
+            if missing:
+                raise ValueError(f'Columns {missing} not found in merged data')
+            line = json.dumps({col: record[col] for col in columns})
+        yield line, next_cursor
+
+
+def paged_response(records, limit, stream):
+    """
+    Returns a page of records as {"data": [...], "next_cursor": ...}, or streams them as NDJSON.
+
+    Parameters
+    ----------
+    records : iterator
+        JSON string of each record and the cursor of the record after it.
+    limit : int or None
+        Maximum number of records. All remaining records are streamed if None.
+    stream : bool
+        Stream the records as NDJSON instead of returning a JSON page.
+    """
+    records = iter(records)
+    # Invalid columns or cursors raise here, before the response starts
+    first = next(records, None)
+    records = itertools.chain([first] if first else [], records)
+
+    if stream:
+        def generate():
+            for line, _ in itertools.islice(records, limit):
+                yield line + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    lines = []
+    next_cursor = None
+    for line, cursor in records:
+        if len(lines) == limit:
+            # More records follow the page, the next page starts after its last record
+            next_cursor = last_cursor
+            break
+        lines.append(line)
+        last_cursor = cursor
+    body = '{"data":[' + ','.join(lines) + \
+        '],"next_cursor":' + json.dumps(next_cursor) + '}'
+    return Response(body, mimetype='application/json')
+
+
 # Endpoint to trigger the pipeline
 
 
 @app.route('/run-pipeline', methods=['POST'])
 def run_pipeline_api():
     """
-    Runs the data pipeline based on provided input parameters.
+    Queues a run of the data pipeline based on provided input parameters.
+    A request with the same parameters as a queued or running job returns that job.
 
     Request Body (JSON):
-    - demographic_file (str): File name of the demographic data file.
-    - expenditure_file (str): File name of the expenditure data file.
+    - demographic_file (str or list[str]): File name of the demographic data file, or a glob pattern
+      or list of file names and patterns cleaned as a batch into partitions by State and Round.
+    - expenditure_file (str or list[str]): File name of the expenditure data file, or a batch like demographic_file.
     - action (str): Action to perform (e.g., all, clean, aggregate).
     - aggregation_parameters (list[dict]): Parameters for data aggregation (if applicable).
+    - use_cache (bool): Skip stages whose inputs and parameters are unchanged (default: config.STAGE_CACHE_ENABLED).
+    - profile (bool): Profile every stage with cProfile (default: config.METRICS_PROFILE).
+    - merge_partitions (int): Number of partitions of the merge, 1 to merge in memory (default: config.MERGE_PARTITIONS).
+    - partition_filters (dict): Values of the partition columns of the cleaned batches to merge,
+      e.g. {"State": ["MEGHALAYA"]} (default: all partitions).
+    - incremental (bool): Only clean, merge and aggregate the rows appended to the raw files
+      since the last incremental run (default: False).
 
     Response:
-    - 200: Successful execution of the pipeline.
+    - 202: The job ID and status. The status is available at /jobs/<job_id>.
+    - 400: Invalid file, partition filter or incremental parameters.
+    - 429: Too many jobs are waiting to run.
     - 500: Internal server error with the error message.
     """
     try:
@@ -40,30 +316,162 @@ def run_pipeline_api():
         expenditure_file = request_data.get('expenditure_file')
         action = request_data.get('action')
         aggregation_parameters = request_data.get('aggregation_parameters')
-
-        run_pipeline(demographic_file, expenditure_file,
-                     action, aggregation_parameters)
-
-        return jsonify({"message": "Pipeline executed successfully!"}), 200
+        use_cache = request_data.get('use_cache')
+        profile = request_data.get('profile')
+        merge_partitions = request_data.get('merge_partitions')
+        partition_filters = request_data.get('partition_filters')
+        incremental = request_data.get('incremental')
+
+        for file in (demographic_file, expenditure_file):
+            if file is not None and not isinstance(file, str) and not (
+                    isinstance(file, list) and file and all(isinstance(item, str) for item in file)):
+                raise ValueError('File parameters must be a file name, a glob pattern or a list of them')
+        if partition_filters is not None and not (isinstance(partition_filters, dict) and all(
+                isinstance(values, list) for values in partition_filters.values())):
+            raise ValueError('partition_filters must map partition columns to lists of values')
+        if incremental is not None and not isinstance(incremental, bool):
+            raise ValueError('incremental must be a boolean')
+
+        job, merged = job_queue.submit({
+            'demographic_file': demographic_file,
+            'expenditure_file': expenditure_file,
+            'action': action or 'all',
+            'aggregation_parameters': aggregation_parameters,
+            'use_cache': use_cache,
+            'profile': profile,
+            'merge_partitions': merge_partitions,
+            'partition_filters': partition_filters,
+            'incremental': bool(incremental),
+        })
+
+        return jsonify({"message": "Pipeline job already in progress" if merged else "Pipeline job queued",
+                        "job_id": job['job_id'],
+                        "status": job['status'],
+                        "status_url": url_for('get_job', job_id=job['job_id'])}), 202
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": "30"}
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
 
+# Endpoint to list pipeline jobs
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    Lists queued, running and recently finished pipeline jobs.
+
+    Response:
+    - 200: Returns the status of each job as JSON.
+    """
+    return jsonify({"jobs": job_queue.list()}), 200
+
+
+# Endpoint to fetch the status of a pipeline job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Fetches the status of a pipeline job.
+
+    Path Parameter:
+    - job_id (str): ID returned by /run-pipeline.
+
+    Response:
+    - 200: Returns the job status ('queued', 'running', 'completed' or 'failed'), the stages
+      running, the status and seconds of each stage, and the result or error.
+    - 404: Job not found.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job not found: {job_id}"}), 404
+    return jsonify(job), 200
+
+
+# Endpoint to fetch the metrics of pipeline runs
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Fetches the report of the latest pipeline run and the headline figures of the previous runs.
+
+    Query Parameters:
+    - limit (int): Maximum number of runs in the history (default: config.METRICS_HISTORY_SIZE).
+
+    Response:
+    - 200: Returns {"latest": report, "history": [...]}, newest run first. Each history entry
+      has the status, wall and CPU time and peak RSS of a run, and the wall time of its stages.
+    - 400: Invalid limit.
+    """
+    limit = request.args.get('limit', config.METRICS_HISTORY_SIZE)
+    try:
+        limit = int(limit)
+        if limit < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": f"Invalid limit {limit}. Expected a non-negative integer"}), 400
+
+    reports = [load_run_report(run_id) for run_id in list_run_ids()[:max(limit, 1)]]
+    reports = [report for report in reports if report is not None]
+    return jsonify({"latest": reports[0] if reports else None,
+                    "history": [summarize_run_report(report) for report in reports[:limit]]}), 200
+
+
+# Endpoint to fetch the report of a pipeline run
+@app.route('/metrics/<run_id>', methods=['GET'])
+def get_run_metrics(run_id):
+    """
+    Fetches the report of a pipeline run.
+
+    Path Parameter:
+    - run_id (str): ID of the run, as returned in the result of its job.
+
+    Response:
+    - 200: Returns the run report: wall and CPU time, rows and bytes read and written and
+      peak RSS of the run and of each stage, with the cleaning steps of each stage.
+    - 404: Run not found.
+    """
+    report = load_run_report(run_id)
+    if report is None:
+        return jsonify({"error": f"Run not found: {run_id}"}), 404
+    return jsonify(report), 200
+
+
 # Endpoint to fetch cleaned data
 @app.route('/data/cleaned', methods=['GET'])
 def get_cleaned_data():
     """
-    Fetches cleaned demographic and expenditure data from pre-defined paths.
+    Fetches cleaned demographic and expenditure data from pre-defined paths, or from the
+    partitioned datasets of the last batch clean.
+
+    Query Parameters (optional, see get_page_args):
+    - dataset (str): 'demographic' or 'expenditure'. Required with the parameters below.
+    - limit, cursor, columns, format: Return a page of rows or stream them as NDJSON.
+      The cursor is a row number, or a byte offset in TSV and CSV files.
 
     Response:
     - 200: Returns the cleaned data as a JSON object.
+    - 304: The cleaned data is unchanged since the ETag sent in If-None-Match.
+    - 400: Invalid query parameters.
     - 500: Internal server error with the error message.
     """
     try:
-        data = load_cleaned_data()
-        return jsonify(data), 200
-
+        page_args = get_page_args()
+        paths = get_cleaned_paths()
+        if page_args is None:
+            return cached_json_response('cleaned', [paths['demographic'], paths['expenditure']],
+                                        load_cleaned_data)
+
+        dataset = request.args.get('dataset')
+        if dataset not in paths:
+            raise ValueError(
+                f'Invalid dataset {dataset}. Allowed datasets are {list(paths)}')
+        records = table_records(
+            paths[dataset], page_args['columns'], page_args['cursor'])
+        return paged_response(records, page_args['limit'], page_args['stream'])
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
@@ -75,30 +483,127 @@ def get_merged_data():
     """
     Fetches merged data combining demographic and expenditure data.
 
+    Query Parameters (optional, see get_page_args):
+    - limit, cursor, columns, format: Return a page of households or stream them as NDJSON.
+      The cursor is a byte offset in the merged JSON file, and columns are household fields.
+
     Response:
     - 200: Returns the merged data as a JSON object.
+    - 304: The merged data is unchanged since the ETag sent in If-None-Match.
+    - 400: Invalid query parameters.
+    - 500: Internal server error with the error message.
+    """
+    try:
+        page_args = get_page_args()
+        if page_args is None:
+            return cached_json_response('merged', [config.MERGED_JSON_PATH], generate=merged_json_chunks)
+
+        records = merged_records(page_args['columns'], page_args['cursor'])
+        return paged_response(records, page_args['limit'], page_args['stream'])
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+# Endpoint to fetch the merged record of a household
+@app.route('/data/households/<hhid>', methods=['GET'])
+def get_household(hhid):
+    """
+    Fetches the merged record of a household, read straight from its position in the merged data.
+
+    Path Parameter:
+    - hhid (str): HHID of the household.
+
+    Response:
+    - 200: Returns the household record, with its persons and expenditure items, as a JSON object.
+    - 400: Invalid HHID.
+    - 404: Household not found.
     - 500: Internal server error with the error message.
     """
     try:
-        data = load_merged_data()
-        return jsonify(data), 200
+        households = load_households([hhid])
+        if hhid not in households:
+            return jsonify({"error": f"Household not found: {hhid}"}), 404
+        return Response(households[hhid], mimetype='application/json')
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
 
+# Endpoint to fetch the merged records of many households
+@app.route('/data/households', methods=['GET', 'POST'])
+def get_households():
+    """
+    Fetches the merged records of a batch of households.
+
+    Request:
+    - GET: HHIDs as repeated `hhid` query parameters, e.g. ?hhid=715311101&hhid=715311102
+    - POST (JSON): {"hhids": [715311101, 715311102]}
+
+    Response:
+    - 200: Returns {"data": [...], "missing": [...]}, the records found in the requested order
+      and the HHIDs not found.
+    - 400: Invalid or too many HHIDs (more than config.MAX_HOUSEHOLD_BATCH).
+    - 500: Internal server error with the error message.
+    """
+    try:
+        if request.method == 'POST':
+            hhids = (request.get_json(silent=True) or {}).get('hhids')
+        else:
+            hhids = request.args.getlist('hhid')
+        if not isinstance(hhids, list) or not hhids:
+            raise ValueError('Expected a non-empty list of HHIDs')
+        if len(hhids) > config.MAX_HOUSEHOLD_BATCH:
+            raise ValueError(
+                f'{len(hhids)} HHIDs requested. A batch holds at most {config.MAX_HOUSEHOLD_BATCH}')
+
+        households = load_households(hhids)
+        body = '{"data":[' + ','.join(households[hhid] for hhid in hhids if hhid in households) + \
+            '],"missing":' + json.dumps([hhid for hhid in hhids if hhid not in households]) + '}'
+        return Response(body, mimetype='application/json')
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+def list_aggregation_files():
+    """
+    Returns the file of each aggregation in the aggregation directory, sorted by name, without hidden files.
+    An aggregation saved in several formats, e.g. with its TSV export, is listed once,
+    in `config.INTERMEDIATE_FORMAT` if it was saved in it.
+    """
+    files = {}
+    for file in os.listdir(config.AGGREGATED_DATA_DIR):
+        name, extension = os.path.splitext(file)
+        if file.startswith('.'):
+            continue
+        if name not in files or extension[1:] == config.INTERMEDIATE_FORMAT:
+            files[name] = file
+    return [files[name] for name in sorted(files)]
+
+
 # Endpoint to list available aggregated data
 @app.route('/data/aggregated', methods=['GET'])
 def list_aggregations():
     """
-    Lists all available aggregated data files in the aggregation directory.
+    Lists all available aggregated data files in the aggregation directory, one per aggregation,
+    sorted by name. The index of a file in the list can be used in place of its name.
 
     Response:
     - 200: Returns a list of filenames as JSON.
     - 500: Internal server error with the error message.
     """
     try:
-        aggregations = os.listdir(config.AGGREGATED_DATA_DIR)
+        aggregations = list_aggregation_files()
         return jsonify({"aggregated-data-links": aggregations}), 200
     except Exception as e:
         traceback.print_exc()
@@ -114,14 +619,22 @@ def get_aggregation_by_name(name):
     Path Parameter:
     - name (str): Name of the aggregated data file.
 
+    Query Parameters (optional):
+    - Filters, sort and top (see get_query_args): Return only the matching rows, queried from
+      a cached, typed and indexed copy of the file.
+    - limit, cursor, columns, format (see get_page_args): Return a page of rows or stream them
+      as NDJSON. The cursor is a row number of the matching rows, or of the file, and a byte
+      offset in TSV and CSV files.
+
     Response:
     - 200: Returns the aggregated data as a JSON object.
+    - 400: Invalid query parameters.
     - 404: Aggregation file not found.
     - 500: Internal server error with the error message.
     """
     try:
         if name.isnumeric():
-            files = os.listdir(config.AGGREGATED_DATA_DIR)
+            files = list_aggregation_files()
             if int(name) >= len(files):
                 return jsonify({"error": f"Aggregation not found: {name}"}), 404
             else:
@@ -129,11 +642,84 @@ def get_aggregation_by_name(name):
 
         filepath = os.path.join(config.AGGREGATED_DATA_DIR, name)
 
-        if os.path.exists(filepath):
+        if not os.path.exists(filepath):
+            return jsonify({"error": f"Aggregation not found: {name}"}), 404
+
+        page_args = get_page_args()
+        query_args = get_query_args(get_stored_columns(filepath))
+        if query_args is not None:
+            columns = request.args.get('columns')
+            result_df = query_table_cache.get(filepath).query(
+                columns=columns.split(',') if columns else None, **query_args)
+            if not any(key in request.args for key in ('limit', 'cursor', 'format')):
+                return Response('[' + ','.join(to_json_lines(result_df)) + ']', mimetype='application/json')
+            records = frame_records(result_df, page_args['cursor'])
+            return paged_response(records, page_args['limit'], page_args['stream'])
+
+        if page_args is None:
             data = load_dataframe(filepath).to_dict(orient='records')
             return jsonify(data), 200
-        else:
-            return jsonify({"error": f"Aggregation not found: {name}"}), 404
+
+        records = table_records(
+            filepath, page_args['columns'], page_args['cursor'])
+        return paged_response(records, page_args['limit'], page_args['stream'])
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+# Endpoint to aggregate the merged data on demand
+@app.route('/data/aggregate', methods=['POST'])
+def aggregate_on_demand():
+    """
+    Aggregates the merged data by a spec, without running the pipeline.
+
+    Results are kept in memory until the merged data changes, so repeating a spec, or
+    listing its functions in another order, returns the cached result.
+
+    Request Body (JSON):
+    - groupby (list[str]): Columns to group by.
+    - agg_params (dict): Columns and aggregation functions, as in aggregation_parameters
+      of /run-pipeline.
+    - data_type (str): Only aggregate rows of this Data_Type (optional).
+    - persist (bool): Also write the result to the aggregated data folder (default: false).
+
+    Response:
+    - 200: Returns {"data": [...], "cached": bool, "seconds": float}, and the name of the
+      written file under "file" if persisted.
+    - 400: Invalid spec.
+    - 404: Merged data not found. Run the pipeline first.
+    - 500: Internal server error with the error message.
+    """
+    try:
+        request_data = request.get_json(silent=True)
+        if not isinstance(request_data, dict):
+            return jsonify({"error": "Expected a JSON object with 'groupby' and 'agg_params'"}), 400
+        spec = normalize_spec(request_data)
+        persist = request_data.get('persist', False)
+        if not isinstance(persist, bool):
+            return jsonify({"error": "'persist' must be a boolean"}), 400
+
+        if not os.path.exists(config.MERGED_TABLE_PATH):
+            return jsonify({"error": "Merged data not found. Run the pipeline first"}), 404
+
+        start = time.perf_counter()
+        result_df, cached = aggregation_cache.aggregate(spec)
+        response = {"cached": cached, "seconds": round(time.perf_counter() - start, 4)}
+
+        if persist:
+            output_file = get_output_file(spec['groupby'], spec['agg_params'])
+            write_stage_output(result_df, output_file)
+            response["file"] = os.path.basename(output_file)
+
+        body = json.dumps(response, separators=(',', ':'))[:-1] + ',"data":[' + ','.join(to_json_lines(result_df)) + ']}'
+        return Response(body, mimetype='application/json')
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
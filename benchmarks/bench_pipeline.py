@@ -0,0 +1,198 @@
+"""
+Benchmark of every pipeline stage on synthetic NSS data of several sizes.
+
+For each size, synthetic Block 4 and Block 8 files are generated into a temporary
+data folder and the pipeline runs on them in a fresh process, so the peak memory of
+a size does not carry over to the next. The wall time, CPU time, peak RSS and
+throughput of each stage come from the run report. Results are compared to the
+stored baseline, and the benchmark exits with status 1 if a stage got slower or
+larger than the tolerance allows.
+
+Run from the project root:
+
+    python -m benchmarks.bench_pipeline --sizes 1000 10000 50000
+    python -m benchmarks.bench_pipeline --save-baseline
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import config
+from benchmarks.generate_nss_data import generate_nss_data
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline_baseline.json')
+
+# Differences below these are noise, whatever the tolerance
+MIN_SECONDS = 0.5
+MIN_MEMORY_MB = 20
+
+
+def run_size(households, workers, seed, keep_data=False):
+    """
+    Generates synthetic data of a size and runs the whole pipeline on it.
+
+    Parameters
+    ----------
+    households : int
+        Number of synthetic households.
+    workers : int
+        Number of processes running independent stages at once.
+    seed : int
+        Seed of the synthetic data.
+    keep_data : bool (default=False)
+        Keep the data folder of the run instead of removing it.
+
+    Returns
+    -------
+    dict
+        Rows of each raw file, and the totals and stage metrics of the run.
+    """
+    data_dir = tempfile.mkdtemp(prefix=f'nss-bench-{households}-')
+    try:
+        generated = generate_nss_data(os.path.join(data_dir, 'raw'), households, seed)
+        # The pipeline logs to 'logs' in its working directory, kept out of the repo
+        os.makedirs(os.path.join(data_dir, 'logs'))
+        subprocess.run([sys.executable, os.path.join(config.BASE_DIR, 'pipeline.py'),
+                        '--no-cache', '--workers', str(workers)],
+                       env={**os.environ, 'PIPELINE_DATA_DIR': data_dir}, cwd=data_dir,
+                       check=True, capture_output=True, text=True)
+        report_file = sorted(glob.glob(os.path.join(data_dir, 'metrics', 'run_*.json')))[-1]
+        with open(report_file) as f:
+            report = json.load(f)
+    except subprocess.CalledProcessError as error:
+        raise RuntimeError(f'Pipeline failed on {households} households:\n{error.stderr}')
+    finally:
+        if keep_data:
+            print(f'Data of {households:,} households kept in {data_dir}')
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    return summarize_run(report, {name: output['rows'] for name, output in generated.items()})
+
+
+def summarize_run(report, raw_rows):
+    """
+    Returns the totals of a run report and, for each stage, its time, memory and throughput.
+    """
+    stages = {}
+    for stage, metrics in report['stages'].items():
+        wall = metrics['wall_seconds'] or 1e-9
+        stages[stage] = {
+            'wall_seconds': metrics['wall_seconds'],
+            'cpu_seconds': metrics['cpu_seconds'],
+            'peak_rss_mb': metrics['peak_rss_mb'],
+            'rows_in': metrics['rows_in'],
+            'rows_out': metrics['rows_out'],
+            'rows_per_second': round(metrics['rows_in'] / wall),
+            'mb_per_second': round(metrics['bytes_read'] / (1024 * 1024) / wall, 2),
+        }
+    return {'raw_rows': raw_rows, 'wall_seconds': report['wall_seconds'],
+            'cpu_seconds': report['cpu_seconds'], 'peak_rss_mb': report['peak_rss_mb'],
+            'stages': stages}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the regressions of the results against the baseline: stages whose wall time
+    or peak RSS grew by more than the tolerance, at a size present in both.
+    """
+    regressions = []
+    for size, result in results.items():
+        base = baseline.get(size)
+        if base is None:
+            continue
+        for stage, metrics in result['stages'].items():
+            base_metrics = base['stages'].get(stage)
+            if base_metrics is None:
+                continue
+            for key, floor in [('wall_seconds', MIN_SECONDS), ('peak_rss_mb', MIN_MEMORY_MB)]:
+                current, previous = metrics[key], base_metrics[key]
+                if current > previous * (1 + tolerance) and current - previous > floor:
+                    regressions.append(f'{size} households, {stage}: {key} {previous} -> {current} '
+                                       f'({current / previous - 1:+.0%})')
+    return regressions
+
+
+def print_results(results, baseline):
+    """
+    Prints a table of the stages at each size, with the change of wall time from the baseline.
+    """
+    print(f"{'Households':>10}  {'Stage':24} {'Rows in':>11} {'Wall s':>8} {'CPU s':>8} "
+          f"{'Rows/s':>11} {'MB/s':>8} {'Peak MB':>8} {'vs base':>8}")
+    for size, result in results.items():
+        base_stages = baseline.get(size, {}).get('stages', {})
+        for stage, metrics in result['stages'].items():
+            change = ''
+            if stage in base_stages and base_stages[stage]['wall_seconds']:
+                change = f"{metrics['wall_seconds'] / base_stages[stage]['wall_seconds'] - 1:+.0%}"
+            print(f"{int(size):>10,}  {stage:24} {metrics['rows_in']:>11,} {metrics['wall_seconds']:>8.2f} "
+                  f"{metrics['cpu_seconds']:>8.2f} {metrics['rows_per_second']:>11,} "
+                  f"{metrics['mb_per_second']:>8.2f} {metrics['peak_rss_mb']:>8.1f} {change:>8}")
+        print(f"{int(size):>10,}  {'total':24} {sum(result['raw_rows'].values()):>11,} "
+              f"{result['wall_seconds']:>8.2f} {result['cpu_seconds']:>8.2f} {'':>11} {'':>8} "
+              f"{result['peak_rss_mb']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic NSS data.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 50000],
+                        help="Numbers of households to benchmark.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes running independent stages at once.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic data.")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="Path of the baseline results.")
+    parser.add_argument("--save-baseline", action='store_true',
+                        help="Store the results as the new baseline instead of comparing them.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Relative growth of wall time or peak RSS reported as a regression.")
+    parser.add_argument("--keep-data", action='store_true',
+                        help="Keep the synthetic data and outputs of each size.")
+    args = parser.parse_args()
+
+    results = {}
+    for households in args.sizes:
+        print(f"Running the pipeline on {households:,} households...")
+        results[str(households)] = run_size(households, args.workers, args.seed, args.keep_data)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored.get('workers') == args.workers and stored.get('seed') == args.seed:
+            baseline = stored['sizes']
+        else:
+            print("Baseline was run with other workers or seed, not comparing")
+
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': {'platform': platform.platform(), 'cpus': os.cpu_count(),
+                                   'python': platform.python_version()},
+                       'workers': args.workers, 'seed': args.seed,
+                       # Sizes that were not rerun keep their stored results
+                       'sizes': {**baseline, **results}}, f, indent=2)
+            f.write('\n')
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions" if baseline else "No baseline to compare to")
+
+
+if __name__ == '__main__':
+    main()
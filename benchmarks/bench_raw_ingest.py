@@ -0,0 +1,131 @@
+"""
+Benchmark of the typed raw-file reader `load_raw_dataframe` against the inferring `load_dataframe`.
+
+Synthetic Block 4 and Block 8 files are generated into a temporary folder and each one
+is read both ways, then prepared and formatted as `clean_data` does before its
+dataset-specific steps. For each reader, the benchmark prints the parse time, the time
+to the formatted frame, the memory of the parsed frame and the peak memory traced
+while parsing and formatting.
+
+Run from the project root:
+
+    python -m benchmarks.bench_raw_ingest --households 20000
+"""
+import argparse
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.generate_nss_data import generate_nss_data
+from scripts.data_cleaning import format_frame, prepare_frame
+from utils.file_utils import load_dataframe, load_raw_dataframe
+
+
+CRITICAL_COLUMNS = ['HHID']
+CATEGORY_COLUMNS = ['Status_of_Current_Attendance', 'Type_of_Educationa_Institution',
+                    'Registered_with_Emp_Exchange', 'Vocational_Training', 'Field_of_Training',
+                    'MGNREG_jobcard', 'MGNREG_work', 'General_Education']
+NUMERIC_COLUMNS = ['Age', 'Value_of_Consumption_Last_30_Day']
+IRRELEVANT_COLUMNS = ['Blank', 'Spl_characters_for_OK_stamp']
+
+
+def legacy_read(path):
+    return load_dataframe(path, compact=False)
+
+
+def typed_read(path):
+    return load_raw_dataframe(path, exclude_columns=IRRELEVANT_COLUMNS)
+
+
+def legacy_format_frame(df):
+    """
+    Former `format_frame`: every numeric column coerced and rounded, then `NUMERIC_COLUMNS` again.
+    """
+    for columns, decimal_places in [(df.select_dtypes('number'), 2), (NUMERIC_COLUMNS, 0)]:
+        for col in columns:
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors='coerce').round(decimal_places)
+    return df
+
+
+def legacy_clean(path):
+    df = prepare_frame(legacy_read(path), CRITICAL_COLUMNS, CATEGORY_COLUMNS, IRRELEVANT_COLUMNS)
+    df = df.drop_duplicates()
+    return legacy_format_frame(df)
+
+
+def typed_clean(path):
+    df = prepare_frame(typed_read(path), CRITICAL_COLUMNS, CATEGORY_COLUMNS, IRRELEVANT_COLUMNS)
+    df = df.drop_duplicates()
+    return format_frame(df, CATEGORY_COLUMNS, NUMERIC_COLUMNS)
+
+
+def time_call(func, path, repeat):
+    """
+    Returns the best wall time of `repeat` calls, and the result of the last one.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(path)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def peak_memory_mb(func, path):
+    """
+    Returns the peak memory traced during a call, in MB.
+    """
+    tracemalloc.start()
+    try:
+        func(path)
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def frame_mb(df):
+    return df.memory_usage(index=True, deep=True).sum() / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark typed parsing of raw NSS files.")
+    parser.add_argument("--households", type=int, default=20000,
+                        help="Number of synthetic households.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic data.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs per reader.")
+    args = parser.parse_args()
+
+    raw_dir = tempfile.mkdtemp(prefix='nss-raw-ingest-')
+    try:
+        generated = generate_nss_data(raw_dir, args.households, args.seed)
+        for name, output in generated.items():
+            path = output['path']
+            legacy_parse, legacy_df = time_call(legacy_read, path, args.repeat)
+            typed_parse, typed_df = time_call(typed_read, path, args.repeat)
+            legacy_total, legacy_cleaned = time_call(legacy_clean, path, args.repeat)
+            typed_total, typed_cleaned = time_call(typed_clean, path, args.repeat)
+            assert len(legacy_cleaned) == len(typed_cleaned), f'{name} rows differ'
+            legacy_peak = peak_memory_mb(legacy_clean, path)
+            typed_peak = peak_memory_mb(typed_clean, path)
+
+            print(f"{name.capitalize()}: {output['rows']:,} rows, {legacy_df.shape[1]} -> {typed_df.shape[1]} columns")
+            print(f"  {'':18} {'Parse s':>8} {'Formatted s':>12} {'Frame MB':>9} {'Peak MB':>8}")
+            print(f"  {'load_dataframe':18} {legacy_parse:8.3f} {legacy_total:12.3f} "
+                  f"{frame_mb(legacy_df):9.1f} {legacy_peak:8.1f}")
+            print(f"  {'load_raw_dataframe':18} {typed_parse:8.3f} {typed_total:12.3f} "
+                  f"{frame_mb(typed_df):9.1f} {typed_peak:8.1f}")
+            print(f"  Speedup {legacy_parse / typed_parse:.1f}x parsing, {legacy_total / typed_total:.1f}x to formatted, "
+                  f"{frame_mb(legacy_df) / frame_mb(typed_df):.1f}x smaller frame")
+    finally:
+        shutil.rmtree(raw_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark of `normalize_strings` against the per-cell string helpers it replaced.
+
+Run from the project root:
+
+    python -m benchmarks.bench_string_normalization --rows 1000000
+"""
+import argparse
+import time
+
+import pandas as pd
+
+import config
+from utils.dataframe_utils import normalize_strings, replace_not_known_with_unknown
+
+
+CATEGORY_COLUMNS = ['Status_of_Current_Attendance', 'Type_of_Educationa_Institution',
+                    'Registered_with_Emp_Exchange', 'Vocational_Training', 'Field_of_Training',
+                    'MGNREG_jobcard', 'MGNREG_work', 'General_Education']
+
+
+def legacy_strip_strings(df):
+    """
+    Former `strip_strings`: blank-to-null and per-cell strip.
+    """
+    df = df.replace(' ', None)
+    for col in df.columns:
+        df[col] = df[col].apply(
+            lambda x: x.strip() if isinstance(x, str) else x)
+    return df
+
+
+def legacy_capitalize_strings(df, cols):
+    """
+    Former `capitalize_strings` with its result kept and only the first letter uppercased,
+    so both paths do the same work.
+    """
+    for col in cols:
+        if col in df.columns:
+            df[col] = df[col].apply(
+                lambda x: x[:1].upper() + x[1:] if isinstance(x, str) else x)
+    return df
+
+
+def legacy_normalize(df):
+    df = legacy_strip_strings(df)
+    for col in df.columns:
+        df[col] = df[col].apply(
+            lambda x: ' '.join(x.split()) if isinstance(x, str) else x)
+    df = legacy_capitalize_strings(df, CATEGORY_COLUMNS)
+    replace_not_known_with_unknown(df, ['Type_of_Educationa_Institution'])
+    return df
+
+
+def vectorized_normalize(df):
+    df = normalize_strings(df, CATEGORY_COLUMNS)
+    replace_not_known_with_unknown(df, ['Type_of_Educationa_Institution'])
+    return df
+
+
+def time_call(func, df, repeat):
+    """
+    Returns the best wall time of `repeat` calls on fresh copies of `df`.
+    """
+    timings = []
+    for _ in range(repeat):
+        frame = df.copy()
+        start = time.perf_counter()
+        func(frame)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark string normalization of raw demographic data.")
+    parser.add_argument("--rows", type=int, default=1_000_000,
+                        help="Number of rows to resample from the raw demographic file.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs per implementation.")
+    args = parser.parse_args()
+
+    sample_df = pd.read_csv(config.RAW_DEMOGRAPHICS_PATH, sep='\t')
+    df = sample_df.sample(n=args.rows, replace=True,
+                          random_state=0).reset_index(drop=True)
+
+    legacy = time_call(legacy_normalize, df, args.repeat)
+    vectorized = time_call(vectorized_normalize, df, args.repeat)
+
+    print(f"Rows: {args.rows:,}  Columns: {len(df.columns)}")
+    print(f"Per-cell helpers:   {legacy:8.3f} s")
+    print(f"normalize_strings:  {vectorized:8.3f} s")
+    print(f"Speedup:            {legacy / vectorized:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
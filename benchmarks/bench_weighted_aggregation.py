@@ -0,0 +1,128 @@
+"""
+Benchmark of survey-weighted aggregations against per-group lambdas.
+
+Rows of the merged sample are resampled and spread over random states, districts and
+survey weights, then population estimates are computed per state, district and sector:
+the number of persons, the yearly consumption total, the mean monthly consumption and
+the variance of ages. Two implementations are timed:
+
+- groupby: `compute_aggregation` with the weighted functions of the aggregation spec,
+  which sums weights, weighted values and weighted squares in one pandas groupby.
+- lambdas: a groupby calling `np.average` on every group, as custom aggregations would.
+
+Run from the project root, once the pipeline has merged the sample data:
+
+    python -m benchmarks.bench_weighted_aggregation --rows 5000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import config
+from scripts.data_aggregation import compute_aggregation, get_output_column
+from utils.file_utils import load_dataframe
+
+
+GROUPBY = ['State', 'District_Code', 'Sector']
+WEIGHT = 'Multiplier_comb'
+AGG_PARAMS = {
+    'Person_Serial_No': {'weighted_count': WEIGHT},
+    'Value_Consumption_Last_365_Days': {'weighted_sum': WEIGHT},
+    'Value_of_Consumption_Last_30_Day': {'weighted_mean': WEIGHT},
+    'Age': {'weighted_var': WEIGHT},
+}
+
+
+def make_frame(rows, states, districts, seed=0):
+    """
+    Returns `rows` resampled rows of the merged data with random group keys and weights.
+    """
+    rng = np.random.default_rng(seed)
+    sample_df = load_dataframe(config.MERGED_TABLE_PATH, columns=['Sector'] + list(AGG_PARAMS))
+    df = sample_df.sample(n=rows, replace=True, random_state=seed).reset_index(drop=True)
+    df['State'] = pd.Categorical.from_codes(rng.integers(0, states, rows),
+                                            [f'STATE {state:02d}' for state in range(states)])
+    df['District_Code'] = pd.Categorical.from_codes(rng.integers(0, districts, rows),
+                                                    [f'District {district:02d}' for district in range(districts)])
+    df[WEIGHT] = rng.lognormal(6, 1, rows).astype(np.float32)
+    return df
+
+
+def groupby_aggregation(df):
+    return compute_aggregation(df, {'groupby': GROUPBY, 'agg_params': AGG_PARAMS}, {})
+
+
+def lambda_aggregation(df):
+    def estimates(group):
+        result = {}
+        for col, func in AGG_PARAMS.items():
+            valid = group[col].notna()
+            values, weights = group.loc[valid, col].astype(np.float64), group.loc[valid, WEIGHT].astype(np.float64)
+            op = next(iter(func))
+            if op == 'weighted_count':
+                result[get_output_column(col, func)] = weights.sum()
+            elif op == 'weighted_sum':
+                result[get_output_column(col, func)] = (values * weights).sum()
+            elif weights.sum() == 0:
+                result[get_output_column(col, func)] = np.nan
+            elif op == 'weighted_mean':
+                result[get_output_column(col, func)] = np.average(values, weights=weights)
+            else:
+                mean = np.average(values, weights=weights)
+                result[get_output_column(col, func)] = np.average((values - mean) ** 2, weights=weights)
+        return pd.Series(result)
+    return df.groupby(GROUPBY, observed=True, sort=True).apply(estimates, include_groups=False).round(2).reset_index()
+
+
+def time_call(func, df, repeat):
+    """
+    Returns the best wall time of `repeat` calls, and the result of the last one.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(df)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def check_results(expected_df, result_df, name):
+    """
+    Raises an AssertionError if a result differs from `compute_aggregation` beyond rounding.
+    """
+    merged_df = expected_df.merge(result_df, on=GROUPBY, suffixes=('', '_other'))
+    assert len(merged_df) == len(expected_df), f'{name} has other groups'
+    for col, func in AGG_PARAMS.items():
+        output_col = get_output_column(col, func)
+        assert np.allclose(merged_df[output_col], merged_df[output_col + '_other'],
+                           rtol=1e-6, atol=0.02, equal_nan=True), f'{name} differs on {output_col}'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark survey-weighted aggregations of merged data.")
+    parser.add_argument("--rows", type=int, default=5_000_000,
+                        help="Number of rows to resample from the merged data.")
+    parser.add_argument("--states", type=int, default=36,
+                        help="Number of distinct states.")
+    parser.add_argument("--districts", type=int, default=50,
+                        help="Number of distinct districts.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs per implementation.")
+    args = parser.parse_args()
+
+    df = make_frame(args.rows, args.states, args.districts)
+
+    groupby, groupby_df = time_call(groupby_aggregation, df, args.repeat)
+    lambdas, lambda_df = time_call(lambda_aggregation, df, 1)
+    check_results(groupby_df, lambda_df, 'lambdas')
+
+    print(f"Rows: {args.rows:,}  Groups: {len(groupby_df):,}")
+    print(f"compute_aggregation: {groupby:8.3f} s")
+    print(f"Per-group lambdas:   {lambdas:8.3f} s  ({lambdas / groupby:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
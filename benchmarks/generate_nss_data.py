@@ -0,0 +1,343 @@
+"""
+Generator of synthetic NSS 68th round Block 4 (demographic) and Block 8 (consumer
+expenditure) files, at any size, for benchmarks.
+
+Households are resampled from the sample files in `data/raw`, so each synthetic
+household keeps the members, ages and relations, or the expenditure items, of a real
+one. Their identification is drawn afresh: states by their Census 2011 population
+share, 8 households per first stage unit (FSU) spread over the second stage strata as
+in the sample, and one multiplier per FSU and stratum. Rows are written exactly as in
+the raw files, with blank cells as a single space, the zero padding of Block 8 codes
+and the runs of spaces in the labels.
+
+Run from the project root:
+
+    python -m benchmarks.generate_nss_data --households 100000 --output-dir /tmp/nss/raw
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import config
+
+
+# NSS state codes, names as in the State column, and Census 2011 population in millions
+STATES = [
+    (1, 'JAMMU & KASHMIR', 12.5), (2, 'HIMACHAL PRADESH', 6.9), (3, 'PUNJAB', 27.7),
+    (4, 'CHANDIGARH', 1.1), (5, 'UTTARAKHAND', 10.1), (6, 'HARYANA', 25.4),
+    (7, 'DELHI', 16.8), (8, 'RAJASTHAN', 68.5), (9, 'UTTAR PRADESH', 199.8),
+    (10, 'BIHAR', 104.1), (11, 'SIKKIM', 0.6), (12, 'ARUNACHAL PRADESH', 1.4),
+    (13, 'NAGALAND', 2.0), (14, 'MANIPUR', 2.9), (15, 'MIZORAM', 1.1),
+    (16, 'TRIPURA', 3.7), (17, 'MEGHALAYA', 3.0), (18, 'ASSAM', 31.2),
+    (19, 'WEST BENGAL', 91.3), (20, 'JHARKHAND', 33.0), (21, 'ODISHA', 42.0),
+    (22, 'CHHATTISGARH', 25.5), (23, 'MADHYA PRADESH', 72.6), (24, 'GUJARAT', 60.4),
+    (25, 'DAMAN & DIU', 0.2), (26, 'DADRA & NAGAR HAVELI', 0.3), (27, 'MAHARASHTRA', 112.4),
+    (28, 'ANDHRA PRADESH', 84.6), (29, 'KARNATAKA', 61.1), (30, 'GOA', 1.5),
+    (31, 'LAKSHADWEEP', 0.1), (32, 'KERALA', 33.4), (33, 'TAMIL NADU', 72.1),
+    (34, 'PUDUCHERRY', 1.2), (35, 'A & N ISLANDS', 0.4),
+]
+
+# Roughly one district per 2 million people
+PEOPLE_PER_DISTRICT = 2.0
+
+# Share of FSUs in urban blocks
+URBAN_SHARE = 0.35
+
+# Hamlet group, second stage stratum and household number of the 8 households of an FSU
+HOUSEHOLD_SLOTS = [(1, 1, 1), (1, 1, 2), (1, 2, 1), (1, 2, 2),
+                   (1, 2, 3), (1, 2, 4), (1, 3, 1), (1, 3, 2)]
+
+# Columns identifying the household, drawn for each synthetic household.
+# The other columns are copied from the resampled household.
+HOUSEHOLD_COLUMNS = ['FSU_Serial_No', 'Sector', 'State_Region', 'District', 'Stratum',
+                     'Sub_Stratum_No', 'Sub_Sample', 'FOD_Sub_Region', 'Hamlet_Group_Sub_Block_No',
+                     'Second_Stage_Stratum_No', 'Sample_Hhld_No', 'MLT', 'MLT_SR', 'State',
+                     'District_Code', 'HHID', 'Multiplier_comb']
+
+# Consumption values, scaled by a factor drawn for each household
+VALUE_COLUMNS = ['Value_of_Consumption_Last_30_Day', 'Value_Consumption_Last_365_Days']
+
+# Spread of the household factor of consumption values
+VALUE_SIGMA = 0.4
+
+# Households generated at once
+CHUNK_HOUSEHOLDS = 50000
+
+
+class BlockTemplate:
+    """
+    Households of a raw sample file, resampled to write synthetic rows in its exact format.
+
+    Consecutive columns copied from the resampled household are joined once per template
+    row, so a synthetic row is a join of a few strings.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the raw sample file.
+    """
+
+    def __init__(self, file_path):
+        df = pd.read_csv(file_path, sep='\t', dtype=str, keep_default_na=False)
+        self.columns = list(df.columns)
+
+        # Zero padding of the household columns, e.g. '01' for District in Block 8
+        self.pad_widths = {col: get_pad_width(df[col]) for col in HOUSEHOLD_COLUMNS}
+
+        # Rows of each household, in file order
+        codes, households = pd.factorize(df['HHID'])
+        self.row_order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes)
+        self.household_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        self.household_sizes = counts
+
+        # Segments of the row: ('template', joined strings of the template rows),
+        # ('household', column) or ('value', column)
+        self.segments = []
+        run = []
+        for col in self.columns + [None]:
+            if col is None or col in HOUSEHOLD_COLUMNS or col in VALUE_COLUMNS:
+                if run:
+                    self.segments.append(('template', np.array(
+                        df[run].agg('\t'.join, axis=1).to_numpy()[self.row_order], dtype=object)))
+                    run = []
+                if col is not None:
+                    kind = 'household' if col in HOUSEHOLD_COLUMNS else 'value'
+                    values = df[col].to_numpy()[self.row_order] if kind == 'value' else None
+                    self.segments.append((kind, col, values))
+            else:
+                run.append(col)
+
+        # District names of the sample, by state and district number
+        district_names = df[['State', 'District', 'District_Code']].drop_duplicates()
+        self.district_names = {(state, int(district)): name for state, district, name in
+                               district_names.itertuples(index=False)}
+
+    def render(self, households, templates, value_factors):
+        """
+        Returns the rows of synthetic households as TSV text.
+
+        Parameters
+        ----------
+        households : dict
+            Formatted values of each household column, one array item per household.
+        templates : numpy.ndarray
+            Index of the template household of each synthetic household.
+        value_factors : numpy.ndarray
+            Factor of the consumption values of each household.
+
+        Returns
+        -------
+        tuple
+            The rows, and their number.
+        """
+        sizes = self.household_sizes[templates]
+        row_household = np.repeat(np.arange(len(templates)), sizes)
+        # Template row of each synthetic row
+        offsets = np.arange(len(row_household)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        row_template = self.household_starts[templates][row_household] + offsets
+
+        parts = []
+        for segment in self.segments:
+            if segment[0] == 'template':
+                parts.append(segment[1][row_template])
+            elif segment[0] == 'household':
+                column = segment[1]
+                parts.append(np.asarray(households[column], dtype=object)[row_household])
+            else:
+                parts.append(scale_values(segment[2][row_template], value_factors[row_household]))
+
+        text = '\n'.join(map('\t'.join, zip(*parts)))
+        return text + '\n' if text else text, len(row_household)
+
+    def format_households(self, households):
+        """
+        Formats the household columns with the zero padding of this file.
+        """
+        formatted = {}
+        for col, values in households.items():
+            if self.pad_widths[col] and values.dtype.kind in 'iu':
+                formatted[col] = np.char.zfill(values.astype(str), self.pad_widths[col])
+            else:
+                formatted[col] = values.astype(str)
+        return formatted
+
+
+def get_pad_width(values):
+    """
+    Returns the zero-padded width of a column of codes, or 0 if it is not padded.
+    """
+    lengths = values.str.len()
+    if lengths.nunique() == 1 and lengths.iloc[0] > 1 and values.str.startswith('0').any() \
+            and values.str.isdigit().all():
+        return int(lengths.iloc[0])
+    return 0
+
+
+def scale_values(values, factors):
+    """
+    Scales whole rupee values by the household factors. Blank cells stay blank.
+    """
+    blank = values == ' '
+    numbers = np.where(blank, '0', values).astype(float)
+    scaled = np.maximum(np.rint(numbers * factors), 1).astype(np.int64).astype(str).astype(object)
+    scaled[blank] = ' '
+    return scaled
+
+
+def draw_households(rng, first_fsu, fsus, district_names):
+    """
+    Draws the identification of the households of consecutive FSUs.
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+        Random generator.
+    first_fsu : int
+        Serial number of the first FSU.
+    fsus : int
+        Number of FSUs.
+    district_names : dict
+        District names of the sample, by state and district number. Other districts
+        are named after their state and number.
+
+    Returns
+    -------
+    dict
+        Values of each household column, one item per household, as numbers or strings.
+    """
+    codes = np.array([code for code, _, _ in STATES])
+    names = np.array([name for _, name, _ in STATES], dtype=object)
+    population = np.array([people for _, _, people in STATES])
+    district_counts = np.maximum(np.rint(population / PEOPLE_PER_DISTRICT), 1).astype(int)
+
+    # FSU level
+    state = rng.choice(len(STATES), size=fsus, p=population / population.sum())
+    district = (rng.random(fsus) * district_counts[state]).astype(int) + 1
+    region = rng.integers(0, 2, size=fsus)
+    fsu_serial = first_fsu + np.arange(fsus)
+    sector = np.where(rng.random(fsus) < URBAN_SHARE, 'Urban', 'Rural')
+    sub_stratum = rng.integers(1, 7, size=fsus)
+
+    # Household level: 8 households per FSU
+    slots = np.array(HOUSEHOLD_SLOTS)
+    per_fsu = len(slots)
+    fsu = np.repeat(np.arange(fsus), per_fsu)
+    hamlet = np.tile(slots[:, 0], fsus)
+    stratum = np.tile(slots[:, 1], fsus)
+    household_no = np.tile(slots[:, 2], fsus)
+
+    # One multiplier per FSU and second stage stratum
+    mlt = np.rint(np.exp(rng.normal(10.5, 0.8, size=(fsus, 3)))).astype(np.int64)
+    mlt = mlt[fsu, stratum - 1]
+
+    state_codes = codes[state][fsu]
+    district_code = np.array([district_names.get((n, d), f'{n.title()} District {d:02d}')
+                              for n, d in zip(names[state], district)], dtype=object)[fsu]
+
+    return {
+        'FSU_Serial_No': fsu_serial[fsu],
+        'Sector': sector[fsu],
+        'State_Region': state_codes * 10 + region[fsu] + 1,
+        'District': district[fsu],
+        'Stratum': district[fsu],
+        'Sub_Stratum_No': sub_stratum[fsu],
+        'Sub_Sample': fsu_serial[fsu] % 2 + 1,
+        'FOD_Sub_Region': state_codes * 100 + 10 + region[fsu],
+        'Hamlet_Group_Sub_Block_No': hamlet,
+        'Second_Stage_Stratum_No': stratum,
+        'Sample_Hhld_No': household_no,
+        'MLT': mlt,
+        'MLT_SR': mlt * 2,
+        'State': names[state][fsu],
+        'District_Code': district_code,
+        'HHID': fsu_serial[fsu] * 10000 + hamlet * 1000 + stratum * 100 + household_no,
+        # Two or three decimals, as in the sample: 64816 -> 324.08
+        'Multiplier_comb': np.array([f'{value:.3f}'.rstrip('0').rstrip('.')
+                                     for value in mlt / 200], dtype=object),
+    }
+
+
+def generate_nss_data(output_dir, households, seed=0, demographic_file=None, expenditure_file=None):
+    """
+    Writes synthetic Block 4 and Block 8 files with the same households.
+
+    Parameters
+    ----------
+    output_dir : str
+        Folder of the generated files, named as `config.RAW_DEMOGRAPHICS_FILE`
+        and `config.RAW_EXPENDITURE_FILE`.
+    households : int
+        Number of households. Block 4 has about 5 rows per household and Block 8 about 29.
+    seed : int (default=0)
+        Seed of the random generator. The same seed writes the same files.
+    demographic_file : str (default=None)
+        Sample demographic file to resample. Defaults to `config.RAW_DEMOGRAPHICS_PATH`.
+    expenditure_file : str (default=None)
+        Sample expenditure file to resample. Defaults to `config.RAW_EXPENDITURE_PATH`.
+
+    Returns
+    -------
+    dict
+        Path and number of rows of each generated file, under 'demographic' and 'expenditure'.
+    """
+    demographic = BlockTemplate(demographic_file or config.RAW_DEMOGRAPHICS_PATH)
+    expenditure = BlockTemplate(expenditure_file or config.RAW_EXPENDITURE_PATH)
+    rng = np.random.default_rng(seed)
+
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {'demographic': {'path': os.path.join(output_dir, config.RAW_DEMOGRAPHICS_FILE), 'rows': 0},
+               'expenditure': {'path': os.path.join(output_dir, config.RAW_EXPENDITURE_FILE), 'rows': 0}}
+
+    per_fsu = len(HOUSEHOLD_SLOTS)
+    total_fsus = -(-households // per_fsu)
+    chunk_fsus = max(CHUNK_HOUSEHOLDS // per_fsu, 1)
+    with open(outputs['demographic']['path'], 'w', newline='') as demographic_out, \
+            open(outputs['expenditure']['path'], 'w', newline='') as expenditure_out:
+        demographic_out.write('\t'.join(demographic.columns) + '\n')
+        expenditure_out.write('\t'.join(expenditure.columns) + '\n')
+
+        for first in range(0, total_fsus, chunk_fsus):
+            fsus = min(chunk_fsus, total_fsus - first)
+            drawn = draw_households(rng, 10000 + first, fsus, demographic.district_names)
+            # The last FSU may be partly filled
+            count = min(fsus * per_fsu, households - first * per_fsu)
+            drawn = {col: values[:count] for col, values in drawn.items()}
+
+            for block, out, name in [(demographic, demographic_out, 'demographic'),
+                                     (expenditure, expenditure_out, 'expenditure')]:
+                templates = rng.integers(0, len(block.household_sizes), size=count)
+                factors = np.exp(rng.normal(0, VALUE_SIGMA, size=count))
+                text, rows = block.render(block.format_households(drawn), templates, factors)
+                out.write(text)
+                outputs[name]['rows'] += rows
+
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic NSS Block 4 and Block 8 files.")
+    parser.add_argument("--households", type=int, default=100_000,
+                        help="Number of households. Block 4 has about 5 rows per household and Block 8 about 29.")
+    parser.add_argument("--output-dir", default=os.path.join(config.DATA_DIR, "synthetic", "raw"),
+                        help="Folder of the generated files.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the random generator.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    outputs = generate_nss_data(args.output_dir, args.households, args.seed)
+    seconds = time.perf_counter() - start
+
+    for name, output in outputs.items():
+        size_mb = os.path.getsize(output['path']) / (1024 * 1024)
+        print(f"{name.capitalize():12} {output['rows']:>12,} rows  {size_mb:10.1f} MB  {output['path']}")
+    print(f"Generated {args.households:,} households in {seconds:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
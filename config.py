@@ -1,20 +1,32 @@
 import os
 
 
+# Storage format of cleaned, merged and aggregated outputs.
+# 'col' is the typed columnar format read by load_dataframe, 'tsv' is plain text.
+INTERMEDIATE_FORMAT = "col"
+# Also export a TSV copy of every output stored in another format
+EXPORT_TSV = True
+
+
 # File names
 RAW_DEMOGRAPHICS_FILE = "Block_4_Demographic particulars of household members_sample.tsv"
 RAW_EXPENDITURE_FILE = "Block_8_Household consumer expenditure_sample.tsv"
-CLEANED_DEMOGRAPHICS_FILE = "demographic_cleaned.tsv"
-CLEANED_EXPENDITURE_FILE = "expenditure_cleaned.tsv"
+CLEANED_DEMOGRAPHICS_FILE = f"demographic_cleaned.{INTERMEDIATE_FORMAT}"
+CLEANED_EXPENDITURE_FILE = f"expenditure_cleaned.{INTERMEDIATE_FORMAT}"
+CLEANED_DEMOGRAPHICS_PARTITIONS_DIR = "demographic_cleaned"
+CLEANED_EXPENDITURE_PARTITIONS_DIR = "expenditure_cleaned"
 MERGED_JSON_FILE = "merged_data.json"
+MERGED_TABLE_FILE = f"merged_data.{INTERMEDIATE_FORMAT}"
 MERGED_TSV_FILE = "merged_data.tsv"
+MERGED_INDEX_FILE = "merged_data.idx.npy"
 
 
 # Define base project directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Data directories
-DATA_DIR = os.path.join(BASE_DIR, "data")
+# Data directories. Set the PIPELINE_DATA_DIR environment variable to run on another
+# data folder, e.g. the synthetic data of the benchmarks.
+DATA_DIR = os.environ.get("PIPELINE_DATA_DIR", os.path.join(BASE_DIR, "data"))
 RAW_DATA_DIR = os.path.join(DATA_DIR, "raw")
 CLEANED_DATA_DIR = os.path.join(DATA_DIR, "cleaned")
 MERGED_DATA_DIR = os.path.join(DATA_DIR, "merged")
@@ -30,8 +42,73 @@ CLEANED_DEMOGRAPHICS_PATH = os.path.join(
     CLEANED_DATA_DIR, CLEANED_DEMOGRAPHICS_FILE)
 CLEANED_EXPENDITURE_PATH = os.path.join(
     CLEANED_DATA_DIR, CLEANED_EXPENDITURE_FILE)
+CLEANED_DEMOGRAPHICS_PARTITIONS_PATH = os.path.join(
+    CLEANED_DATA_DIR, CLEANED_DEMOGRAPHICS_PARTITIONS_DIR)
+CLEANED_EXPENDITURE_PARTITIONS_PATH = os.path.join(
+    CLEANED_DATA_DIR, CLEANED_EXPENDITURE_PARTITIONS_DIR)
 MERGED_JSON_PATH = os.path.join(MERGED_DATA_DIR, MERGED_JSON_FILE)
+MERGED_TABLE_PATH = os.path.join(MERGED_DATA_DIR, MERGED_TABLE_FILE)
 MERGED_TSV_PATH = os.path.join(MERGED_DATA_DIR, MERGED_TSV_FILE)
+MERGED_INDEX_PATH = os.path.join(MERGED_DATA_DIR, MERGED_INDEX_FILE)
+
+
+# Merging settings
+# The nested JSON is read by the /data/merged endpoint and the visualization stage.
+WRITE_MERGED_JSON = True
+# Number of households serialized at once when writing the nested JSON
+MERGED_JSON_BATCH_SIZE = 10000
+# Partitioned merge: with more than one partition, both cleaned files are split on disk
+# by the hash of MERGE_PARTITION_BY ("HHID" or "State") and merged one partition at a time.
+# Peak memory is then about one partition per worker.
+MERGE_PARTITIONS = 1
+MERGE_PARTITION_BY = "HHID"
+# Rows of a cleaned file read at once while partitioning
+MERGE_CHUNK_ROWS = 500000
+# Folder of the partition files, removed once the merge is done
+MERGE_SPILL_DIR = os.path.join(MERGED_DATA_DIR, "spill")
+
+
+# Cleaning settings
+# Streaming mode cleans raw files chunk by chunk; the chunk size is derived from the memory budget.
+CLEANING_STREAMING = False
+CLEANING_MAX_MEMORY_MB = 512
+# Batch ingestion: raw files given as a list or glob pattern are cleaned one file per task
+# into a dataset partitioned by these columns, e.g. demographic_cleaned/State=ASSAM/Round=68/.
+CLEANED_PARTITION_BY = ["State", "Round"]
+
+
+# Number of processes running independent pipeline stages at once.
+# Each worker holds its own copy of the data it processes.
+PIPELINE_WORKERS = min(4, os.cpu_count() or 1)
+
+
+# Stage cache settings
+# Stages whose inputs and parameters are unchanged since their last run are skipped.
+STAGE_CACHE_ENABLED = True
+# Fingerprint raw inputs by content hash instead of size and modification time
+STAGE_CACHE_HASH_CONTENTS = False
+STAGE_CACHE_PATH = os.path.join(DATA_DIR, "stage_cache.json")
+
+
+# Incremental settings
+# Incremental runs (--incremental) clean and merge only the rows appended to the raw files
+# since the last run, and fold them into the aggregations through their partial state.
+INCREMENTAL_DIR = os.path.join(DATA_DIR, "incremental")
+# Byte offsets of the raw files read so far, and the outputs the next run appends to
+INCREMENTAL_STATE_PATH = os.path.join(INCREMENTAL_DIR, "state.json")
+# Partial state of every aggregation (sums, counts, minimums and maximums per group)
+AGGREGATION_STATE_DIR = os.path.join(INCREMENTAL_DIR, "aggregated")
+# Bytes before the end of the rows read so far that must be unchanged for new rows to be appended
+INCREMENTAL_TAIL_BYTES = 65536
+
+
+# Metrics settings
+# Every pipeline run writes a JSON report of its stages, served by the /metrics endpoint.
+METRICS_DIR = os.path.join(DATA_DIR, "metrics")
+# Number of run reports kept
+METRICS_HISTORY_SIZE = 100
+# Profile every stage with cProfile. Enable it for a single run with --profile.
+METRICS_PROFILE = False
 
 
 # Report directories
@@ -41,6 +118,33 @@ CHARTS_DIR = os.path.join(DATA_DIR, "charts")
 LOGS_DIR = os.path.join(BASE_DIR, "logs")
 PIPELINE_LOG_PATH = os.path.join(LOGS_DIR, "pipeline.log")
 
+# Job queue settings
+# Pipeline runs requested through the API run one at a time in the background.
+# Submissions beyond JOB_QUEUE_SIZE waiting jobs are rejected with 429.
+JOB_QUEUE_SIZE = 8
+# Number of finished jobs whose status is kept
+JOB_HISTORY_SIZE = 100
+
+# Response cache settings
+# Serialized responses of /data/cleaned and /data/merged are kept until their files change.
+RESPONSE_CACHE_MAX_MB = 256
+# Also keep a gzip-compressed copy for clients accepting gzip
+RESPONSE_CACHE_GZIP = True
+
+# Pagination settings of the data endpoints
+# Rows read from disk at once while paging or streaming
+STREAM_CHUNK_ROWS = 10000
+# Default and maximum number of rows of a JSON page
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+# Maximum number of households of a batch lookup
+MAX_HOUSEHOLD_BATCH = 1000
+
+# Number of aggregation files kept in memory, typed and indexed, for filter queries
+QUERY_CACHE_TABLES = 32
+# Number of on-demand aggregations of the merged data kept in memory by /data/aggregate
+AGGREGATION_CACHE_RESULTS = 128
+
 # API settings
 FLASK_RUN_HOST = "127.0.0.1"
 FLASK_RUN_PORT = 5000
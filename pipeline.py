@@ -1,46 +1,455 @@
-from scripts.data_cleaning import clean_data
-from scripts.data_merging import merge_data
+from scripts.data_cleaning import clean_data, clean_data_partitioned, clean_increment, get_part_name
+from scripts.data_merging import merge_data, merge_increment, write_unmerged_rows
 from scripts.data_visualization import visualize_data
-from scripts.data_aggregation import aggregate_data
+from scripts.data_aggregation import aggregate_all, get_output_file, get_spec_key, get_state_file, is_mergeable, normalize_spec, update_aggregations
 
 import config
+import schema
 import os
 import argparse
-
+from datetime import datetime
+import glob
+import json
+import shutil
+import sys
+import time
+
+from utils.cache_utils import compute_fingerprint, is_stage_cached, load_stage_cache, record_stage, remove_stage
+from utils.executor_utils import run_dag
+from utils.file_utils import find_files, get_cleaned_paths, get_stored_columns, load_dataframe, remove_partition_parts
+from utils.incremental_utils import (IncrementConflictError, clear_incremental_state, get_file_marks, get_increment_path,
+                                     get_output_signatures, is_appended, load_incremental_state, save_incremental_state)
 from utils.logger_utils import configure_logger, get_logger, log_error
+from utils.metrics_utils import enable_peak_rss_reset, get_cpu_seconds, get_peak_rss_mb, new_run_id, write_run_report
+
+
+def check_stage(stage_cache, stage, input_paths, params, use_cache, cache_report, hash_contents=False):
+    """
+    Fingerprints a stage and reports whether its outputs from a previous run can be reused.
+
+    Parameters
+    ----------
+
+    stage_cache : dict
+        Fingerprints of previous runs, from `load_stage_cache`.
+    stage : string
+        Name of the stage, e.g. 'clean:demographic'.
+    input_paths : list
+        Paths of the files read by the stage.
+    params : dict
+        Parameters that change the output of the stage.
+    use_cache : bool
+        Reuse outputs of unchanged stages.
+    cache_report : dict
+        Lists of 'hits' and 'misses' the stage name is added to.
+    hash_contents : bool (default=False)
+        Fingerprint the inputs by content hash instead of size and modification time.
+
+    Returns
+    -------
+
+    tuple
+        True if the stage can be skipped, and the fingerprint to record once it has run.
+    """
+
+    logger = get_logger(__name__)
+
+    fingerprint = compute_fingerprint(input_paths, params, hash_contents)
+    if use_cache and is_stage_cached(stage_cache, stage, fingerprint):
+        logger.info(f"Cache hit: {stage}")
+        cache_report['hits'].append(stage)
+        return True, fingerprint
+
+    logger.info(f"Cache miss: {stage}")
+    cache_report['misses'].append(stage)
+    # Forget the previous run, so a failure does not leave stale outputs cached
+    remove_stage(stage_cache, stage)
+    return False, fingerprint
+
+
+def cached_task(stage_cache, cache_report, stage, func, args, input_paths, params, output_paths, use_cache, deps, hash_contents=False):
+    """
+    Returns a `run_dag` task that runs a stage unless its outputs from a previous run can be reused.
+
+    The stage is fingerprinted once its dependencies have completed, and its fingerprint
+    is recorded once it has run.
+    """
+    fingerprint = {}
+
+    def prepare():
+        cached, fingerprint['value'] = check_stage(stage_cache, stage, input_paths, params,
+                                                   use_cache, cache_report, hash_contents)
+        return None if cached else args
+
+    def complete(result):
+        # Outputs only known once the stage has run are listed in its result
+        record_stage(stage_cache, stage, fingerprint['value'],
+                     output_paths(result) if callable(output_paths) else output_paths)
+
+    return {'func': func, 'args': args, 'deps': deps, 'prepare': prepare, 'complete': complete}
+
+
+def resolve_raw_files(raw_file, default_path):
+    """
+    Returns the raw files of a dataset, and True if they are cleaned as a batch.
+
+    A file name is resolved under `config.RAW_DATA_DIR` and cleaned on its own. A glob
+    pattern or a list of file names or patterns is a batch, even if it matches one file:
+    its files are cleaned in parallel into the partitions of a cleaned dataset.
+
+    Raises
+    ------
+
+    FileNotFoundError
+        If a pattern of a batch matches no file.
+    ValueError
+        If two files of a batch have the same name, so their parts would overwrite each other.
+    """
+    if not raw_file:
+        return [default_path], False
+    if isinstance(raw_file, str) and not glob.has_magic(raw_file):
+        return [os.path.join(config.RAW_DATA_DIR, raw_file)], False
+
+    raw_paths = find_files(raw_file, config.RAW_DATA_DIR)
+    part_names = [get_part_name(raw_path) for raw_path in raw_paths]
+    duplicates = sorted({name for name in part_names if part_names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'Files of a batch must have distinct names, found several {duplicates}')
+    return raw_paths, True
+
+
+def select_cleaned_output(stage_cache, dataset, cleaned_path, partitions_path, raw_paths=None):
+    """
+    Removes the cleaned outputs of a dataset that the current clean does not write, and
+    forgets their stages, so the merge and the API never read outputs of an older clean.
+
+    Before a single file is cleaned, the partitioned dataset is removed. Before a batch
+    is cleaned, the cleaned file is removed, and so are the parts of files no longer in the batch.
+    """
+    if raw_paths is None:
+        shutil.rmtree(partitions_path, ignore_errors=True)
+        stale_stages = [stage for stage in stage_cache if stage.startswith(f'clean:{dataset}:')]
+    else:
+        part_names = [get_part_name(raw_path) for raw_path in raw_paths]
+        for path in [cleaned_path, os.path.splitext(cleaned_path)[0] + '.tsv']:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        remove_partition_parts(partitions_path, keep=part_names)
+        stale_stages = [f'clean:{dataset}'] + [
+            stage for stage in stage_cache
+            if stage.startswith(f'clean:{dataset}:') and stage.split(':', 2)[2] not in part_names]
+    for stage in stale_stages:
+        remove_stage(stage_cache, stage)
+
+
+def aggregation_task(stage_cache, cache_report, specs, use_cache, deps, state_dir=None):
+    """
+    Returns a `run_dag` task that computes the aggregation specs whose outputs cannot be reused.
+
+    Each aggregation is cached on its own, so a new spec only runs itself. With a
+    `state_dir`, the partial states of mergeable aggregations are outputs too.
+    """
+    pending = []
+
+    def prepare():
+        for spec in specs:
+            output_file = get_output_file(spec['groupby'], spec['agg_params'])
+            stage = 'aggregate:' + os.path.basename(output_file)
+            params = {'groupby': spec['groupby'], 'agg_params': spec['agg_params'],
+                      'data_type': spec.get('data_type'), 'export_tsv': config.EXPORT_TSV}
+            output_paths = [output_file]
+            if state_dir:
+                params['state_dir'] = state_dir
+                if is_mergeable(spec['agg_params']):
+                    output_paths.append(get_state_file(output_file, state_dir))
+            cached, fingerprint = check_stage(stage_cache, stage, [config.MERGED_TABLE_PATH],
+                                              params, use_cache, cache_report)
+            if not cached:
+                pending.append((spec, stage, fingerprint, output_paths))
+        return ([spec for spec, _, _, _ in pending], state_dir) if pending else None
+
+    def complete(result):
+        for _, stage, fingerprint, output_paths in pending:
+            record_stage(stage_cache, stage, fingerprint, output_paths)
+
+    return {'func': aggregate_all, 'deps': deps, 'prepare': prepare, 'complete': complete}
+
+
+def get_pipeline_tasks(stage_cache, cache_report, report, action, demographic_file, expenditure_file, aggregation_parameters, use_cache, workers, merge_partitions, partition_filters, state_dir=None):
+    """
+    Returns the `run_dag` tasks of a full run of the pipeline, see `run_pipeline`.
+
+    Cleaned files of batches are added to the 'files' of the run report. Aggregations
+    also write their partial state to `state_dir` if specified.
+    """
+    logger = get_logger(__name__)
+
+    tasks = {}
+    cleaned_paths = get_cleaned_paths()
+
+    if action in ['clean', 'all']:
+        # Step 1: Clean data, both files at once, or every file of a batch at once
+        for dataset, raw_file, default_path, cleaned_path, partitions_path in [
+            ('demographic', demographic_file, config.RAW_DEMOGRAPHICS_PATH,
+             config.CLEANED_DEMOGRAPHICS_PATH, config.CLEANED_DEMOGRAPHICS_PARTITIONS_PATH),
+            ('expenditure', expenditure_file, config.RAW_EXPENDITURE_PATH,
+             config.CLEANED_EXPENDITURE_PATH, config.CLEANED_EXPENDITURE_PARTITIONS_PATH),
+        ]:
+            raw_paths, batch = resolve_raw_files(raw_file, default_path)
+            select_cleaned_output(stage_cache, dataset, cleaned_path, partitions_path,
+                                  raw_paths if batch else None)
+            params = {'output_file': cleaned_path,
+                      'export_tsv': config.EXPORT_TSV,
+                      'schema': schema.COLUMN_DTYPES}
+
+            if not batch:
+                cleaned_paths[dataset] = cleaned_path
+                stage = 'clean:' + dataset
+                tasks[stage] = cached_task(stage_cache, cache_report, stage, clean_data,
+                                           (raw_paths[0], cleaned_path), raw_paths, params,
+                                           [cleaned_path], use_cache, deps=[],
+                                           hash_contents=config.STAGE_CACHE_HASH_CONTENTS)
+                continue
+
+            # Each file of a batch is cleaned in its own task, into its own parts
+            cleaned_paths[dataset] = partitions_path
+            params.update({'output_file': partitions_path,
+                           'partition_by': config.CLEANED_PARTITION_BY})
+            logger.info(f"Cleaning {len(raw_paths)} {dataset} files into {partitions_path}")
+            for raw_path in raw_paths:
+                stage = f'clean:{dataset}:{get_part_name(raw_path)}'
+                tasks[stage] = cached_task(stage_cache, cache_report, stage, clean_data_partitioned,
+                                           (raw_path, partitions_path, config.CLEANED_PARTITION_BY),
+                                           [raw_path], params, lambda result: result['outputs'],
+                                           use_cache, deps=[],
+                                           hash_contents=config.STAGE_CACHE_HASH_CONTENTS)
+                report['files'].append({'dataset': dataset, 'file': raw_path, 'stage': stage})
+
+    if action in ['merge', 'all']:
+        # Step 2: Merge data once both files are cleaned
+        # Partitioned merges order rows by partition
+        # Batches are merged from the partitions matching `partition_filters`
+        if partition_filters and not any(path in (
+                config.CLEANED_DEMOGRAPHICS_PARTITIONS_PATH, config.CLEANED_EXPENDITURE_PARTITIONS_PATH)
+                for path in cleaned_paths.values()):
+            logger.warning("Partition filters are ignored, the cleaned data is not partitioned")
+        params = {'write_merged_json': config.WRITE_MERGED_JSON,
+                  'export_tsv': config.EXPORT_TSV,
+                  'schema': schema.COLUMN_DTYPES,
+                  'partitions': merge_partitions,
+                  'partition_by': config.MERGE_PARTITION_BY if merge_partitions > 1 else None,
+                  'filters': partition_filters}
+        merged_paths = [config.MERGED_TABLE_PATH]
+        if config.WRITE_MERGED_JSON:
+            merged_paths += [config.MERGED_JSON_PATH,
+                             config.MERGED_INDEX_PATH]
+        tasks['merge'] = cached_task(stage_cache, cache_report, 'merge', merge_data,
+                                     (cleaned_paths['expenditure'],
+                                      cleaned_paths['demographic'],
+                                      merge_partitions, config.MERGE_PARTITION_BY, workers,
+                                      partition_filters),
+                                     [cleaned_paths['expenditure'],
+                                         cleaned_paths['demographic']],
+                                     params, merged_paths, use_cache,
+                                     deps=[stage for stage in tasks if stage.startswith('clean:')])
+
+    merge_deps = ['merge'] if 'merge' in tasks else []
+
+    if action in ['aggregate', 'all']:
+        # Step 3: Generate aggregations in parallel once data is merged.
+        # Specs sharing their first group key run together to share factorized keys.
+        batches = {}
+        for spec in aggregation_parameters:
+            batches.setdefault(spec['groupby'][0], []).append(spec)
+        for key, specs in batches.items():
+            tasks['aggregate:' + key] = aggregation_task(
+                stage_cache, cache_report, specs, use_cache, merge_deps, state_dir)
+
+    if action in ['visualize', 'all']:
+        # Step 4: Generate visualizations alongside the aggregations
+        tasks['visualize'] = cached_task(stage_cache, cache_report, 'visualize', visualize_data, (workers,),
+                                         [config.MERGED_JSON_PATH], {}, [
+                                             config.CHARTS_DIR], use_cache,
+                                         deps=merge_deps)
+
+    return tasks
+
+
+def get_incremental_fingerprint():
+    """
+    Returns a fingerprint of the settings that change the outputs incremental runs append
+    to. A state recorded with other settings needs a full run.
+    """
+    return compute_fingerprint([], {'schema': schema.COLUMN_DTYPES,
+                                    'format': config.INTERMEDIATE_FORMAT,
+                                    'export_tsv': config.EXPORT_TSV,
+                                    'write_merged_json': config.WRITE_MERGED_JSON})
+
+
+def get_incremental_outputs():
+    """
+    Returns the outputs incremental runs append to.
+    """
+    outputs = [config.CLEANED_DEMOGRAPHICS_PATH, config.CLEANED_EXPENDITURE_PATH, config.MERGED_TABLE_PATH]
+    if config.WRITE_MERGED_JSON:
+        outputs += [config.MERGED_JSON_PATH, config.MERGED_INDEX_PATH]
+    return outputs
+
 
+def check_increment(incremental_state, raw_paths):
+    """
+    Returns why a full run is needed instead of an incremental one, or None if the rows
+    appended to the raw files can be folded into the outputs of the last run.
+    """
+    if incremental_state is None:
+        return 'no incremental run has completed'
+    if incremental_state['fingerprint'] != get_incremental_fingerprint():
+        return 'the settings of the outputs changed'
+    for dataset, raw_path in raw_paths.items():
+        if not is_appended(raw_path, incremental_state['files'].get(dataset)):
+            return f'{raw_path} is not the file of the last run with rows appended'
+    if get_output_signatures(incremental_state['outputs']) != incremental_state['outputs']:
+        return 'the outputs were modified since the last incremental run'
+    return None
+
+
+def get_increment_tasks(incremental_state, raw_paths, aggregation_parameters, workers):
+    """
+    Returns the `run_dag` tasks of an incremental run: the new rows of both raw files
+    are cleaned, then merged, then folded into the aggregations while the charts are
+    drawn again from the whole merged data.
+
+    Mergeable aggregations whose partial state was written for the same spec are folded,
+    the others are recomputed from the whole merged data. If no row was appended to the
+    raw files, only the aggregations the last run did not compute run.
+    """
+    appended = any(os.path.getsize(raw_path) > incremental_state['files'][dataset]['offset']
+                   for dataset, raw_path in raw_paths.items())
+
+    # Specs sharing their first group key run together to share factorized keys
+    fold_batches = {}
+    rebuild_batches = {}
+    for spec in aggregation_parameters:
+        output_file = get_output_file(spec['groupby'], spec['agg_params'])
+        mergeable = is_mergeable(spec['agg_params'])
+        current = os.path.exists(output_file) and \
+            incremental_state['aggregations'].get(os.path.basename(output_file)) == get_spec_key(normalize_spec(spec)) and \
+            (not mergeable or os.path.exists(get_state_file(output_file, config.AGGREGATION_STATE_DIR)))
+        if current and mergeable and appended:
+            fold_batches.setdefault(spec['groupby'][0], []).append(spec)
+        elif not current or appended:
+            rebuild_batches.setdefault(spec['groupby'][0], []).append(spec)
+
+    tasks = {}
+    if appended:
+        for dataset, raw_path in raw_paths.items():
+            tasks['clean:' + dataset] = {
+                'func': clean_increment,
+                'args': (raw_path, get_cleaned_paths()[dataset], incremental_state['files'][dataset]['offset'],
+                         get_increment_path(f'{dataset}_increment'), incremental_state['age_counts'].get(dataset))}
+        tasks['merge'] = {'func': merge_increment,
+                          'args': (get_increment_path('expenditure_increment'),
+                                   get_increment_path('demographic_increment'),
+                                   get_increment_path('merged_increment')),
+                          'deps': ['clean:demographic', 'clean:expenditure']}
+
+    for key in list(dict.fromkeys(list(fold_batches) + list(rebuild_batches))):
+        tasks['aggregate:' + key] = {'func': update_aggregations,
+                                     'args': (fold_batches.get(key, []), rebuild_batches.get(key, []),
+                                              get_increment_path('merged_increment'), config.AGGREGATION_STATE_DIR),
+                                     'deps': ['merge'] if appended else []}
+    if appended:
+        tasks['visualize'] = {'func': visualize_data, 'args': (workers,), 'deps': ['merge']}
+    return tasks
+
+
+def record_incremental_state(raw_marks, aggregation_parameters, age_counts=None):
+    """
+    Records the state the next incremental run starts from: the marks of the raw file
+    rows read so far, the age counts of the cleaned rows, the specs of the aggregations
+    and the signatures of the outputs to append to.
 
-def run_pipeline(demographic_file=None, expenditure_file=None, action=None, aggregation_parameters=None):
+    Without `age_counts`, as after a full run, the ages are counted in the cleaned
+    outputs, and the rows the merge left out are written as pending rows.
+    """
+    cleaned_paths = get_cleaned_paths()
+    if age_counts is None:
+        write_unmerged_rows(cleaned_paths['expenditure'], cleaned_paths['demographic'])
+        age_counts = {}
+        for dataset, cleaned_path in cleaned_paths.items():
+            if 'Age' in get_stored_columns(cleaned_path):
+                counts = load_dataframe(cleaned_path, columns=['Age'], compact=False)['Age'].value_counts().sort_index()
+                age_counts[dataset] = {format(age, 'g'): int(count) for age, count in counts.items()}
+
+    aggregations = {}
+    for spec in aggregation_parameters:
+        output_file = get_output_file(spec['groupby'], spec['agg_params'])
+        aggregations[os.path.basename(output_file)] = get_spec_key(normalize_spec(spec))
+
+    save_incremental_state({'fingerprint': get_incremental_fingerprint(),
+                            'files': raw_marks,
+                            'age_counts': age_counts,
+                            'aggregations': aggregations,
+                            'outputs': get_output_signatures(get_incremental_outputs())})
+
+
+def run_pipeline(demographic_file=None, expenditure_file=None, action=None, aggregation_parameters=None, use_cache=None, workers=None, progress=None, profile=None, merge_partitions=None, partition_filters=None, incremental=False):
     """
     Orchestrates the pipeline: cleaning, merging, aggregation and visualization.
 
+    Stages run as a dependency graph: both raw files are cleaned at once, then merged,
+    then the aggregations and charts run in parallel on the merged data.
+
     Parameters
     ----------
 
-    demographic_file : string (default=None)
-        File name of demographic data.
-    expenditure_file : string (default=None)
-        File name of expenditure data.
+    demographic_file : string or list (default=None)
+        File name of demographic data, or a glob pattern or list of file names and patterns
+        whose files are cleaned at once, each file into the partitions of
+        `config.CLEANED_DEMOGRAPHICS_PARTITIONS_PATH`. See `resolve_raw_files`.
+    expenditure_file : string or list (default=None)
+        File name of expenditure data, or a glob pattern or list of them, like `demographic_file`.
     action : string (default=None)
         Stage of pipeline to run. Options > 'clean', 'merge', 'aggregate', 'visualize', 'all'
     aggregation_parameters : list (default=None)
         List of dictionaries with aggregation parameters
+    use_cache : bool (default=None)
+        Skip stages whose inputs and parameters are unchanged since their last run.
+        Defaults to `config.STAGE_CACHE_ENABLED`.
+    workers : int (default=None)
+        Number of processes running independent stages at once. Defaults to `config.PIPELINE_WORKERS`.
+    progress : callable (default=None)
+        Function called with the stage name, its status and the seconds it ran for,
+        whenever a stage changes status. See `run_dag`.
+    profile : bool (default=None)
+        Profile every stage with cProfile. Defaults to `config.METRICS_PROFILE`.
+    merge_partitions : int (default=None)
+        Number of partitions of the merge, 1 to merge in memory. Defaults to `config.MERGE_PARTITIONS`.
+    partition_filters : dict (default=None)
+        Values of the partition columns of the cleaned datasets of batches to merge, e.g.
+        {'State': ['MEGHALAYA'], 'Round': [68]}. Only the matching partitions are read.
+        All partitions are merged if not specified.
+    incremental : bool (default=False)
+        Clean and merge only the rows appended to the raw files since the last incremental
+        run, and fold them into the aggregations through their partial state in
+        `config.AGGREGATION_STATE_DIR`. Needs the action 'all' and one raw file per
+        dataset. The first run, and any run whose raw files or outputs were otherwise
+        changed, runs the full pipeline and records the state the next one starts from.
+        See `get_increment_tasks`.
+
+    Returns
+    -------
+
+    dict
+        Names of the stages skipped ('hits') and run ('misses') under the 'cache' key,
+        the id of the run report under 'run_id', and the files of batches with the
+        partitions they were cleaned into and their timings under 'files'. The report is
+        written to `config.METRICS_DIR` whether the run succeeds or fails.
 
     """
 
-    if demographic_file:
-        RAW_DEMOGRAPHICS_PATH = os.path.join(
-            config.RAW_DATA_DIR, demographic_file)
-    else:
-        RAW_DEMOGRAPHICS_PATH = config.RAW_DEMOGRAPHICS_PATH
-
-    if expenditure_file:
-        RAW_EXPENDITURE_PATH = os.path.join(
-            config.RAW_DATA_DIR, expenditure_file)
-
-    else:
-        RAW_EXPENDITURE_PATH = config.RAW_EXPENDITURE_PATH
-
     action = action or 'all'
 
     aggregation_parameters = aggregation_parameters or [
@@ -67,93 +476,221 @@ def run_pipeline(demographic_file=None, expenditure_file=None, action=None, aggr
         {
             # Count of unmarried people who are adults grouped by State, District, HHID
             'groupby': ['State', 'District_Code', 'HHID', 'Marital_Status'],
-            'agg_params': {"Age": lambda x: x[x >= 18].count()}
+            'agg_params': {"Age": {"count_if": {"gte": 18}}}
         }
     ]
 
-    configure_logger()
-    logger = get_logger(__name__)
-
-    try:
-
-        logger.info("Running pipeline...")
-        print("Running pipeline...")
-
-        if action in ['clean', 'all']:
-
-            # Step 1: Clean data
-            logger.info("Stage: Cleaning data...")
-            print("Stage: Cleaning data...")
-
-            clean_data(RAW_DEMOGRAPHICS_PATH,
-                       config.CLEANED_DEMOGRAPHICS_PATH)
-            clean_data(RAW_EXPENDITURE_PATH,
-                       config.CLEANED_EXPENDITURE_PATH)
+    use_cache = config.STAGE_CACHE_ENABLED if use_cache is None else use_cache
+    workers = workers or config.PIPELINE_WORKERS
 
-            logger.info("Stage: Cleaning data completed")
+    profile = config.METRICS_PROFILE if profile is None else profile
+    merge_partitions = merge_partitions or config.MERGE_PARTITIONS
 
-        if action in ['merge', 'all']:
-
-            # Step 2: Merge data
-            logger.info("Stage: Merging data...")
-            print("Stage: Merging data...")
+    log_file = configure_logger()
+    logger = get_logger(__name__)
 
-            merge_data(config.CLEANED_EXPENDITURE_PATH,
-                       config.CLEANED_DEMOGRAPHICS_PATH)
+    run_id = new_run_id()
+    report = {'run_id': run_id, 'started_at': datetime.now().isoformat(timespec='seconds'),
+              'finished_at': None, 'status': 'running', 'error': None, 'action': action,
+              'workers': workers, 'use_cache': use_cache, 'profile': profile,
+              'merge_partitions': merge_partitions, 'partition_filters': partition_filters,
+              'incremental': incremental, 'log_file': log_file, 'cache': None, 'stages': {}, 'files': []}
+    stage_metrics = {}
 
-            logger.info("Stage: Merging data completed")
+    def track(stage, status, seconds):
+        report['stages'][stage] = {'status': status, 'wall_seconds': seconds}
+        if progress is not None:
+            progress(stage, status, seconds)
 
-        if action in ['aggregate', 'all']:
-            # Step 3: Generate aggregations
-            logger.info("Stage: Generating aggregations...")
-            print("Stage: Generating aggregations....")
+    start_wall, start_cpu = time.perf_counter(), get_cpu_seconds()
+    try:
 
-            for param in aggregation_parameters:
-                aggregate_data(param['groupby'],
-                               param['agg_params'])
+        logger.info("Running pipeline...")
+        print("Running pipeline...")
 
-            logger.info("Stage: Generating aggregations completed")
+        stage_cache = load_stage_cache()
+        cache_report = {'hits': [], 'misses': []}
+        report['cache'] = cache_report
+
+        def run_tasks(tasks):
+            logger.info(f"Running {len(tasks)} tasks on {workers} workers")
+            return run_dag(tasks, workers, initializer=configure_logger,
+                           initargs=(log_file,), progress=track, metrics=stage_metrics,
+                           profile_dir=os.path.join(config.METRICS_DIR, run_id) if profile else None)
+
+        results = None
+        if incremental:
+            # Only the rows appended since the last run are cleaned, merged and aggregated
+            if action != 'all':
+                raise ValueError("Incremental runs need the action 'all'")
+            raw_paths = {}
+            for dataset, raw_file, default_path in [
+                ('demographic', demographic_file, config.RAW_DEMOGRAPHICS_PATH),
+                ('expenditure', expenditure_file, config.RAW_EXPENDITURE_PATH),
+            ]:
+                dataset_paths, batch = resolve_raw_files(raw_file, default_path)
+                if batch:
+                    raise ValueError('Incremental runs take one raw file per dataset, not a batch')
+                raw_paths[dataset] = dataset_paths[0]
+            os.makedirs(config.INCREMENTAL_DIR, exist_ok=True)
+
+            incremental_state = load_incremental_state()
+            reason = check_increment(incremental_state, raw_paths)
+            if reason is None:
+                # Outputs are appended to, so a failed run is followed by a full one
+                for stage in list(stage_cache):
+                    remove_stage(stage_cache, stage)
+                clear_incremental_state()
+                try:
+                    results = run_tasks(get_increment_tasks(
+                        incremental_state, raw_paths, aggregation_parameters, workers))
+                except IncrementConflictError as error:
+                    logger.warning(f"New rows cannot be appended: {error}")
+                    reason = str(error)
+                else:
+                    raw_marks = dict(incremental_state['files'])
+                    age_counts = dict(incremental_state['age_counts'])
+                    for dataset, raw_path in raw_paths.items():
+                        result = results.get('clean:' + dataset)
+                        if result:
+                            raw_marks[dataset] = get_file_marks(raw_path, result['offset'])
+                            age_counts[dataset] = result['age_counts']
+                    record_incremental_state(raw_marks, aggregation_parameters, age_counts)
+
+            if reason is not None:
+                logger.info(f"Running the full pipeline: {reason}")
+                clear_incremental_state()
+                raw_marks = {dataset: get_file_marks(raw_path) for dataset, raw_path in raw_paths.items()}
+
+        if results is None:
+            results = run_tasks(get_pipeline_tasks(
+                stage_cache, cache_report, report, action, demographic_file, expenditure_file,
+                aggregation_parameters, use_cache, workers, merge_partitions, partition_filters,
+                config.AGGREGATION_STATE_DIR if incremental else None))
+            if incremental:
+                record_incremental_state(raw_marks, aggregation_parameters)
+
+        # Files cleaned in this run, not skipped, list their partitions
+        for file_report in report['files']:
+            result = results.get(file_report['stage'])
+            file_report['partitions'] = result['partitions'] if result else None
+
+        logger.info(f"Cache hits: {cache_report['hits']}")
+        logger.info(f"Cache misses: {cache_report['misses']}")
+
+        report['status'] = 'completed'
+        logger.info("Pipeline completed.")
+        print("Pipeline completed!")
 
-        if action in ['visualize', 'all']:
+        # File timings are added when the report is finished
+        return {'cache': cache_report, 'run_id': run_id, 'files': report['files']}
 
-            # Step 4: Generate visualizations
-            logger.info("Stage: Generate visualizations...")
-            print("Stage: Generate visualizations...")
+    except Exception as error:
+        report['status'], report['error'] = 'failed', str(error)
+        log_error(logger, error)
+        raise
 
-            visualize_data()
+    finally:
+        report['wall_seconds'] = round(time.perf_counter() - start_wall, 4)
+        report['cpu_seconds'] = round(get_cpu_seconds() - start_cpu, 4)
+        finish_run_report(report, stage_metrics, logger)
 
-            logger.info("Stage:  Generate visualizations completed")
 
-        logger.info("Pipeline completed.")
-        print("Pipeline completed!")
+def finish_run_report(report, stage_metrics, logger):
+    """
+    Completes a run report with the totals of the run and the metrics of each stage, and writes it.
 
-    except Exception as error:
+    Bytes are summed over the stages, and the peak RSS is the highest of any process.
+    """
+    report['finished_at'] = datetime.now().isoformat(timespec='seconds')
+    for stage, metrics in stage_metrics.items():
+        report['stages'].setdefault(stage, {}).update(metrics)
+        report['stages'][stage].pop('name', None)
+
+    for file_report in report['files']:
+        metrics = report['stages'].get(file_report['stage'], {})
+        file_report.update({key: metrics.get(key) for key in (
+            'status', 'wall_seconds', 'cpu_seconds', 'rows_in', 'rows_out', 'peak_rss_mb')})
+        logger.info(f"File {file_report['file']}: {file_report['status']} in {file_report['wall_seconds']}s, "
+                    f"{file_report['rows_in']} rows in, {file_report['rows_out']} rows out")
+
+    stages = report['stages'].values()
+    report['peak_rss_mb'] = max([round(get_peak_rss_mb(), 2)] +
+                                [stage.get('peak_rss_mb', 0) for stage in stages])
+    report['bytes_read'] = sum(stage.get('bytes_read', 0) for stage in stages)
+    report['bytes_written'] = sum(stage.get('bytes_written', 0) for stage in stages)
+
+    for stage, metrics in report['stages'].items():
+        if 'cpu_seconds' in metrics:
+            logger.info(f"Stage {stage}: {metrics['wall_seconds']}s wall, {metrics['cpu_seconds']}s CPU, "
+                        f"{metrics['rows_in']} rows in, {metrics['rows_out']} rows out, "
+                        f"{metrics['peak_rss_mb']} MB peak RSS")
+    try:
+        logger.info(f'Run report written to {write_run_report(report)}')
+    except OSError as error:
         log_error(logger, error)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run the data pipeline.")
-    parser.add_argument("--demographic_file", type=str,
-                        default=None, help="Path to the demographic data file.")
-    parser.add_argument("--expenditure_file", type=str,
-                        default=None, help="Path to the expenditure data file.")
+    parser.add_argument("--demographic_file", type=str, nargs='+',
+                        default=None, help="Path to the demographic data file, or several files or glob patterns to clean as a batch.")
+    parser.add_argument("--expenditure_file", type=str, nargs='+',
+                        default=None, help="Path to the expenditure data file, or several files or glob patterns to clean as a batch.")
     parser.add_argument("--action", type=str, choices=["clean", "merge", "aggregate", "visualize", "all"],
                         default="all", help="List of action to perform.")
     parser.add_argument("--aggregation_parameters", type=str,
-                        default=None, help="List of dictonaries containing aggregation parameters.")
+                        default=None, help="JSON list of dictonaries containing aggregation parameters.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes running independent stages at once.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Rerun every stage, even if its inputs and parameters are unchanged.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile every stage with cProfile and add the slowest functions to the run report.")
+    parser.add_argument("--merge-partitions", type=int, default=None,
+                        help="Number of partitions of the merge, to bound its memory (default: config.MERGE_PARTITIONS).")
+    parser.add_argument("--partition-filter", action="append", default=None, metavar="COLUMN=VALUE[,VALUE...]",
+                        help="Merge only these partitions of the cleaned batches, e.g. State=MEGHALAYA. Can be repeated.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Clean, merge and aggregate only the rows appended to the raw files since the last incremental run.")
     args = parser.parse_args()
 
+    # A single value keeps its meaning of one file, several values are a batch
     demographic_file = args.demographic_file
+    if demographic_file and len(demographic_file) == 1:
+        demographic_file = demographic_file[0]
     expenditure_file = args.expenditure_file
+    if expenditure_file and len(expenditure_file) == 1:
+        expenditure_file = expenditure_file[0]
+    partition_filters = None
+    if args.partition_filter:
+        partition_filters = {}
+        for partition_filter in args.partition_filter:
+            column, _, values = partition_filter.partition('=')
+            if not column or not values:
+                parser.error(f"Invalid partition filter {partition_filter}, expected COLUMN=VALUE[,VALUE...]")
+            partition_filters.setdefault(column, []).extend(values.split(','))
     action = args.action
     if args.aggregation_parameters:
-        aggregation_parameters = eval(args.aggregation_parameters)
+        aggregation_parameters = json.loads(args.aggregation_parameters)
     else:
         aggregation_parameters = None
 
-    run_pipeline(
-        demographic_file=demographic_file,
-        expenditure_file=expenditure_file,
-        action=action,
-        aggregation_parameters=aggregation_parameters
-    )
+    # This process only runs the pipeline, so each stage may reset its peak RSS
+    enable_peak_rss_reset()
+    try:
+        run_pipeline(
+            demographic_file=demographic_file,
+            expenditure_file=expenditure_file,
+            action=action,
+            aggregation_parameters=aggregation_parameters,
+            use_cache=False if args.no_cache else None,
+            workers=args.workers,
+            profile=args.profile or None,
+            merge_partitions=args.merge_partitions,
+            partition_filters=partition_filters,
+            incremental=args.incremental
+        )
+    except Exception:
+        # The error is already logged with its traceback
+        sys.exit(1)
@@ -0,0 +1,87 @@
+# Registry of compact dtypes of the known NSS columns, applied by load_dataframe and every
+# pipeline stage through `utils.dataframe_utils.apply_schema`.
+#
+# - 'category': low-cardinality strings, stored once per distinct value. Delimited files
+#   read these columns as strings, so codes keep their leading zeros (e.g. '022').
+# - Small ints: codes and counts. A column with nulls or values out of range keeps its dtype,
+#   unless it fits float32 exactly (e.g. Age in the merged data, null for expenditure rows).
+# - 'float32': only applied when every value is exactly representable, such as the whole
+#   rupee values of consumption. Multiplier_comb has two decimals and stays float64.
+COLUMN_DTYPES = {
+    # Identification of the sample household
+    'Round_Centre_Code': 'category',
+    'FSU_Serial_No': 'int32',
+    'Round': 'int16',
+    'Sch_No': 'int16',
+    'Sample': 'category',
+    'Sector': 'category',
+    'State_Region': 'int16',
+    'District': 'int16',
+    'Stratum': 'int16',
+    'Sub_Stratum_No': 'int8',
+    'Filler_1': 'int8',
+    'Sub_Round': 'int8',
+    'Sub_Sample': 'int8',
+    'FOD_Sub_Region': 'int16',
+    'Hamlet_Group_Sub_Block_No': 'int8',
+    'Second_Stage_Stratum_No': 'int8',
+    'Sample_Hhld_No': 'int8',
+    'Level': 'int8',
+    'Filler_2': 'int8',
+    'NSS': 'int16',
+    'NSC': 'int16',
+    'MLT': 'int32',
+    'NSS_SR': 'int16',
+    'NSC_SR': 'int16',
+    'MLT_SR': 'int32',
+    'State': 'category',
+    'District_Code': 'category',
+    'HHID': 'int64',
+    'Multiplier_comb': 'float64',
+
+    # Block 4: demographic particulars of household members
+    'Person_Serial_No': 'int16',
+    'Relation_to_Head': 'category',
+    'Sex': 'category',
+    'Age': 'int8',
+    'Marital_Status': 'category',
+    'General_Education': 'category',
+    'Technical_Education': 'category',
+    'Status_of_Current_Attendance': 'category',
+    'Type_of_Educationa_Institution': 'category',
+    'Registered_with_Emp_Exchange': 'category',
+    'Vocational_Training': 'category',
+    'Field_of_Training': 'category',
+    'MGNREG_jobcard': 'category',
+    'MGNREG_work': 'category',
+
+    # Block 8: household consumer expenditure
+    'Item_Group_Srl_No': 'category',
+    'Value_of_Consumption_Last_30_Day': 'float32',
+    'Value_Consumption_Last_365_Days': 'float32',
+
+    # Merged data
+    'Data_Type': 'category',
+}
+
+# Columns read as strings from delimited files
+STRING_COLUMNS = [col for col, dtype in COLUMN_DTYPES.items()
+                  if dtype == 'category']
+
+# Numeric columns of the registry and their compact dtypes
+NUMERIC_COLUMN_DTYPES = {col: dtype for col, dtype in COLUMN_DTYPES.items()
+                         if dtype != 'category'}
+
+# Numeric columns of raw files that may have blank cells
+NULLABLE_RAW_COLUMNS = ['Age', 'Value_of_Consumption_Last_30_Day', 'Value_Consumption_Last_365_Days']
+
+# Dtypes of the known columns of raw files at parse time, see `load_raw_dataframe`.
+# Strings are read as categories of strings, so codes keep their leading zeros. Integers
+# are read as int64, and numbers that may be blank or fractional as float64, so blank cells
+# parse as NaN. Numbers are cast to their compact dtypes once parsed.
+RAW_COLUMN_DTYPES = {**{col: 'category' for col in STRING_COLUMNS},
+                     **{col: 'int64' if dtype.startswith('int') and col not in NULLABLE_RAW_COLUMNS else 'float64'
+                        for col, dtype in NUMERIC_COLUMN_DTYPES.items()}}
+
+# Cells of raw files read as nulls, on top of the pandas defaults: NSS writes blanks as a single space
+RAW_NA_VALUES = [' ']
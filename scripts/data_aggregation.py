@@ -1,9 +1,49 @@
-from utils.file_utils import write_file, load_dataframe
+from utils.file_utils import write_file, write_stage_output, load_dataframe
+from utils.dataframe_utils import apply_schema, concat_frames
 from utils.logger_utils import get_logger, log_error
-from utils.dataframe_utils import flatten_data
 
 import config
+import json
+import numpy as np
+import operator
 import os
+import pandas as pd
+import time
+
+
+# Pandas functions that aggregation specs can name, e.g. {"Age": "mean"}
+AGGREGATION_FUNCTIONS = ('count', 'size', 'nunique', 'first', 'last', 'any', 'all', 'min', 'max',
+                         'sum', 'mean', 'median', 'prod', 'std', 'var', 'sem', 'skew')
+
+# Pandas functions that only aggregate numbers
+NUMERIC_FUNCTIONS = ('sum', 'mean', 'median', 'prod', 'std', 'var', 'sem', 'skew')
+
+# Operators of declarative aggregation functions, e.g. {"Age": {"count_if": {"gte": 18}}}
+AGGREGATION_OPERATORS = ('count_if', 'sum_if', 'ratio', 'weighted_sum',
+                         'weighted_count', 'weighted_mean', 'weighted_var')
+
+# Operators weighted by a column of survey weights, e.g. {"Age": {"weighted_mean": "Multiplier_comb"}}
+WEIGHTED_OPERATORS = ('weighted_sum', 'weighted_count', 'weighted_mean', 'weighted_var')
+
+# Pandas functions whose results can be folded from the partial state of two sets of rows.
+# Declarative functions can all be folded.
+MERGEABLE_FUNCTIONS = ('count', 'size', 'sum', 'mean', 'min', 'max')
+
+# Suffixes of the partial state columns of means and variances
+STATE_SUM = '__sum'
+STATE_COUNT = '__count'
+STATE_M2 = '__m2'
+
+# Operators of conditions used by 'count_if' and 'sum_if'
+CONDITION_OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'in': lambda series, values: series.isin(values),
+}
 
 
 def aggregate_data(groupby_cols, agg_params, data_type=None):
@@ -19,6 +59,7 @@ def aggregate_data(groupby_cols, agg_params, data_type=None):
     agg_params: dict
         Dictionary of column names and aggregation functions.
         e.g., {'Age': 'mean', 'Value_of_Consumption_Last_30_Day': 'sum'}
+        Functions are pandas function names or declarative specs, see `compile_agg_params`.
 
     data_type: str or None
         Filter data by `Data_Type` column if specified.
@@ -34,29 +75,727 @@ def aggregate_data(groupby_cols, agg_params, data_type=None):
 
     try:
 
-        logger.info("Loading merged tsv data...")
-        df = load_dataframe(config.MERGED_TSV_PATH)
-        logger.info("Merged tsv data loaded")
+        spec = {'groupby': groupby_cols,
+                'agg_params': agg_params, 'data_type': data_type}
 
-        if data_type:
-            df = df[df['Data_Type'] == data_type]
+        logger.info("Loading merged data...")
+        df = load_dataframe(config.MERGED_TABLE_PATH,
+                            columns=get_required_columns([spec]), compact=False)
+        saved_mb = apply_schema(df)
+        logger.info(f"Merged data loaded. Compact dtypes saved {saved_mb:.2f} MB")
 
-        agg_cols = list(agg_params.keys())
-        df = df.dropna(subset=agg_cols, how="all")
+        aggregated_df = compute_aggregation(df, spec, {})
 
-        aggregated_df = df.groupby(groupby_cols).agg(
-            agg_params).round(2).reset_index()
-        for key, val in agg_params.items():
-            aggregated_df.rename(
-                columns={key: key+"_"+str(val)}, inplace=True)
-
-        output_file = os.path.join(config.AGGREGATED_DATA_DIR, ("-".join(
-            [str(col) for col in groupby_cols]) + "-" + "-".join([str(col) for col in agg_cols]) + '.tsv'))
-
-        write_file(aggregated_df, output_file, 'tsv')
+        output_file = get_output_file(groupby_cols, agg_params)
+        write_stage_output(aggregated_df, output_file)
         logger.info(f"Aggregation completed. Output stored at {
                     config.AGGREGATED_DATA_DIR}")
         return aggregated_df
 
     except Exception as error:
         log_error(logger, error)
+        raise
+
+
+def aggregate_all(aggregation_parameters, state_dir=None):
+    """
+    Computes a list of aggregations from a single load of the merged data.
+
+    Only the columns used by the aggregations are loaded. Group keys are factorized
+    once and shared between aggregations, including prefixes of longer keys, so
+    ['State'] and ['State', 'District_Code'] reuse the factorized 'State' column.
+    One output file per aggregation is written, with the same name as `aggregate_data`.
+
+    Parameters
+    ----------
+
+    aggregation_parameters: list
+        List of dictionaries with keys 'groupby', 'agg_params' and optionally 'data_type',
+        as taken by `aggregate_data`.
+
+    state_dir: str (default=None)
+        Folder the partial state of every mergeable aggregation is also written to, for
+        incremental runs to fold new rows into. See `compute_partial_state`.
+
+    Returns
+    -------
+
+    dict
+        Seconds spent on each aggregation, keyed by output file name.
+    """
+
+    logger = get_logger(__name__)
+
+    try:
+
+        logger.info("Loading merged data...")
+        df = load_dataframe(config.MERGED_TABLE_PATH,
+                            columns=get_required_columns(aggregation_parameters), compact=False)
+        saved_mb = apply_schema(df)
+        logger.info(f"Merged data loaded. Compact dtypes saved {saved_mb:.2f} MB")
+
+        key_cache = {}
+        timings = {}
+        for spec in aggregation_parameters:
+            start = time.perf_counter()
+            aggregated_df = compute_aggregation(df, spec, key_cache)
+            output_file = get_output_file(spec['groupby'], spec['agg_params'])
+            write_stage_output(aggregated_df, output_file)
+            if state_dir and is_mergeable(spec['agg_params']):
+                write_partial_state(compute_partial_state(df, spec, key_cache), output_file, state_dir)
+
+            output_name = os.path.basename(output_file)
+            timings[output_name] = round(time.perf_counter() - start, 4)
+            logger.info(
+                f"Aggregation {output_name} completed in {timings[output_name]}s")
+
+        logger.info(f"Aggregations completed. Output stored at {
+                    config.AGGREGATED_DATA_DIR}")
+        return timings
+
+    except Exception as error:
+        log_error(logger, error)
+        raise
+
+
+def update_aggregations(fold_parameters, rebuild_parameters, increment_file, state_dir):
+    """
+    Updates aggregations with the rows appended to the merged data by an incremental run.
+
+    The partial state of each aggregation in `fold_parameters` is computed from the new
+    rows only and folded into the state of the previous runs, so the cost depends on
+    the number of new rows and groups. The other aggregations are recomputed from the
+    whole merged data, see `aggregate_all`.
+
+    Parameters
+    ----------
+
+    fold_parameters: list
+        Mergeable aggregation specs whose partial state is in `state_dir`.
+
+    rebuild_parameters: list
+        Aggregation specs to recompute, e.g. with functions such as 'median' that cannot
+        be folded, or without partial state yet.
+
+    increment_file: str
+        Path of the merged new rows, see `merge_increment`.
+
+    state_dir: str
+        Folder of the partial state of the aggregations.
+
+    Returns
+    -------
+
+    dict
+        Seconds spent on each aggregation, keyed by output file name.
+    """
+
+    logger = get_logger(__name__)
+
+    try:
+
+        timings = {}
+        if fold_parameters:
+            df = load_dataframe(increment_file,
+                                columns=get_required_columns(fold_parameters), compact=False)
+            apply_schema(df)
+            logger.info(f"Folding {len(df)} new rows into {len(fold_parameters)} aggregations")
+
+            key_cache = {}
+            for spec in fold_parameters:
+                start = time.perf_counter()
+                output_file = get_output_file(spec['groupby'], spec['agg_params'])
+                state_df = fold_partial_states(
+                    [load_dataframe(get_state_file(output_file, state_dir)),
+                     compute_partial_state(df, spec, key_cache)], spec)
+                write_stage_output(finalize_partial_state(state_df, spec), output_file)
+                write_partial_state(state_df, output_file, state_dir)
+
+                output_name = os.path.basename(output_file)
+                timings[output_name] = round(time.perf_counter() - start, 4)
+                logger.info(
+                    f"Aggregation {output_name} folded in {timings[output_name]}s")
+
+        if rebuild_parameters:
+            timings.update(aggregate_all(rebuild_parameters, state_dir))
+        return timings
+
+    except Exception as error:
+        log_error(logger, error)
+        raise
+
+
+def compute_aggregation(df, spec, key_cache):
+    """
+    Aggregates a dataframe according to a single aggregation spec.
+
+    Parameters
+    ----------
+
+    df: pd.DataFrame
+        Merged data with at least the columns used by the spec.
+
+    spec: dict
+        Dictionary with keys 'groupby', 'agg_params' and optionally 'data_type'.
+
+    key_cache: dict
+        Factorized group keys shared between calls on the same dataframe.
+
+    Returns
+    -------
+
+    pd.DataFrame
+        Aggregated dataframe, sorted by the group keys.
+    """
+
+    groupby_cols = spec['groupby']
+    agg_params = spec['agg_params']
+    agg_cols = list(agg_params.keys())
+
+    codes, keys_df = get_group_codes(df, groupby_cols, key_cache)
+
+    mask = df[agg_cols].notna().any(axis=1).to_numpy() & (codes >= 0)
+    if spec.get('data_type'):
+        mask &= (df['Data_Type'] == spec['data_type']).to_numpy()
+
+    # Rows are only copied when some are left out
+    all_rows = mask.all()
+    inputs_df, named_aggs, ratios, weighted = compile_agg_params(df if all_rows else df[mask], agg_params)
+    grouped_df = inputs_df.groupby(codes if all_rows else codes[mask]).agg(**named_aggs)
+    for output_col, (numerator, denominator) in ratios.items():
+        grouped_df[output_col] = grouped_df[numerator] / grouped_df[denominator]
+    for output_col, (op, shift) in weighted.items():
+        weight_sum, weighted_sum, squares = get_weighted_sums(grouped_df, output_col, shift)
+        if op == 'weighted_count':
+            grouped_df[output_col] = weight_sum
+        elif op == 'weighted_sum':
+            grouped_df[output_col] = weighted_sum
+        elif op == 'weighted_mean':
+            grouped_df[output_col] = weighted_sum / weight_sum
+        else:
+            grouped_df[output_col] = squares / weight_sum
+    grouped_df = grouped_df[get_output_columns(agg_params)].round(2)
+
+    aggregated_df = pd.concat([keys_df.iloc[grouped_df.index].reset_index(drop=True),
+                               grouped_df.reset_index(drop=True)], axis=1)
+    return aggregated_df
+
+
+def is_mergeable(agg_params):
+    """
+    Returns True if every aggregation function can be folded from partial states, see `get_state_columns`.
+    """
+    return all(isinstance(func, dict) or func in MERGEABLE_FUNCTIONS for func in agg_params.values())
+
+
+def get_state_columns(agg_params):
+    """
+    Returns the partial state columns of mergeable aggregation functions, with how the
+    values of two sets of rows are folded: 'sum', 'min', 'max', or 'm2' for the weighted
+    sum of squared deviations of a weighted variance.
+
+    Means keep the sum and count of their values, ratios the sums of their numerator
+    and denominator, weighted means their weighted sum and sum of weights, and weighted
+    variances also the weighted sum of squared deviations from the group mean.
+    """
+    columns = {}
+    for col, func in agg_params.items():
+        output_col = get_output_column(col, func)
+        op = next(iter(func)) if isinstance(func, dict) else func
+        if op in ('mean', 'weighted_mean', 'weighted_var'):
+            columns[output_col + STATE_SUM] = 'sum'
+            columns[output_col + STATE_COUNT] = 'sum'
+            if op == 'weighted_var':
+                columns[output_col + STATE_M2] = 'm2'
+        elif op == 'weighted_sum':
+            columns[output_col + STATE_SUM] = 'sum'
+        elif op == 'weighted_count':
+            columns[output_col + STATE_COUNT] = 'sum'
+        elif op == 'ratio':
+            columns[output_col + '_numerator'] = 'sum'
+            columns[output_col + '_denominator'] = 'sum'
+        else:
+            columns[output_col] = op if op in ('min', 'max') else 'sum'
+    return columns
+
+
+def compute_partial_state(df, spec, key_cache):
+    """
+    Computes the partial state of a mergeable aggregation: the group keys and, for each
+    group, the columns of `get_state_columns`.
+
+    Partial states of two sets of rows are folded by `fold_partial_states`, and
+    `finalize_partial_state` turns a state into the output of `compute_aggregation`.
+
+    Parameters
+    ----------
+
+    df: pd.DataFrame
+        Merged data with at least the columns used by the spec.
+
+    spec: dict
+        Dictionary with keys 'groupby', 'agg_params' and optionally 'data_type'.
+
+    key_cache: dict
+        Factorized group keys shared between calls on the same dataframe.
+
+    Returns
+    -------
+
+    pd.DataFrame
+        Partial state with a row per group, sorted by the group keys.
+    """
+
+    groupby_cols = spec['groupby']
+    agg_params = spec['agg_params']
+    agg_cols = list(agg_params.keys())
+
+    codes, keys_df = get_group_codes(df, groupby_cols, key_cache)
+
+    mask = df[agg_cols].notna().any(axis=1).to_numpy() & (codes >= 0)
+    if spec.get('data_type'):
+        mask &= (df['Data_Type'] == spec['data_type']).to_numpy()
+
+    # Means are kept as sums and counts, the other functions are their own state
+    all_rows = mask.all()
+    inputs_df, named_aggs, _, weighted = compile_agg_params(df if all_rows else df[mask], agg_params)
+    state_aggs = {}
+    for name, named_agg in named_aggs.items():
+        if named_agg.aggfunc == 'mean':
+            state_aggs[name + STATE_SUM] = pd.NamedAgg(named_agg.column, 'sum')
+            state_aggs[name + STATE_COUNT] = pd.NamedAgg(named_agg.column, 'count')
+        else:
+            state_aggs[name] = named_agg
+    grouped_df = inputs_df.groupby(codes if all_rows else codes[mask]).agg(**state_aggs)
+
+    for output_col, (op, shift) in weighted.items():
+        weight_sum, weighted_sum, squares = get_weighted_sums(grouped_df, output_col, shift)
+        grouped_df[output_col + STATE_COUNT] = weight_sum
+        if weighted_sum is not None:
+            grouped_df[output_col + STATE_SUM] = weighted_sum
+        if squares is not None:
+            grouped_df[output_col + STATE_M2] = squares
+    grouped_df = grouped_df[list(get_state_columns(agg_params))]
+
+    return pd.concat([keys_df.iloc[grouped_df.index].reset_index(drop=True),
+                      grouped_df.reset_index(drop=True)], axis=1)
+
+
+def fold_partial_states(state_dfs, spec):
+    """
+    Folds the partial states of several sets of rows into the partial state of all of them.
+
+    Groups found in any state are kept, and their state columns are summed, or their
+    minimums and maximums kept. The weighted sums of squared deviations of weighted
+    variances are shifted to the mean of the folded group first.
+
+    Returns
+    -------
+
+    pd.DataFrame
+        Partial state with a row per group, sorted by the group keys.
+    """
+    groupby_cols = spec['groupby']
+    state_columns = get_state_columns(spec['agg_params'])
+    state_df = concat_frames([df for df in state_dfs if len(df)] or state_dfs[:1])
+
+    codes, keys_df = get_group_codes(state_df, groupby_cols, {})
+    folded_df = state_df[list(state_columns)].groupby(codes).agg(
+        {col: 'sum' if rule == 'm2' else rule for col, rule in state_columns.items()})
+
+    for col, rule in state_columns.items():
+        if rule != 'm2':
+            continue
+        output_col = col[:-len(STATE_M2)]
+        counts = state_df[output_col + STATE_COUNT].to_numpy(dtype=np.float64)
+        sums = state_df[output_col + STATE_SUM].to_numpy(dtype=np.float64)
+        folded_counts = np.bincount(codes, weights=counts, minlength=len(keys_df))
+        folded_sums = np.bincount(codes, weights=sums, minlength=len(keys_df))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            deviations = np.where(counts > 0, sums / counts - (folded_sums / folded_counts)[codes], 0.0)
+        m2 = state_df[col].to_numpy(dtype=np.float64) + counts * deviations ** 2
+        folded_df[col] = np.bincount(codes, weights=m2, minlength=len(keys_df))[folded_df.index]
+
+    return pd.concat([keys_df.iloc[folded_df.index].reset_index(drop=True),
+                      folded_df.reset_index(drop=True)], axis=1)
+
+
+def finalize_partial_state(state_df, spec):
+    """
+    Returns the aggregated dataframe of a partial state, as `compute_aggregation` computes it from the rows.
+    """
+    groupby_cols = spec['groupby']
+    outputs = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for col, func in spec['agg_params'].items():
+            output_col = get_output_column(col, func)
+            op = next(iter(func)) if isinstance(func, dict) else func
+            if op in ('mean', 'weighted_mean'):
+                outputs[output_col] = state_df[output_col + STATE_SUM] / state_df[output_col + STATE_COUNT]
+            elif op == 'weighted_var':
+                outputs[output_col] = (state_df[output_col + STATE_M2] /
+                                       state_df[output_col + STATE_COUNT]).clip(lower=0)
+            elif op == 'weighted_sum':
+                outputs[output_col] = state_df[output_col + STATE_SUM]
+            elif op == 'weighted_count':
+                outputs[output_col] = state_df[output_col + STATE_COUNT]
+            elif op == 'ratio':
+                outputs[output_col] = state_df[output_col + '_numerator'] / state_df[output_col + '_denominator']
+            else:
+                outputs[output_col] = state_df[output_col]
+    return pd.concat([state_df[groupby_cols], pd.DataFrame(outputs).round(2)], axis=1)
+
+
+def get_state_file(output_file, state_dir):
+    """
+    Returns the path of the partial state of an aggregation, named after its output file.
+    """
+    return os.path.join(state_dir, os.path.basename(output_file))
+
+
+def write_partial_state(state_df, output_file, state_dir):
+    """
+    Writes the partial state of an aggregation to `state_dir`, see `compute_partial_state`.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    state_file = get_state_file(output_file, state_dir)
+    write_file(state_df, state_file, os.path.splitext(state_file)[1][1:])
+
+
+def compile_agg_params(df, agg_params):
+    """
+    Compiles aggregation functions into vectorized column operations followed by
+    built-in pandas aggregations, so no aggregation calls back into Python per group.
+
+    Functions are either pandas function names (e.g. 'mean', 'count') or declarative specs:
+
+    - {"count_if": condition}: number of non-null values meeting the condition.
+    - {"sum_if": condition}: sum of the values meeting the condition.
+    - {"ratio": column}: sum of the values divided by the sum of `column`, over rows where both are present.
+    - {"weighted_sum": column}, {"weighted_count": column}, {"weighted_mean": column} and
+      {"weighted_var": column}: total, sum of weights, mean and population variance of the
+      values weighted by the survey weights in `column`, over rows where both are present.
+
+    Weighted functions are compiled into sums of the weights, of the weighted values and of
+    the weighted squared values, finished by `get_weighted_sums`. Values of means and
+    variances are shifted by their mean first, so the variance does not lose precision to
+    cancellation.
+
+    A condition is a dictionary of operators ('eq', 'ne', 'gt', 'gte', 'lt', 'lte', 'in') and
+    values, all of which must hold, e.g. {"gte": 18}. It applies to the aggregated column,
+    unless another one is named under the 'column' key, e.g. {"column": "Sector", "eq": "Rural"}.
+
+    Parameters
+    ----------
+
+    df: pd.DataFrame
+        Rows to aggregate.
+
+    agg_params: dict
+        Dictionary of column names and aggregation functions.
+
+    Returns
+    -------
+
+    tuple
+        Dataframe of input columns to group, named aggregations for `DataFrameGroupBy.agg`,
+        a dictionary of ratio outputs to their (numerator, denominator) named aggregations,
+        and a dictionary of weighted outputs to their operator and the shift of their values.
+
+    Raises
+    ------
+
+    ValueError
+        If an aggregation function is not a supported name or a valid declarative spec, or
+        aggregates numbers of a column that is not numeric.
+    """
+
+    inputs = {}
+    named_aggs = {}
+    ratios = {}
+    weighted = {}
+    float_values = {}
+    for col, func in agg_params.items():
+        output_col = get_output_column(col, func)
+        if isinstance(func, str):
+            if func in NUMERIC_FUNCTIONS:
+                check_numeric(df[col], func)
+            inputs[col] = df[col]
+            named_aggs[output_col] = pd.NamedAgg(col, func)
+            continue
+
+        op, argument = next(iter(func.items()))
+        values = df[col]
+        if op != 'count_if':
+            check_numeric(values, op)
+        if op == 'ratio' or op in WEIGHTED_OPERATORS:
+            check_numeric(df[argument], op)
+        if op == 'count_if':
+            inputs[output_col] = (evaluate_condition(df, col, argument) &
+                                  values.notna()).astype(np.int64)
+            named_aggs[output_col] = pd.NamedAgg(output_col, 'sum')
+        elif op == 'sum_if':
+            inputs[output_col] = values.where(
+                evaluate_condition(df, col, argument))
+            named_aggs[output_col] = pd.NamedAgg(output_col, 'sum')
+        elif op == 'ratio':
+            other = df[argument]
+            both = values.notna() & other.notna()
+            numerator, denominator = values.where(both), other.where(both)
+            inputs[output_col + '_numerator'] = numerator
+            inputs[output_col + '_denominator'] = denominator
+            named_aggs[output_col + '_numerator'] = pd.NamedAgg(
+                output_col + '_numerator', 'sum')
+            named_aggs[output_col + '_denominator'] = pd.NamedAgg(
+                output_col + '_denominator', 'sum')
+            ratios[output_col] = (output_col + '_numerator',
+                                  output_col + '_denominator')
+        elif op in WEIGHTED_OPERATORS:
+            # Columns shared by several functions, such as the weights, are converted once
+            for value_col in (col, argument):
+                if value_col not in float_values:
+                    float_values[value_col] = get_float_values(df[value_col])
+            values, weights = float_values[col], float_values[argument]
+            both = ~(np.isnan(values) | np.isnan(weights))
+            if not both.all():
+                weights = np.where(both, weights, np.nan)
+            shift = values[both].mean() if op in ('weighted_mean', 'weighted_var') and both.any() else 0.0
+            sums = {output_col + '_weights': weights}
+            if op != 'weighted_count':
+                shifted = values - shift
+                sums[output_col + '_weighted'] = weights * shifted
+                if op == 'weighted_var':
+                    sums[output_col + '_weighted_squares'] = weights * shifted * shifted
+            for name, sum_values in sums.items():
+                inputs[name] = sum_values
+                named_aggs[name] = pd.NamedAgg(name, 'sum')
+            weighted[output_col] = (op, shift)
+
+    # Compact float32 columns are summed in float64, like the values they were cast from
+    inputs_df = pd.DataFrame(inputs, index=df.index)
+    inputs_df = inputs_df.astype({col: np.float64 for col in inputs_df.columns
+                                  if inputs_df[col].dtype == np.float32})
+    return inputs_df, named_aggs, ratios, weighted
+
+
+def get_weighted_sums(grouped_df, output_col, shift):
+    """
+    Returns the sums of a weighted function for each group, from the grouped inputs
+    compiled by `compile_agg_params`: the sum of the weights, the weighted sum of the
+    values, and the weighted sum of their squared deviations from the group mean.
+    Sums the function does not need are None.
+    """
+    weight_sum = grouped_df[output_col + '_weights']
+    if output_col + '_weighted' not in grouped_df:
+        return weight_sum, None, None
+    shifted_sum = grouped_df[output_col + '_weighted']
+    squares = None
+    if output_col + '_weighted_squares' in grouped_df:
+        # Groups without weight have no deviation
+        squares = (grouped_df[output_col + '_weighted_squares'] -
+                   shifted_sum ** 2 / weight_sum).fillna(0).clip(lower=0)
+    return weight_sum, shifted_sum + shift * weight_sum, squares
+
+
+def get_float_values(series):
+    """
+    Returns the values of a numeric column as a float64 array, NaN where null.
+    """
+    return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def check_numeric(series, func):
+    """
+    Raises a ValueError if an aggregation function that only aggregates numbers is given a
+    column that is not numeric. Categories of numbers are numeric.
+    """
+    if not pd.api.types.is_numeric_dtype(series.dtype) and not (
+            isinstance(series.dtype, pd.CategoricalDtype)
+            and pd.api.types.is_numeric_dtype(series.cat.categories.dtype)):
+        raise ValueError(f"Aggregation '{func}' needs a numeric column, {series.name} is {series.dtype}")
+
+
+def evaluate_condition(df, col, condition):
+    """
+    Returns a boolean series of the rows of `df` that meet a declarative condition.
+    """
+    condition = dict(condition)
+    target = df[condition.pop('column', col)]
+    result = pd.Series(True, index=df.index)
+    for op, value in condition.items():
+        if op not in CONDITION_OPERATORS:
+            raise ValueError(
+                f'Invalid condition operator {op}. Allowed operators are {list(CONDITION_OPERATORS)}')
+        result &= CONDITION_OPERATORS[op](target, value).fillna(False)
+    return result
+
+
+def get_output_column(col, func):
+    """
+    Returns the output column name of an aggregation function, e.g. 'Age_mean' or 'Age_count_if'.
+
+    Raises
+    ------
+
+    ValueError
+        If the aggregation function is not a supported name or a valid declarative spec.
+    """
+    if isinstance(func, str):
+        if func not in AGGREGATION_FUNCTIONS:
+            raise ValueError(f"Unknown aggregation '{func}' for column {col}. "
+                             f'Allowed functions are {list(AGGREGATION_FUNCTIONS)}')
+        return col + "_" + func
+    if not isinstance(func, dict) or len(func) != 1:
+        raise ValueError(
+            f'Invalid aggregation function {func!r} for column {col}. Use one of the functions '
+            f'{list(AGGREGATION_FUNCTIONS)} or a dictionary with one of the operators {list(AGGREGATION_OPERATORS)}')
+    op, argument = next(iter(func.items()))
+    if op not in AGGREGATION_OPERATORS:
+        raise ValueError(f"Unknown aggregation '{op}' for column {col}. "
+                         f'Allowed operators are {list(AGGREGATION_OPERATORS)}')
+    if op in ('count_if', 'sum_if'):
+        check_condition(col, op, argument)
+    elif not isinstance(argument, str):
+        raise ValueError(f"Aggregation '{op}' for column {col} needs a column name, got {argument!r}")
+    return col + "_" + op
+
+
+def check_condition(col, op, condition):
+    """
+    Raises a ValueError if the condition of a 'count_if' or 'sum_if' function is not valid,
+    see `evaluate_condition`.
+    """
+    if not isinstance(condition, dict) or not condition:
+        raise ValueError(f"Aggregation '{op}' for column {col} needs a condition, got {condition!r}")
+    for condition_op, value in condition.items():
+        if condition_op == 'column':
+            if not isinstance(value, str):
+                raise ValueError(f"Condition column of '{op}' for column {col} must be a column name")
+        elif condition_op not in CONDITION_OPERATORS:
+            raise ValueError(
+                f'Invalid condition operator {condition_op} of {op!r} for column {col}. '
+                f'Allowed operators are {list(CONDITION_OPERATORS)}')
+        elif condition_op == 'in' and not isinstance(value, list):
+            raise ValueError(f"Condition 'in' of '{op}' for column {col} needs a list of values")
+
+
+def get_output_columns(agg_params):
+    """
+    Returns the output column names of all aggregation functions, in order.
+    """
+    return [get_output_column(col, func) for col, func in agg_params.items()]
+
+
+def get_group_codes(df, groupby_cols, key_cache):
+    """
+    Factorizes group key columns into integer codes, reusing the codes of key prefixes.
+
+    Returns
+    -------
+
+    tuple
+        Array with the group code of each row (-1 where a key is null) and a dataframe
+        with the key values of each code, in sorted key order.
+    """
+
+    cache_key = tuple(groupby_cols)
+    if cache_key in key_cache:
+        return key_cache[cache_key]
+
+    if len(groupby_cols) == 1:
+        col = groupby_cols[0]
+        codes, uniques = pd.factorize(df[col], sort=True)
+        keys_df = pd.DataFrame({col: uniques})
+    else:
+        prefix_codes, prefix_keys_df = get_group_codes(
+            df, groupby_cols[:-1], key_cache)
+        last_codes, last_keys_df = get_group_codes(
+            df, groupby_cols[-1:], key_cache)
+
+        # Combined codes keep the lexicographic order of (prefix, last)
+        valid = (prefix_codes >= 0) & (last_codes >= 0)
+        combined = prefix_codes[valid].astype(
+            np.int64) * len(last_keys_df) + last_codes[valid]
+        valid_codes, uniques = pd.factorize(combined, sort=True)
+        codes = np.full(len(df), -1, dtype=np.intp)
+        codes[valid] = valid_codes
+
+        keys_df = prefix_keys_df.iloc[uniques //
+                                      len(last_keys_df)].reset_index(drop=True)
+        keys_df[groupby_cols[-1]] = last_keys_df.iloc[uniques % len(last_keys_df), 0].to_numpy()
+
+    key_cache[cache_key] = (codes, keys_df)
+    return codes, keys_df
+
+
+def get_required_columns(aggregation_parameters):
+    """
+    Returns the merged data columns used by a list of aggregation specs.
+    """
+    columns = []
+    for spec in aggregation_parameters:
+        columns += spec['groupby'] + list(spec['agg_params'].keys())
+        for col, func in spec['agg_params'].items():
+            op, argument = next(iter(func.items())) if isinstance(
+                func, dict) else (func, None)
+            if op in ('count_if', 'sum_if') and 'column' in argument:
+                columns.append(argument['column'])
+            elif op == 'ratio' or op in WEIGHTED_OPERATORS:
+                columns.append(argument)
+        if spec.get('data_type'):
+            columns.append('Data_Type')
+    return list(dict.fromkeys(columns))
+
+
+def normalize_spec(spec):
+    """
+    Validates an aggregation spec and returns it with every key set.
+
+    Parameters
+    ----------
+
+    spec: dict
+        Dictionary with keys 'groupby', 'agg_params' and optionally 'data_type'.
+
+    Returns
+    -------
+
+    dict
+        The spec with keys 'groupby', 'agg_params' and 'data_type' (None if not specified).
+
+    Raises
+    ------
+
+    ValueError
+        If a key is missing or has the wrong type, or an aggregation function is invalid.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('Aggregation spec must be a dictionary')
+    groupby_cols = spec.get('groupby')
+    agg_params = spec.get('agg_params')
+    data_type = spec.get('data_type')
+    if not isinstance(groupby_cols, list) or not groupby_cols or \
+            not all(isinstance(col, str) for col in groupby_cols):
+        raise ValueError("'groupby' must be a non-empty list of column names")
+    if not isinstance(agg_params, dict) or not agg_params:
+        raise ValueError("'agg_params' must be a non-empty dictionary of columns and functions")
+    if data_type is not None and not isinstance(data_type, str):
+        raise ValueError("'data_type' must be a string")
+    get_output_columns(agg_params)
+    return {'groupby': groupby_cols, 'agg_params': agg_params, 'data_type': data_type}
+
+
+def get_spec_key(spec):
+    """
+    Returns a string identifying the result of a normalized aggregation spec.
+    Specs listing the same functions in another order have the same key.
+    """
+    return json.dumps(spec, sort_keys=True)
+
+
+def get_output_file(groupby_cols, agg_params):
+    """
+    Returns the path of the output file of an aggregation.
+    """
+    return os.path.join(config.AGGREGATED_DATA_DIR, ("-".join(
+        [str(col) for col in groupby_cols]) + "-" + "-".join([str(col) for col in agg_params.keys()]) + '.' + config.INTERMEDIATE_FORMAT))
@@ -1,10 +1,15 @@
+from collections import Counter
+import numpy as np
+import os
 import pandas as pd
+import config
 from utils.logger_utils import get_logger, log_error
-from utils.file_utils import load_dataframe, write_file
+from utils.file_utils import load_raw_dataframe, load_raw_increment, iter_raw_dataframe, estimate_chunk_rows, get_part_file, get_stored_columns, remove_partition_parts, write_file, write_partitioned, write_stage_output
 from utils.dataframe_utils import *
+from utils.incremental_utils import IncrementConflictError
 
 
-def clean_data(input_file, output_file, critical_columns=None, category_columns=None, numeric_columns=None, irrelevant_columns=None):
+def clean_data(input_file, output_file, critical_columns=None, category_columns=None, numeric_columns=None, irrelevant_columns=None, streaming=None, max_memory_mb=None, partition_by=None):
     """
     Cleans data file and exports it.
 
@@ -13,7 +18,8 @@ def clean_data(input_file, output_file, critical_columns=None, category_columns=
     input_file : string
         The path of the file to be cleaned.
     output_file : string
-        The path to store the cleaned data file.
+        The path to store the cleaned data file, or the partitioned dataset the cleaned
+        rows are added to with `partition_by`.
     critical_columns : list (default=None)
         List of columns whose values called be null.
     category_columns : list (default=None)
@@ -21,7 +27,24 @@ def clean_data(input_file, output_file, critical_columns=None, category_columns=
     numeric_columns : list (default=None)
         List of columns that have numerical values.
     irrelevant_columns : list (default=None)
-        List of columns that have irrelevant values.
+        List of columns that have irrelevant values. They are not read from the input file.
+    streaming : bool (default=None)
+        Clean the file in bounded chunks instead of loading it whole.
+        Defaults to `config.CLEANING_STREAMING`.
+    max_memory_mb : int (default=None)
+        Memory budget for one chunk in streaming mode.
+        Defaults to `config.CLEANING_MAX_MEMORY_MB`.
+    partition_by : list (default=None)
+        Columns the cleaned rows are partitioned by, e.g. ['State', 'Round']. The rows are
+        written to one part per partition, named after the input file, replacing the parts
+        of a previous clean of that file. Columns without data in the file are kept, so
+        the parts of every file have the same columns. See `write_partitioned`.
+
+    Returns
+    -------
+    dict
+        The input file, the number of cleaned rows, the rows written to each partition
+        and the paths written ('outputs').
 
     """
 
@@ -37,38 +60,358 @@ def clean_data(input_file, output_file, critical_columns=None, category_columns=
                                           'Value_of_Consumption_Last_30_Day']
     irrelevant_columns = irrelevant_columns or [
         'Blank', 'Spl_characters_for_OK_stamp']
+    streaming = config.CLEANING_STREAMING if streaming is None else streaming
+    max_memory_mb = max_memory_mb or config.CLEANING_MAX_MEMORY_MB
 
     try:
+        if partition_by:
+            # Other files of the batch may be writing to the dataset
+            remove_partition_parts(output_file, part_names=[get_part_name(input_file)], remove_empty=False)
+
+        if streaming:
+            return clean_data_streaming(input_file, output_file, critical_columns, category_columns,
+                                        numeric_columns, irrelevant_columns, max_memory_mb, partition_by)
+
         # load data
         logger.info(f'Loading input file: {input_file}')
-        input_df = load_dataframe(input_file)
+        input_df = load_raw_input(input_file, irrelevant_columns)
         logger.info(f'File loading completed: {input_file}')
 
         # Methods for general cleaning
-        input_df = strip_strings(input_df)
-        drop_columns(input_df, irrelevant_columns)
-        drop_empty_columns(input_df)
-        drop_na_from_columns(input_df, critical_columns, how='any')
-        fill_na_with_unknown(input_df, category_columns)
+        # Parts of a dataset keep the columns that are empty in their file, so all parts share their columns
+        input_df = prepare_frame(
+            input_df, critical_columns, category_columns, irrelevant_columns,
+            [] if partition_by else None)
         input_df.drop_duplicates(inplace=True)
-        format_numeric_columns(input_df)
-        input_df = capitalize_strings(input_df, category_columns)
+        input_df = format_frame(input_df, category_columns, numeric_columns)
 
         # Methods specific to demographic and expenditure datasets
-        format_numeric_columns(
-            input_df, numeric_columns=numeric_columns, decimal_places=0)
-
-        replace_not_known_with_unknown(
-            input_df, ['Type_of_Educationa_Institution'])
-        fill_na_with_imputation(input_df, ['Age'], 'median')
-        drop_na_from_columns(input_df, [
-                             'Value_of_Consumption_Last_30_Day', 'Value_of_Consumption_Last_30_Day'], how='all')
-        compute_monthly_yearly_expenditure(input_df)
+        finish_frame(input_df)
+        sort_categories(input_df)
+        saved_mb = apply_schema(input_df)
+        logger.info(f'Compact dtypes saved {saved_mb:.2f} MB: {output_file}')
 
         # export data
-        write_file(input_df, output_file, 'tsv')
+        partitions = write_cleaned_output(input_df, output_file, input_file, partition_by)
         logger.info(
             f'File cleaned and output stored in {output_file}')
+        return get_clean_result(input_file, output_file, len(input_df), partitions, partition_by)
+
+    except Exception as error:
+        log_error(logger, error)
+        raise
+
+
+def load_raw_input(input_file, irrelevant_columns):
+    """
+    Loads a raw file typed while parsing, see `load_raw_dataframe`. Dtypes are inferred
+    instead if a numeric cell of the file is not a number.
+    """
+    try:
+        return load_raw_dataframe(input_file, exclude_columns=irrelevant_columns)
+    except ValueError as error:
+        get_logger(__name__).warning(
+            f'Inferring dtypes of {input_file}, a numeric cell is not a number: {error}')
+        return load_raw_dataframe(input_file, exclude_columns=irrelevant_columns, typed=False)
+
+
+def clean_increment(input_file, output_file, offset, increment_file, age_counts=None, critical_columns=None, category_columns=None, numeric_columns=None, irrelevant_columns=None):
+    """
+    Cleans the rows appended to a raw file since a previous clean and appends them to its output.
+
+    The rows are cleaned as by `clean_data`, with the columns of the existing output:
+    columns the output dropped as empty stay dropped, and columns without data in the
+    new rows are kept as nulls. Duplicates are dropped within the new rows, and missing
+    ages are filled with the median age of all rows cleaned so far, from `age_counts`.
+
+    Parameters
+    ----------
+    input_file : string
+        The path of the raw file.
+    output_file : string
+        The path of the cleaned data file the new rows are appended to.
+    offset : int
+        Byte offset of the first new row, see `load_raw_increment`.
+    increment_file : string
+        The path the cleaned new rows are also written to, for the incremental merge.
+    age_counts : dict (default=None)
+        Number of rows of each age cleaned so far, keyed by the age as a string.
+    critical_columns, category_columns, numeric_columns, irrelevant_columns : list
+        Same as for `clean_data`.
+
+    Returns
+    -------
+    dict
+        The input file, the number of cleaned rows, the byte offset after the rows read
+        ('offset') and the updated age counts ('age_counts').
+
+    Raises
+    ------
+    IncrementConflictError
+        If the new rows have data in a column the output dropped as empty, or values
+        that do not fit the dtypes of the output.
+
+    """
 
+    logger = get_logger(__name__)
+    logger.info(f'Cleaning rows of {input_file} from byte {offset}')
+
+    # Same defaults as `clean_data`
+    critical_columns = critical_columns or ['HHID']
+    category_columns = category_columns or ['Status_of_Current_Attendance', 'Type_of_Educationa_Institution',
+                                            'Registered_with_Emp_Exchange', 'Vocational_Training', 'Field_of_Training',
+                                            'MGNREG_jobcard', 'MGNREG_work', 'General_Education']
+    numeric_columns = numeric_columns or ['Age', 'Value_of_Consumption_Last_30_Day',
+                                          'Value_of_Consumption_Last_30_Day']
+    irrelevant_columns = irrelevant_columns or [
+        'Blank', 'Spl_characters_for_OK_stamp']
+
+    try:
+        try:
+            input_df, end_offset = load_raw_increment(input_file, offset, exclude_columns=irrelevant_columns)
+        except ValueError as error:
+            logger.warning(f'Inferring dtypes of new rows of {input_file}, a numeric cell is not a number: {error}')
+            input_df, end_offset = load_raw_increment(input_file, offset, exclude_columns=irrelevant_columns,
+                                                      typed=False)
+
+        output_columns = get_stored_columns(output_file)
+        input_df = prepare_frame(input_df, critical_columns, category_columns, irrelevant_columns, [])
+        dropped_columns = [col for col in input_df.columns if col not in output_columns]
+        filled_columns = [col for col in dropped_columns if input_df[col].notna().any()]
+        if filled_columns:
+            raise IncrementConflictError(
+                f'New rows of {input_file} have data in columns {filled_columns} that are empty in {output_file}')
+        drop_columns(input_df, dropped_columns)
+        input_df.drop_duplicates(inplace=True)
+        input_df = format_frame(input_df, category_columns, numeric_columns)
+
+        age_counts = pd.Series(age_counts or {}, dtype=float)
+        age_counts.index = age_counts.index.astype(float)
+        if 'Age' in input_df.columns:
+            age_counts = age_counts.add(input_df['Age'].value_counts(), fill_value=0)
+        finish_frame(input_df, np.round(median_from_counts(age_counts), 0) if len(age_counts) else None)
+        sort_categories(input_df)
+        apply_schema(input_df)
+
+        # Columns without data in the new rows are null
+        input_df = input_df.reindex(columns=output_columns)
+        try:
+            write_stage_output(input_df, output_file, append=True)
+        except ValueError as error:
+            raise IncrementConflictError(f'New rows of {input_file} do not fit {output_file}: {error}') from error
+        write_file(input_df, increment_file, os.path.splitext(increment_file)[1][1:])
+
+        logger.info(f'{len(input_df)} new rows cleaned and appended to {output_file}')
+        return {'file': input_file, 'rows': len(input_df), 'offset': end_offset,
+                'age_counts': {format(age, 'g'): int(count) for age, count in age_counts.sort_index().items()}}
+
+    except IncrementConflictError:
+        # The pipeline runs in full instead
+        raise
     except Exception as error:
         log_error(logger, error)
+        raise
+
+
+def clean_data_partitioned(input_file, output_dir, partition_by):
+    """
+    Cleans one file of a batch into the partitions of a cleaned dataset, see `clean_data`.
+    """
+    return clean_data(input_file, output_dir, partition_by=partition_by)
+
+
+def clean_data_streaming(input_file, output_file, critical_columns, category_columns, numeric_columns, irrelevant_columns, max_memory_mb, partition_by=None):
+    """
+    Cleans data file chunk by chunk, appending each cleaned chunk to the output file.
+
+    The output matches the in-memory path of `clean_data`. Steps that need the
+    whole file are resolved with extra passes over the input:
+
+    1. A schema pass fixes one dtype per column and finds columns that are empty in the whole file.
+    2. If 'Age' survives cleaning, a statistics pass computes its median over the
+       deduplicated rows from a value -> count histogram.
+    3. The final pass cleans every chunk, drops duplicates across chunks and writes it.
+
+    Numeric columns are parsed with the compact dtype the schema pass found for the whole
+    file. Chunks are written without the category dtypes of the schema registry, since
+    the categories of one chunk may not fit the next. `load_dataframe` applies them
+    when the output is read.
+
+    Parameters
+    ----------
+    input_file : string
+        The path of the file to be cleaned.
+    output_file : string
+        The path to store the cleaned data file.
+    critical_columns, category_columns, numeric_columns, irrelevant_columns : list
+        Same as for `clean_data`.
+    max_memory_mb : int
+        Memory budget for one chunk.
+    partition_by : list (default=None)
+        Same as for `clean_data`.
+
+    Returns
+    -------
+    dict
+        Same as for `clean_data`.
+
+    """
+
+    logger = get_logger(__name__)
+
+    chunk_rows = estimate_chunk_rows(input_file, max_memory_mb)
+    logger.info(
+        f'Streaming clean of {input_file} in chunks of {chunk_rows} rows')
+
+    typed = True
+    try:
+        dtypes, empty_columns = scan_schema(input_file, chunk_rows, irrelevant_columns)
+    except ValueError as error:
+        logger.warning(f'Inferring dtypes of {input_file}, a numeric cell is not a number: {error}')
+        typed = False
+        dtypes, empty_columns = scan_schema(input_file, chunk_rows, irrelevant_columns, typed)
+    if partition_by:
+        empty_columns = []
+    logger.info(f'Schema pass completed: {input_file}')
+
+    def cleaned_chunks():
+        seen_hashes = []
+        for chunk in iter_raw_dataframe(input_file, chunk_rows, dtype=dtypes,
+                                        exclude_columns=irrelevant_columns, typed=typed):
+            chunk = prepare_frame(chunk, critical_columns, category_columns,
+                                  irrelevant_columns, empty_columns)
+            chunk, seen_hashes = drop_duplicates_across_chunks(
+                chunk, seen_hashes)
+            yield format_frame(chunk, category_columns, numeric_columns)
+
+    age_median = None
+    if 'Age' in dtypes and 'Age' not in irrelevant_columns + empty_columns:
+        age_counts = pd.Series(dtype=float)
+        for chunk in cleaned_chunks():
+            age_counts = age_counts.add(
+                chunk['Age'].value_counts(), fill_value=0)
+        age_median = np.round(median_from_counts(age_counts), 0)
+        logger.info(f'Statistics pass completed: {input_file}')
+
+    header_written = False
+    rows = 0
+    partitions = Counter()
+    for chunk in cleaned_chunks():
+        finish_frame(chunk, age_median)
+        partitions.update(write_cleaned_output(
+            chunk, output_file, input_file, partition_by, append=header_written))
+        header_written = True
+        rows += len(chunk)
+
+    logger.info(f'File cleaned and output stored in {output_file}')
+    return get_clean_result(input_file, output_file, rows, dict(partitions), partition_by)
+
+
+def write_cleaned_output(df, output_file, input_file, partition_by=None, append=False):
+    """
+    Writes cleaned rows to the output file, or to the partitions of the output dataset
+    in parts named after the input file.
+
+    Returns
+    -------
+    dict
+        Rows written to each partition, empty without `partition_by`.
+    """
+    if not partition_by:
+        write_stage_output(df, output_file, append=append)
+        return {}
+    return write_partitioned(df, output_file, partition_by, get_part_name(input_file), append=append)
+
+
+def get_clean_result(input_file, output_file, rows, partitions, partition_by=None):
+    """
+    Returns the result of a clean, see `clean_data`.
+    """
+    if partition_by:
+        outputs = [get_part_file(os.path.join(output_file, partition), get_part_name(input_file))
+                   for partition in sorted(partitions)]
+    else:
+        outputs = [output_file]
+    return {'file': input_file, 'rows': rows, 'partitions': partitions, 'outputs': outputs}
+
+
+def get_part_name(input_file):
+    """
+    Returns the name of the parts of the cleaned rows of a raw file: its file name without extension.
+    """
+    return os.path.splitext(os.path.basename(input_file))[0]
+
+
+def scan_schema(input_file, chunk_rows, irrelevant_columns=None, typed=True):
+    """
+    Reads the file once to find a dtype for each column that is valid for every chunk,
+    and the columns that contain no data in any chunk. Chunks are read as by
+    `iter_raw_dataframe`, so a numeric column keeps its compact dtype if it fits every chunk.
+
+    Returns
+    -------
+    tuple
+        Dictionary of column dtypes and list of empty columns.
+    """
+    chunk_dtypes = {}
+    has_data = {}
+    for chunk in iter_raw_dataframe(input_file, chunk_rows, exclude_columns=irrelevant_columns, typed=typed):
+        for col in chunk.columns:
+            # Categories differ between chunks, strings are parsed as objects by the later passes
+            chunk_dtypes.setdefault(col, set()).add(
+                np.dtype(object) if isinstance(chunk[col].dtype, pd.CategoricalDtype) else chunk[col].dtype)
+        # Blank strings only become nulls after normalization
+        chunk_has_data = normalize_strings(chunk).notna().any()
+        for col in chunk.columns:
+            has_data[col] = has_data.get(col, False) or chunk_has_data[col]
+
+    dtypes = {}
+    for col, col_dtypes in chunk_dtypes.items():
+        if len(col_dtypes) == 1:
+            dtypes[col] = col_dtypes.pop()
+        elif all(pd.api.types.is_numeric_dtype(dtype) for dtype in col_dtypes):
+            dtypes[col] = np.result_type(*col_dtypes)
+        else:
+            dtypes[col] = object
+    empty_columns = [col for col, data in has_data.items() if not data]
+    return dtypes, empty_columns
+
+
+def prepare_frame(df, critical_columns, category_columns, irrelevant_columns, empty_columns=None):
+    """
+    Row-wise general cleaning that runs before duplicates are dropped.
+    Columns without data are detected from `df` unless `empty_columns` is given.
+    """
+    df = normalize_strings(df, category_columns)
+    drop_columns(df, irrelevant_columns)
+    if empty_columns is None:
+        drop_empty_columns(df)
+    else:
+        drop_columns(df, empty_columns)
+    drop_na_from_columns(df, critical_columns, how='any')
+    fill_na_with_unknown(df, category_columns)
+    return df
+
+
+def format_frame(df, category_columns, numeric_columns):
+    """
+    Row-wise formatting that runs after duplicates are dropped.
+    Each numeric column is rounded once, to whole numbers for `numeric_columns`.
+    """
+    format_numeric_columns(df, numeric_columns=[
+        col for col in df.select_dtypes('number') if col not in numeric_columns])
+    format_numeric_columns(
+        df, numeric_columns=numeric_columns, decimal_places=0)
+    replace_not_known_with_unknown(
+        df, ['Type_of_Educationa_Institution'])
+    return df
+
+
+def finish_frame(df, age_median=None):
+    """
+    Imputation and derived values specific to demographic and expenditure datasets.
+    """
+    fill_na_with_imputation(df, ['Age'], 'median', value=age_median)
+    drop_na_from_columns(df, [
+                         'Value_of_Consumption_Last_30_Day', 'Value_of_Consumption_Last_30_Day'], how='all')
+    compute_monthly_yearly_expenditure(df)
@@ -1,107 +1,498 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import glob
+import numpy as np
+import os
 import pandas as pd
 import config
+import shutil
 
 from utils.logger_utils import get_logger, log_error
-from utils.file_utils import load_dataframe, load_merged_data, write_file
-from utils.dataframe_utils import get_common_columns, get_grouped_dict
+from utils.file_utils import append_merged_json, concat_merged_json, get_stored_columns, iter_dataframe, load_dataframe, write_file, write_stage_output, write_merged_json
+from utils.dataframe_utils import apply_schema, concat_frames, get_common_columns
+from utils.incremental_utils import IncrementConflictError, get_increment_path
+from utils.metrics_utils import enable_peak_rss_reset, record_io, run_measured
 
 
-def merge_data(expenditure_file, demographic_file):
+# Columns a partitioned merge can partition the rows by. Both identify the household,
+# so all rows of a household land in the same partition.
+PARTITION_COLUMNS = ('HHID', 'State')
+
+
+def merge_data(expenditure_file, demographic_file, partitions=None, partition_by=None, workers=None, filters=None):
     """
     Merge expenditure and demographic data
 
+    With more than one partition, both files are partitioned on disk and merged one
+    partition at a time, see `merge_data_partitioned`.
+
     Parameters
     ----------
 
     expenditure_file : str
-        Path of expenditure data
+        Path of expenditure data, a file or a partitioned dataset
     demographic_file : str
-        Path of demographic data
-    output_file : str
-        Path of output merged data
+        Path of demographic data, a file or a partitioned dataset
+    partitions : int (default=None)
+        Number of partitions, 1 to merge both files in memory. Defaults to `config.MERGE_PARTITIONS`.
+    partition_by : str (default=None)
+        Column the rows are partitioned by, 'HHID' or 'State'. Defaults to `config.MERGE_PARTITION_BY`.
+    workers : int (default=None)
+        Number of processes merging partitions at once. Defaults to `config.PIPELINE_WORKERS`.
+    filters : dict (default=None)
+        Values of the partition columns of partitioned datasets to merge, e.g.
+        {'State': ['MEGHALAYA']}. Only the matching partitions are read. See `list_partition_files`.
 
     """
 
+    partitions = partitions or config.MERGE_PARTITIONS
+    partition_by = partition_by or config.MERGE_PARTITION_BY
+    workers = workers or config.PIPELINE_WORKERS
+
     logger = get_logger(__name__)
     logger.info(f'Merging files {expenditure_file} and {demographic_file}')
 
     try:
+        if partitions > 1:
+            merge_data_partitioned(expenditure_file, demographic_file,
+                                   partitions, partition_by, workers, filters)
+            return
 
         # Load the datasets
         logger.info('Loading cleaned files to be merged')
-        expenditure_df = load_dataframe(expenditure_file)
-        demographic_df = load_dataframe(demographic_file)
-        logger.info('Cleaned files loaded')
-
-        # Get common columns between the datasets
-        common_columns = get_common_columns(
-            expenditure_df, demographic_df, ['Round_Centre_Code'])
-        common_columns_df = expenditure_df[common_columns]
-        common_columns_df = common_columns_df.drop_duplicates()
-
-        # Remove common columns from both the datasets
-        common_columns.remove('HHID')
-        expenditure_df.drop(columns=common_columns, inplace=True)
-        demographic_df.drop(columns=common_columns, inplace=True)
-
-        # Group data into dictionary list, grouping by HHID
-        expenditure_data = get_grouped_dict(df=expenditure_df, groupby='HHID',
-                                            name='Expenditure_Data')
-        demographic_data = get_grouped_dict(df=demographic_df, groupby='HHID',
-                                            name='Demographic_Data')
-
-        # Merge expenditure data and demographic data into the common dataset based on HHID key
-        merged_df = pd.merge(common_columns_df, demographic_data,
-                             on="HHID", how="inner")
-        merged_df = pd.merge(merged_df, expenditure_data,
-                             on="HHID", how="inner")
-
-        # Flattern and export merged data
-        merged_df.to_json(config.MERGED_JSON_PATH, orient='table', index=False)
-        flat_merged_df = flatten_merged_json(load_merged_data())
-        write_file(flat_merged_df, config.MERGED_TSV_PATH, 'tsv')
-
-        # Export to tsv file
+        expenditure_df = load_dataframe(expenditure_file, compact=False, filters=filters)
+        demographic_df = load_dataframe(demographic_file, compact=False, filters=filters)
+        saved_mb = apply_schema(expenditure_df) + apply_schema(demographic_df)
+        logger.info(f'Cleaned files loaded. Compact dtypes saved {saved_mb:.2f} MB')
+
+        households_df = split_households(expenditure_df, demographic_df)
+
+        # Build and export the flat merged table directly from the cleaned data
+        flat_merged_df = flatten_merged_frames(
+            households_df, demographic_df, expenditure_df)
+        saved_mb = apply_schema(flat_merged_df)
+        logger.info(f'Compact dtypes saved {saved_mb:.2f} MB: {config.MERGED_TABLE_PATH}')
+        write_stage_output(flat_merged_df, config.MERGED_TABLE_PATH)
+        del flat_merged_df
+
+        # Export nested merged data
+        if config.WRITE_MERGED_JSON:
+            write_merged_json(households_df, demographic_df, expenditure_df,
+                              config.MERGED_JSON_PATH, config.MERGED_JSON_BATCH_SIZE,
+                              index_file=config.MERGED_INDEX_PATH)
 
         logger.info(
             f'Merging completed. Merged data is stored at: {config.MERGED_DATA_DIR}')
 
     except Exception as error:
         log_error(logger, error)
+        raise
 
 
-def flatten_merged_json(data):
+def merge_increment(expenditure_increment, demographic_increment, increment_file):
     """
-    Flatten merged JSON data
+    Merge the rows cleaned by an incremental run and append them to the merged outputs.
+
+    Rows of households found in only one dataset are kept aside in pending files, see
+    `write_pending_rows`, and merged once the other dataset has rows for them. New
+    households are appended to the merged table, and to the nested JSON and its index,
+    after the households of previous runs.
 
     Parameters
     ----------
 
-    data : json file
+    expenditure_increment : str
+        Path of the cleaned new expenditure rows, see `clean_increment`.
+    demographic_increment : str
+        Path of the cleaned new demographic rows.
+    increment_file : str
+        Path the merged new rows are also written to, for the incremental aggregations.
+
+    Returns
+    -------
+
+    dict
+        Number of merged households ('households') and rows ('rows').
+
+    Raises
+    ------
+
+    IncrementConflictError
+        If new rows belong to households merged by a previous run, or do not fit the
+        columns and dtypes of the merged table.
+    """
+
+    logger = get_logger(__name__)
+    logger.info(f'Merging new rows of {expenditure_increment} and {demographic_increment}')
+
+    try:
+        merged_hhids = get_merged_hhids()
+        frames = {}
+        for name, input_file in (('expenditure', expenditure_increment), ('demographic', demographic_increment)):
+            new_df = load_dataframe(input_file, compact=False)
+            pending_file = get_increment_path(f'{name}_pending')
+            frames[name] = new_df
+            if os.path.exists(pending_file):
+                pending_df = load_dataframe(pending_file, compact=False)
+                frames[name] = concat_frames([pending_df, new_df]) if len(new_df) else pending_df
+            apply_schema(frames[name])
+
+            conflicts = np.isin(new_df['HHID'].to_numpy(), merged_hhids)
+            if conflicts.any():
+                raise IncrementConflictError(
+                    f'New {name} rows belong to {len(np.unique(new_df["HHID"].to_numpy()[conflicts]))} '
+                    f'households merged by a previous run')
+        expenditure_df, demographic_df = frames['expenditure'], frames['demographic']
+
+        # Rows of households missing from the other dataset wait for its next rows
+        write_pending_rows(expenditure_df[~expenditure_df['HHID'].isin(demographic_df['HHID'])],
+                           demographic_df[~demographic_df['HHID'].isin(expenditure_df['HHID'])])
+
+        households_df = split_households(expenditure_df, demographic_df)
+        flat_merged_df = flatten_merged_frames(
+            households_df, demographic_df, expenditure_df)
+        apply_schema(flat_merged_df)
+
+        merged_columns = get_stored_columns(config.MERGED_TABLE_PATH)
+        extra_columns = [col for col in flat_merged_df.columns if col not in merged_columns]
+        if extra_columns:
+            raise IncrementConflictError(
+                f'New rows have columns {extra_columns} that are not in {config.MERGED_TABLE_PATH}')
+        # Columns without data in the new rows are null
+        flat_merged_df = flat_merged_df.reindex(columns=merged_columns)
+        try:
+            write_stage_output(flat_merged_df, config.MERGED_TABLE_PATH, append=True)
+        except ValueError as error:
+            raise IncrementConflictError(
+                f'New rows do not fit {config.MERGED_TABLE_PATH}: {error}') from error
+        write_file(flat_merged_df, increment_file, os.path.splitext(increment_file)[1][1:])
+
+        if config.WRITE_MERGED_JSON and len(households_df):
+            part_file = os.path.join(config.INCREMENTAL_DIR, 'merged_increment.json')
+            part_index_file = os.path.join(config.INCREMENTAL_DIR, 'merged_increment.idx.npy')
+            write_merged_json(households_df, demographic_df, expenditure_df,
+                              part_file, config.MERGED_JSON_BATCH_SIZE, index_file=part_index_file)
+            append_merged_json(part_file, config.MERGED_JSON_PATH,
+                               part_index_file, config.MERGED_INDEX_PATH)
+            os.remove(part_file)
+            os.remove(part_index_file)
+
+        logger.info(f'{len(households_df)} new households merged, {len(flat_merged_df)} rows appended to '
+                    f'{config.MERGED_TABLE_PATH}')
+        return {'households': len(households_df), 'rows': len(flat_merged_df)}
+
+    except IncrementConflictError:
+        # The pipeline runs in full instead
+        raise
+    except Exception as error:
+        log_error(logger, error)
+        raise
+
+
+def get_merged_hhids():
+    """
+    Returns the HHIDs of the merged households, from the index of the nested JSON when it is written.
+    """
+    if config.WRITE_MERGED_JSON:
+        return np.load(config.MERGED_INDEX_PATH)['HHID']
+    return load_dataframe(config.MERGED_TABLE_PATH, columns=['HHID'], compact=False)['HHID'].unique()
+
+
+def write_pending_rows(expenditure_df, demographic_df):
+    """
+    Write the cleaned rows of households that are not merged yet, because the other
+    dataset has no rows for them. The next incremental merge merges them with its new rows.
+    """
+    for name, df in (('expenditure', expenditure_df), ('demographic', demographic_df)):
+        pending_file = get_increment_path(f'{name}_pending')
+        if len(df):
+            write_file(df, pending_file, os.path.splitext(pending_file)[1][1:])
+        elif os.path.isdir(pending_file):
+            shutil.rmtree(pending_file)
+        elif os.path.exists(pending_file):
+            os.remove(pending_file)
+
+
+def write_unmerged_rows(expenditure_file, demographic_file):
+    """
+    Write the cleaned rows of households left out of a full merge as pending rows, see
+    `write_pending_rows`, so incremental merges can still merge them. Only the HHID
+    columns are loaded unless some rows are left out.
+    """
+    files = {'expenditure': expenditure_file, 'demographic': demographic_file}
+    hhids = {name: load_dataframe(input_file, columns=['HHID'], compact=False)['HHID']
+             for name, input_file in files.items()}
+    pending_dfs = {}
+    for name, other in (('expenditure', 'demographic'), ('demographic', 'expenditure')):
+        pending = ~hhids[name].isin(hhids[other]).to_numpy()
+        pending_dfs[name] = load_dataframe(files[name], compact=False)[pending] \
+            if pending.any() else pd.DataFrame()
+    write_pending_rows(pending_dfs['expenditure'], pending_dfs['demographic'])
+
+
+def split_households(expenditure_df, demographic_df):
+    """
+    Separate the household level columns shared by both datasets from the rest.
+
+    The shared columns, except HHID, are dropped from both dataframes in place.
+
+    Parameters
+    ----------
+
+    expenditure_df : pd.DataFrame
+        Cleaned expenditure data
+    demographic_df : pd.DataFrame
+        Cleaned demographic data
+
+    Returns
+    -------
+
+    pd.DataFrame
+        Household level columns, one row per household present in both datasets, in
+        the order of the expenditure data.
+    """
+
+    # Get common columns between the datasets
+    common_columns = get_common_columns(
+        expenditure_df, demographic_df, ['Round_Centre_Code'])
+    common_columns_df = expenditure_df[common_columns]
+    common_columns_df = common_columns_df.drop_duplicates()
+
+    # Remove common columns from both the datasets
+    common_columns.remove('HHID')
+    expenditure_df.drop(columns=common_columns, inplace=True)
+    demographic_df.drop(columns=common_columns, inplace=True)
+
+    # Keep households present in both datasets
+    return common_columns_df[common_columns_df['HHID'].isin(demographic_df['HHID']) &
+                             common_columns_df['HHID'].isin(expenditure_df['HHID'])]
+
+
+def merge_data_partitioned(expenditure_file, demographic_file, partitions, partition_by, workers, filters=None):
+    """
+    Merge expenditure and demographic data one partition at a time, so peak memory is
+    about that of one partition instead of both files.
+
+    Both files are read in chunks and their rows are spilled to `config.MERGE_SPILL_DIR`
+    by the hash of `partition_by`, so each household lands in one partition. Each partition
+    is then merged on its own, on a pool of `workers` processes, and the merged partitions
+    are concatenated. Rows are ordered by partition, then as in an in-memory merge.
+    Columns whose dtype differs between partitions are written with a dtype that holds
+    all of them, e.g. categories with the categories of every partition.
+
+    Parameters
+    ----------
+
+    expenditure_file : str
         Path of expenditure data
+    demographic_file : str
+        Path of demographic data
+    partitions : int
+        Number of partitions.
+    partition_by : str
+        Column the rows are partitioned by, one of `PARTITION_COLUMNS`.
+    workers : int
+        Number of processes merging partitions at once. Each one holds a partition in memory.
+    filters : dict (default=None)
+        Values of the partition columns of partitioned datasets to merge, see `merge_data`.
+
+    Raises
+    ------
+
+    ValueError
+        If `partition_by` is not one of `PARTITION_COLUMNS`.
+    """
+
+    logger = get_logger(__name__)
+
+    if partition_by not in PARTITION_COLUMNS:
+        raise ValueError(
+            f'Invalid partition column {partition_by}. Allowed columns are {list(PARTITION_COLUMNS)}')
+
+    spill_dir = config.MERGE_SPILL_DIR
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.makedirs(spill_dir)
+
+    try:
+        # Spill both files to disk, one set of files per partition
+        templates = {}
+        for name, input_file in (('expenditure', expenditure_file), ('demographic', demographic_file)):
+            templates[name] = partition_file(
+                input_file, spill_dir, name, partitions, partition_by, filters)
+        logger.info(f'Cleaned files split into {partitions} partitions by {partition_by}')
+
+        # Merge each partition on its own
+        args = [(spill_dir, partition, templates) for partition in range(partitions)]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, partitions), initializer=enable_peak_rss_reset) as executor:
+                measured = list(executor.map(run_measured, [f'merge:{partition}' for partition in range(partitions)],
+                                             [merge_partition] * partitions, args))
+            # Rows and bytes of the workers count towards this stage
+            for _, metrics in measured:
+                record_io(metrics['rows_in'], metrics['rows_out'],
+                          metrics['bytes_read'], metrics['bytes_written'])
+            results = [result for result, _ in measured]
+        else:
+            results = [merge_partition(*partition_args) for partition_args in args]
+        logger.info(f'Partitions merged: {sum(rows for rows, _ in results)} rows')
+
+        # Concatenate the merged partitions
+        dtypes = get_common_dtypes([dtypes for rows, dtypes in results if rows] or [results[0][1]])
+        for partition in range(partitions):
+            flat_df = pd.read_pickle(get_spill_path(spill_dir, 'merged', partition)).astype(dtypes)
+            write_stage_output(flat_df, config.MERGED_TABLE_PATH, append=partition > 0)
+            del flat_df
+
+        if config.WRITE_MERGED_JSON:
+            concat_merged_json([(get_spill_path(spill_dir, 'merged', partition, '.json'),
+                                 get_spill_path(spill_dir, 'merged', partition, '.idx.npy'))
+                                for partition in range(partitions)],
+                               config.MERGED_JSON_PATH, index_file=config.MERGED_INDEX_PATH)
+
+        logger.info(
+            f'Merging completed. Merged data is stored at: {config.MERGED_DATA_DIR}')
+
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def partition_file(input_file, spill_dir, name, partitions, partition_by, filters=None):
+    """
+    Spill the rows of a file to one pickle file per partition and chunk, read `config.MERGE_CHUNK_ROWS` rows at a time.
+
+    Returns
+    -------
+
+    pd.DataFrame
+        An empty dataframe with the columns and dtypes of the file, standing in for partitions without rows.
+    """
+    template = None
+    for chunk_number, chunk in enumerate(iter_dataframe(input_file, config.MERGE_CHUNK_ROWS, filters=filters)):
+        record_io(rows_in=len(chunk))
+        if template is None:
+            template = chunk.head(0)
+
+        partition_ids = get_partition_ids(chunk[partition_by], partitions)
+        order = np.argsort(partition_ids, kind='stable')
+        bounds = np.searchsorted(partition_ids[order], np.arange(partitions + 1))
+        for partition in range(partitions):
+            if bounds[partition] < bounds[partition + 1]:
+                spill_path = get_spill_path(spill_dir, name, partition, f'_{chunk_number:06d}.pkl')
+                chunk.iloc[order[bounds[partition]:bounds[partition + 1]]].to_pickle(spill_path)
+                record_io(bytes_written=os.path.getsize(spill_path))
+
+    if template is None:
+        template = load_dataframe(input_file, compact=False, filters=filters).head(0)
+    return template
+
+
+def merge_partition(spill_dir, partition, templates):
+    """
+    Merge the spilled rows of one partition, writing its flat table and nested JSON to the spill folder.
+
+    Returns
+    -------
+
+    tuple
+        Number of rows of the flat table, and its dtypes.
     """
+    frames = {}
+    for name, template in templates.items():
+        spill_paths = sorted(glob.glob(get_spill_path(spill_dir, name, partition, '_*.pkl')))
+        frames[name] = template.copy() if not spill_paths else pd.concat(
+            [pd.read_pickle(spill_path) for spill_path in spill_paths], ignore_index=True)
+        # Rows were counted when partitioning the file
+        record_io(bytes_read=sum(os.path.getsize(spill_path) for spill_path in spill_paths))
+        apply_schema(frames[name])
+
+    expenditure_df, demographic_df = frames['expenditure'], frames['demographic']
+    households_df = split_households(expenditure_df, demographic_df)
+
+    flat_merged_df = flatten_merged_frames(
+        households_df, demographic_df, expenditure_df)
+    apply_schema(flat_merged_df)
+    flat_merged_df.to_pickle(get_spill_path(spill_dir, 'merged', partition))
 
-    json_data = data['data']
+    if config.WRITE_MERGED_JSON:
+        write_merged_json(households_df, demographic_df, expenditure_df,
+                          get_spill_path(spill_dir, 'merged', partition, '.json'),
+                          config.MERGED_JSON_BATCH_SIZE,
+                          index_file=get_spill_path(spill_dir, 'merged', partition, '.idx.npy'))
 
-    flattened_rows = []
+    return len(flat_merged_df), flat_merged_df.dtypes.to_dict()
 
-    # Iterate through each household
-    for household in json_data:
-        household_level_data = {k: v for k, v in household.items(
-        ) if k not in ["Demographic_Data", "Expenditure_Data"]}
 
-        # Flatten Demographic_Data
-        for person in household.get("Demographic_Data", []):
-            row = {**household_level_data, **person}
-            row['Data_Type'] = 'Demographic'  # Tag for identification
-            flattened_rows.append(row)
+def get_spill_path(spill_dir, name, partition, suffix='.pkl'):
+    """
+    Returns the path of a spill file of a partition, e.g. 'expenditure_0003_000012.pkl' or 'merged_0003.json'.
+    """
+    return os.path.join(spill_dir, f'{name}_{partition:04d}{suffix}')
+
+
+def get_partition_ids(values, partitions):
+    """
+    Returns the partition of each value, from its hash. Numbers are hashed as floats,
+    so a value stored as an integer in one file and a float in the other lands in the same partition.
+    """
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        values = values.astype(np.float64)
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    return (hashes % np.uint64(partitions)).astype(np.int64)
+
+
+def get_common_dtypes(partition_dtypes):
+    """
+    Returns, for each column, a dtype holding the values of every partition: the union of
+    the categories of categorical columns, the widest numeric dtype, or object otherwise.
+    """
+    dtypes = {}
+    for col in partition_dtypes[0]:
+        col_dtypes = [partition[col] for partition in partition_dtypes]
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in col_dtypes):
+            categories = functools.reduce(lambda left, right: left.union(right),
+                                          [dtype.categories for dtype in col_dtypes])
+            dtypes[col] = pd.CategoricalDtype(categories)
+        elif all(isinstance(dtype, np.dtype) and dtype.kind in 'biuf' for dtype in col_dtypes):
+            dtypes[col] = np.result_type(*col_dtypes)
+        else:
+            dtypes[col] = np.dtype(object)
+    return dtypes
+
+
+def flatten_merged_frames(households_df, demographic_df, expenditure_df):
+    """
+    Flatten merged data into one table with a row per person and per expenditure item.
+
+    Parameters
+    ----------
+
+    households_df : pd.DataFrame
+        Household level columns, one row per household
+    demographic_df : pd.DataFrame
+        Demographic data with household level columns removed (except HHID)
+    expenditure_df : pd.DataFrame
+        Expenditure data with household level columns removed (except HHID)
+
+    Returns
+    -------
+
+    pd.DataFrame
+        Household columns joined to every person and expenditure row, tagged by `Data_Type`.
+        Rows are ordered by household, with demographic rows before expenditure rows.
+    """
+
+    households_df = households_df.assign(
+        Household_Order=np.arange(len(households_df)))
 
-        # Flatten Expenditure_Data
-        for expenditure in household.get("Expenditure_Data", []):
-            row = {**household_level_data, **expenditure}
-            row['Data_Type'] = 'Expenditure'  # Tag for identification
-            flattened_rows.append(row)
+    flat_frames = []
+    for data_type, df in (('Demographic', demographic_df), ('Expenditure', expenditure_df)):
+        flat_df = pd.merge(households_df, df, on='HHID', how='inner')
+        flat_df['Data_Type'] = data_type
+        flat_frames.append(flat_df)
 
-    df = pd.DataFrame(flattened_rows)
+    flat_merged_df = pd.concat(flat_frames, ignore_index=True)
+    flat_merged_df.sort_values('Household_Order', kind='stable', inplace=True)
+    flat_merged_df.drop(columns='Household_Order', inplace=True)
+    flat_merged_df.reset_index(drop=True, inplace=True)
 
-    return df
+    return flat_merged_df
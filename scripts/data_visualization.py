@@ -1,42 +1,82 @@
-# Define base project directory
-import matplotlib
+from concurrent.futures import ProcessPoolExecutor
 import config
+import os
+import time
 
-from utils.file_utils import load_merged_data
-from utils.dataframe_utils import flatten_data
-from utils.plot_utils import plot_stacked_bar_chart, plot_grouped_bar_chart, plot_pie_charts, plot_stacked_histogram, plot_heatmap
+from utils.file_utils import iter_merged_data
+from utils.dataframe_utils import flatten_records
+from utils.plot_utils import CHART_COLUMNS, get_chart_tasks
 from utils.logger_utils import get_logger, log_error
+from utils.metrics_utils import record_io
 
 
-def visualize_data():
+def visualize_data(workers=None):
     """
     Draws charts from merged data
+
+    The values of every chart are computed here, then the charts are rendered on a pool
+    of worker processes, one task per chart.
+
+    Parameters
+    ----------
+    workers : int (default=None)
+        Number of processes rendering charts. Defaults to `config.PIPELINE_WORKERS`.
+
+    Returns
+    -------
+    dict
+        Seconds spent rendering each chart, keyed by chart file name.
     """
 
-    matplotlib.use('Agg')
+    workers = workers or config.PIPELINE_WORKERS
 
     logger = get_logger(__name__)
     logger.info("Starting data visualization")
 
     try:
+        # Flattening the merged data one batch of households at a time
         logger.info("Loading merged data...")
-        merged_data = load_merged_data()
-        logger.info("Merged data loaded")
-
-        # Preparing dataframes from JSON merged data
         meta = ['HHID', 'Multiplier_comb', 'Sector', 'State', 'District_Code']
-        demographic_df = flatten_data(merged_data, 'Demographic_Data', meta)
-        expenditure_df = flatten_data(merged_data, 'Expenditure_Data', meta)
+        flat_dfs = flatten_records(iter_merged_data(), ['Demographic_Data', 'Expenditure_Data'],
+                                   meta, columns=CHART_COLUMNS)
+        demographic_df = flat_dfs.pop('Demographic_Data')
+        expenditure_df = flat_dfs.pop('Expenditure_Data')
+        memory_mb = (demographic_df.memory_usage(deep=True).sum() +
+                     expenditure_df.memory_usage(deep=True).sum()) / (1024 * 1024)
+        logger.info(f'Merged data loaded: {len(demographic_df)} persons and {len(expenditure_df)} '
+                    f'expenditure items in {memory_mb:.2f} MB with compact dtypes')
+
+        # Computing plot values
+        tasks = get_chart_tasks(demographic_df, expenditure_df)
+        del demographic_df, expenditure_df
 
         # Plotting charts
-        plot_stacked_bar_chart(expenditure_df)
-        plot_grouped_bar_chart(demographic_df)
-        plot_pie_charts(demographic_df)
-        plot_stacked_histogram(demographic_df)
-        plot_heatmap(expenditure_df)
+        os.makedirs(config.CHARTS_DIR, exist_ok=True)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                timings = list(executor.map(render_chart, *zip(*tasks)))
+        else:
+            timings = [render_chart(plot, args) for plot, args in tasks]
+
+        timings = {os.path.basename(args[-1]): seconds
+                   for (_, args), seconds in zip(tasks, timings)}
+        record_io(bytes_written=sum(os.path.getsize(args[-1]) for _, args in tasks))
+        for chart, seconds in timings.items():
+            logger.info(f'Chart {chart} rendered in {seconds}s')
 
         logger.info(f'Visualization completed. Charts stored at: {
                     config.CHARTS_DIR}')
+        return timings
 
     except Exception as error:
         log_error(logger, error)
+        raise
+
+
+def render_chart(plot, args):
+    """
+    Renders a chart with a plot function and returns the seconds it took.
+    """
+    start = time.perf_counter()
+    plot(*args)
+    return round(time.perf_counter() - start, 4)
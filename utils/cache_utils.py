@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+
+import config
+
+
+def file_signature(path, hash_contents=False):
+    """
+    Returns a JSON-serializable signature of a file or directory that changes when its content changes.
+
+    Parameters
+    ----------
+    path : str
+        Path of a file, or of a directory such as a columnar output.
+    hash_contents : bool (default=False)
+        Hash the file contents instead of using their size and modification time.
+
+    Returns
+    -------
+    list or None
+        Size and modification time (or content hash) of the file, or of every file in the
+        directory. None if the path does not exist.
+    """
+    if os.path.isdir(path):
+        return [[entry.name, file_signature(entry.path, hash_contents)]
+                for entry in sorted(os.scandir(path), key=lambda entry: entry.name)]
+    if not os.path.exists(path):
+        return None
+    if hash_contents:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def compute_fingerprint(input_paths, params, hash_contents=False):
+    """
+    Returns a fingerprint of a stage from the signatures of its inputs and its parameters.
+
+    Parameters
+    ----------
+    input_paths : list
+        Paths of the files read by the stage.
+    params : dict
+        Parameters that change the output of the stage.
+    hash_contents : bool (default=False)
+        Hash the input file contents instead of using their size and modification time.
+
+    Returns
+    -------
+    str
+        Hex digest of the fingerprint.
+    """
+    payload = {
+        'inputs': [[path, file_signature(path, hash_contents)] for path in input_paths],
+        'params': params,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=repr)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def load_stage_cache():
+    """
+    Load the fingerprints recorded for the stage outputs of previous runs.
+
+    Returns
+    -------
+    dict
+        Dictionary of stage name to its fingerprint and output paths.
+    """
+    if not os.path.exists(config.STAGE_CACHE_PATH):
+        return {}
+    with open(config.STAGE_CACHE_PATH) as f:
+        return json.load(f)
+
+
+def save_stage_cache(stage_cache):
+    """
+    Save the fingerprints of the stage outputs.
+    """
+    tmp_path = config.STAGE_CACHE_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(stage_cache, f, indent=2)
+    os.replace(tmp_path, config.STAGE_CACHE_PATH)
+
+
+def is_stage_cached(stage_cache, stage, fingerprint):
+    """
+    Returns True if a stage ran with the same fingerprint and its outputs still exist.
+    """
+    entry = stage_cache.get(stage)
+    if not entry or entry['fingerprint'] != fingerprint:
+        return False
+    return all(os.path.exists(path) for path in entry['outputs'])
+
+
+def record_stage(stage_cache, stage, fingerprint, output_paths):
+    """
+    Record the fingerprint and outputs of a completed stage and save the cache.
+    """
+    stage_cache[stage] = {'fingerprint': fingerprint,
+                          'outputs': list(output_paths)}
+    save_stage_cache(stage_cache)
+
+
+def remove_stage(stage_cache, stage):
+    """
+    Forget a stage, e.g. before rerunning it, so a failed run is never cached.
+    """
+    if stage_cache.pop(stage, None) is not None:
+        save_stage_cache(stage_cache)
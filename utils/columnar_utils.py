@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+META_FILE = "_meta.json"
+CODES_DTYPE = np.dtype('int32')
+
+
+def write_columnar(input_df, output_dir, append=False):
+    """
+    Write a DataFrame to a typed columnar directory.
+
+    Every column is stored as a raw binary file next to a `_meta.json` file that records
+    the column dtypes and the number of rows. Object and category columns are
+    dictionary-encoded: the distinct values go to the metadata and the column file holds
+    int32 codes (-1 for nulls). The index is not stored.
+
+    Parameters
+    ----------
+    input_df : pandas.DataFrame
+        The DataFrame to be written.
+    output_dir : str
+        The path of the columnar directory.
+    append : bool (default=False)
+        Append the rows to an existing directory with the same columns instead of overwriting it.
+
+    Raises
+    ------
+    ValueError
+        If a column cannot be encoded, or appended rows do not match the stored columns.
+
+    """
+    if append and os.path.exists(os.path.join(output_dir, META_FILE)):
+        _append_columnar(input_df, output_dir)
+        return
+
+    tmp_dir = output_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    columns = []
+    for position, col in enumerate(input_df.columns):
+        column_meta = {'name': col, 'file': f'{position:04d}.bin'}
+        values = _encode_column(input_df[col], column_meta)
+        values.tofile(os.path.join(tmp_dir, column_meta['file']))
+        columns.append(column_meta)
+
+    _write_meta(tmp_dir, {'nrows': len(input_df), 'columns': columns})
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.rename(tmp_dir, output_dir)
+
+
+def read_columnar(input_dir, columns=None, start=0, stop=None):
+    """
+    Read a typed columnar directory into a DataFrame.
+
+    Column files are memory-mapped copy-on-write, so only the requested columns are
+    read from disk and the returned frame can be modified without touching the files.
+
+    Parameters
+    ----------
+    input_dir : str
+        The path of the columnar directory.
+    columns : list (default=None)
+        Columns to load. All columns are loaded if not specified.
+    start : int (default=0)
+        Position of the first row to load.
+    stop : int (default=None)
+        Position after the last row to load. Rows are loaded to the end if not specified.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The loaded data with its stored dtypes, indexed from 0.
+
+    Raises
+    ------
+    ValueError
+        If a requested column is not stored in the directory.
+
+    """
+    meta = read_columnar_meta(input_dir)
+    stored = {column_meta['name']: column_meta for column_meta in meta['columns']}
+    columns = list(stored) if columns is None else list(columns)
+
+    missing = [col for col in columns if col not in stored]
+    if missing:
+        raise ValueError(f'Columns {missing} not found in {input_dir}')
+
+    start = min(max(start, 0), meta['nrows'])
+    stop = meta['nrows'] if stop is None else min(max(stop, start), meta['nrows'])
+
+    data = {}
+    for col in columns:
+        data[col] = _decode_column(
+            input_dir, stored[col], start, stop)
+    return pd.DataFrame(data, columns=columns, copy=False)
+
+
+def read_columnar_meta(input_dir):
+    """
+    Returns the metadata (row count and column descriptions) of a columnar directory.
+    """
+    with open(os.path.join(input_dir, META_FILE)) as f:
+        return json.load(f)
+
+
+def _encode_column(series, column_meta):
+    """
+    Returns the array to store for a column and records how to decode it in `column_meta`.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        column_meta['dtype'] = 'category'
+        column_meta['ordered'] = bool(series.cat.ordered)
+        column_meta['dictionary'] = _to_json_values(series.cat.categories)
+        return series.cat.codes.to_numpy().astype(CODES_DTYPE)
+
+    if series.dtype == object:
+        codes, uniques = pd.factorize(series)
+        column_meta['dtype'] = 'object'
+        column_meta['dictionary'] = _to_json_values(uniques)
+        return codes.astype(CODES_DTYPE)
+
+    if not isinstance(series.dtype, np.dtype):
+        raise ValueError(
+            f'Column {series.name} has unsupported dtype {series.dtype} for columnar storage')
+    column_meta['dtype'] = series.dtype.str
+    return np.ascontiguousarray(series.to_numpy())
+
+
+def _decode_column(input_dir, column_meta, start, stop):
+    """
+    Returns the values of rows `start` to `stop` of a stored column as an array or Categorical.
+    """
+    dtype = column_meta['dtype']
+    file_dtype = CODES_DTYPE if dtype in ('object', 'category') else np.dtype(dtype)
+    path = os.path.join(input_dir, column_meta['file'])
+    if stop == start:
+        values = np.empty(0, dtype=file_dtype)
+    else:
+        values = np.memmap(path, dtype=file_dtype, mode='c', offset=start * file_dtype.itemsize,
+                           shape=(stop - start,)).view(np.ndarray)
+
+    if dtype == 'category':
+        categorical = pd.Categorical.from_codes(values, categories=column_meta['dictionary'],
+                                                ordered=column_meta['ordered'])
+        # Appended categories are stored after the others, the column reads them in sorted order
+        if not categorical.ordered and not categorical.categories.is_monotonic_increasing:
+            categorical = categorical.set_categories(categorical.categories.sort_values())
+        return categorical
+    if dtype == 'object':
+        # Code -1 marks nulls and picks the trailing None
+        dictionary = np.empty(len(column_meta['dictionary']) + 1, dtype=object)
+        dictionary[:-1] = column_meta['dictionary']
+        return dictionary[values]
+    return values
+
+
+def _append_columnar(input_df, output_dir):
+    """
+    Append the rows of a DataFrame to the column files of an existing directory.
+
+    New values of object and category columns are added to their dictionaries. Every
+    column is encoded before any file is written, so rows that do not fit the stored
+    columns leave the directory as it was.
+    """
+    meta = read_columnar_meta(output_dir)
+    stored_columns = [column_meta['name'] for column_meta in meta['columns']]
+    if list(input_df.columns) != stored_columns:
+        raise ValueError(
+            f'Cannot append columns {list(input_df.columns)} to {output_dir} with columns {stored_columns}')
+
+    encoded = []
+    for column_meta in meta['columns']:
+        series = input_df[column_meta['name']]
+        dtype = column_meta['dtype']
+        if dtype in ('object', 'category'):
+            dictionary = pd.Index(column_meta['dictionary'], dtype=object)
+            new_values = pd.Index(series.dropna().unique(), dtype=object)
+            dictionary = dictionary.append(new_values[~new_values.isin(dictionary)])
+            column_meta['dictionary'] = _to_json_values(dictionary)
+            values = dictionary.get_indexer(series.astype(object)).astype(CODES_DTYPE)
+        else:
+            source = series.to_numpy()
+            if not np.can_cast(source.dtype, np.dtype(dtype), casting='same_kind'):
+                raise ValueError(
+                    f'Cannot append {series.dtype} values to {dtype} column {column_meta["name"]}')
+            with np.errstate(invalid='ignore', over='ignore'):
+                values = np.ascontiguousarray(source.astype(dtype))
+                if not np.array_equal(values.astype(source.dtype), source, equal_nan=source.dtype.kind == 'f'):
+                    raise ValueError(
+                        f'Values of column {column_meta["name"]} do not fit its stored dtype {dtype}')
+        encoded.append((column_meta['file'], values))
+
+    for file, values in encoded:
+        with open(os.path.join(output_dir, file), 'ab') as f:
+            values.tofile(f)
+
+    # Row count is updated last, so readers never see partially appended rows
+    meta['nrows'] += len(input_df)
+    _write_meta(output_dir, meta)
+
+
+def _write_meta(output_dir, meta):
+    tmp_path = os.path.join(output_dir, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(output_dir, META_FILE))
+
+
+def _to_json_values(values):
+    """
+    Returns a list of plain Python values that can be stored in the metadata.
+    """
+    json_values = []
+    for value in values:
+        if isinstance(value, np.generic):
+            value = value.item()
+        if not isinstance(value, (str, int, float, bool)):
+            raise ValueError(
+                f'Value {value!r} of type {type(value).__name__} cannot be dictionary-encoded')
+        json_values.append(value)
+    return json_values
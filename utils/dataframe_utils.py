@@ -1,14 +1,80 @@
+import itertools
+
+import numpy as np
 import pandas as pd
 
+from schema import COLUMN_DTYPES
+from utils.metrics_utils import measure_step
+
 
 def flatten_data(data, path, meta):
     """
     Flatten JSON data to dataframe at specified data path.
     """
-    df = pd.json_normalize(data['data'], record_path=path, meta=meta)
-    return df
-
-
+    records = data['data'] if isinstance(data, dict) else data
+    return flatten_records(records, [path], meta)[path]
+
+
+def flatten_records(records, paths, meta, columns=None, batch_size=10000):
+    """
+    Flatten household records to one dataframe per data path, in a single pass over the records.
+
+    Records are flattened in batches and each batch is cast to the compact dtypes of the
+    schema registry, so `records` may be a stream such as `iter_merged_data` and only the
+    compact frames are held in memory.
+
+    Parameters
+    ----------
+    records : iterable
+        Household records, each holding a list of rows under every path.
+    paths : list
+        Data paths to flatten, e.g. ['Demographic_Data', 'Expenditure_Data'].
+    meta : list
+        Household fields added to every row.
+    columns : dict (default=None)
+        Columns to keep for each path. All columns are kept if not specified.
+    batch_size : int (default=10000)
+        Number of records flattened at once.
+
+    Returns
+    -------
+    dict
+        Flattened dataframe of each path.
+    """
+    frames = {path: [] for path in paths}
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        for path in paths:
+            df = pd.json_normalize(batch, record_path=path, meta=meta)
+            if columns and path in columns:
+                df = df[[col for col in columns[path] if col in df.columns]]
+            if len(df):
+                apply_schema(df)
+                frames[path].append(df)
+    return {path: concat_frames(path_frames) if path_frames else pd.DataFrame(columns=columns.get(path) if columns else None)
+            for path, path_frames in frames.items()}
+
+
+def concat_frames(frames):
+    """
+    Concatenate dataframes, keeping the columns that are categorical in every frame categorical.
+    """
+    frames = list(frames)
+    for col in frames[0].columns:
+        if all(isinstance(df[col].dtype, pd.CategoricalDtype) for df in frames if col in df.columns):
+            categories = frames[0][col].cat.categories
+            for df in frames[1:]:
+                if col in df.columns:
+                    categories = categories.union(df[col].cat.categories)
+            frames = [df.assign(**{col: df[col].cat.set_categories(categories)}) if col in df.columns else df
+                      for df in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+@measure_step
 def drop_columns(df, cols):
     """
     Drop specified columns from dataframe.
@@ -18,14 +84,12 @@ def drop_columns(df, cols):
             df.drop(columns=col, inplace=True)
 
 
+@measure_step
 def drop_unknown(df):
     """
     Drop all rows with 'Unknown' value from dataframe.
     """
-    def check_for_unknown(row):
-        if 'Unknown' in row.values:
-            df.drop(index=row.name, inplace=True)
-    df.apply(check_for_unknown, axis=1)
+    df.drop(index=df.index[df.isin(['Unknown']).any(axis=1)], inplace=True)
     return df
 
 
@@ -40,17 +104,64 @@ def drop_indexes(df, indexes):
     return df
 
 
-def strip_strings(df):
+@measure_step
+def normalize_strings(df, case_columns=None):
     """
-    Strip all strings in dataframe.
+    Normalize all string columns of dataframe in a single column-wise pass.
+
+    Strings are stripped, runs of whitespace are collapsed to one space and blank
+    strings become null. Values in `case_columns` also get an uppercase first letter,
+    the rest of them is left as it is. Each column is factorized first, so the string
+    operations run once per distinct value instead of once per cell. Categorical
+    columns stay categorical, only their categories are normalized.
     """
-    df = df.replace(' ', None)
+    case_columns = case_columns or []
     for col in df.columns:
-        df[col] = df[col].apply(
-            lambda x: x.strip() if isinstance(x, str) else x)
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            codes, uniques = None, df[col].cat.categories
+        elif pd.api.types.is_object_dtype(df[col]):
+            codes, uniques = pd.factorize(df[col])
+        else:
+            continue
+        values = pd.Series(uniques, dtype=object)
+        is_string = values.map(type) == str
+        strings = values[is_string].str.strip().str.replace(
+            r'\s+', ' ', regex=True)
+        if col in case_columns:
+            strings = strings.str[:1].str.upper() + strings.str[1:]
+        values[is_string] = strings.mask(strings == '')
+        if codes is None:
+            df[col] = recode_categories(df[col], values)
+        else:
+            # Code -1 marks nulls and picks the trailing None
+            df[col] = np.append(values.to_numpy(), None)[codes]
     return df
 
 
+def recode_categories(series, values):
+    """
+    Returns a categorical series with each category replaced by its value in `values`.
+    Categories that get the same value are merged, and null values become nulls.
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    # Code -1 marks nulls in the series and picks the trailing -1
+    series_codes = np.append(codes, -1)[series.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(series_codes, uniques), index=series.index, name=series.name)
+
+
+@measure_step
+def sort_categories(df):
+    """
+    Drop the unused categories of all categorical columns and sort the others,
+    as a cast of the values from strings would.
+    """
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            categories = df[col].cat.remove_unused_categories().cat.categories
+            df[col] = df[col].cat.set_categories(categories.sort_values())
+
+
+@measure_step
 def drop_empty_columns(df):
     """
     Drop columns with no data.
@@ -58,6 +169,7 @@ def drop_empty_columns(df):
     df.dropna(axis=1, how='all', inplace=True)
 
 
+@measure_step
 def drop_na_from_columns(df, cols, how):
     """
     Drop rows with no data in specified columns
@@ -67,57 +179,125 @@ def drop_na_from_columns(df, cols, how):
         df.dropna(subset=cols, how=how, inplace=True)
 
 
+@measure_step
 def fill_na_with_unknown(df, cols):
     """
     Fill NA with 'Unknown' in dataframe 'df' for columns 'cols'
     """
     for col in cols:
         if col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype) and 'Unknown' not in df[col].cat.categories:
+                df[col] = df[col].cat.add_categories('Unknown')
             df[col] = df[col].fillna('Unknown')
 
 
+@measure_step
 def format_numeric_columns(df, numeric_columns=None, decimal_places=2):
     """
     Format decimal places for all numeric columns.
+    Columns that are not numeric are coerced to numbers first, integer columns are left as they are.
     """
     if numeric_columns == None:
         numeric_columns = df.select_dtypes('number')
     for col in numeric_columns:
         if col in df.columns:
-            df[col] = pd.to_numeric(
-                df[col], errors='coerce').round(decimal_places)
-    return df
-
-
-def capitalize_strings(df, cols):
-    """
-    Capitalize values in all specified columns
-    """
-    for col in cols:
-        if col in df.columns:
-            df[col].apply(str.capitalize)
+            values = df[col]
+            if not pd.api.types.is_numeric_dtype(values.dtype):
+                values = pd.to_numeric(values, errors='coerce')
+            elif pd.api.types.is_integer_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype):
+                continue
+            df[col] = values.round(decimal_places)
     return df
 
 
+@measure_step
 def replace_not_known_with_unknown(df, cols):
     """
     Replace 'Not Known' with 'Unknown' in specified columns
     """
     for col in cols:
         if col in df.columns:
-            df[col] = df[col].replace('Not   known', 'Unknown')
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = recode_categories(df[col], pd.Series(df[col].cat.categories, dtype=object).replace(
+                    r'(?i)^not\s+known$', 'Unknown', regex=True))
+            else:
+                df[col] = df[col].replace(
+                    r'(?i)^not\s+known$', 'Unknown', regex=True)
 
 
-def fill_na_with_imputation(df, cols, method):
+@measure_step
+def fill_na_with_imputation(df, cols, method, value=None):
     """
-    Fill NA values with specified imputation method for specified columns
+    Fill NA values with specified imputation method for specified columns.
+    A precomputed `value` (e.g. a median over the whole file) overrides the method.
     """
     for col in cols:
         if col in df.columns:
-            if method == 'median':
+            if value is not None:
+                df[col] = df[col].fillna(value)
+            elif method == 'median':
                 df[col] = df[col].fillna(df['Age'].median().round(0))
 
 
+def median_from_counts(counts):
+    """
+    Returns the median of the values described by a value -> count series.
+    """
+    counts = counts[counts > 0].sort_index()
+    total = counts.sum()
+    if total == 0:
+        return np.nan
+    positions = counts.cumsum().to_numpy()
+    values = counts.index.to_numpy(dtype=float)
+    lower = values[np.searchsorted(positions, (total - 1) // 2, side='right')]
+    upper = values[np.searchsorted(positions, total // 2, side='right')]
+    return (lower + upper) / 2
+
+
+@measure_step
+def drop_duplicates_across_chunks(df, seen_hashes):
+    """
+    Drop rows of a chunk that are duplicated within the chunk or were seen in earlier chunks.
+
+    Rows are tracked by a 64-bit hash, so memory grows by 8 bytes per unique row
+    instead of by the size of the rows themselves. The hashes are kept in sorted runs,
+    probed with `np.searchsorted`; the hashes of each chunk make a new run, and runs are
+    merged when the last one grows as large as the one before it. There are at most
+    log2(rows) runs, and each hash is merged log2(rows) times over a whole file.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Chunk to deduplicate.
+    seen_hashes : list
+        Sorted runs of the hashes of the rows kept so far, empty for the first chunk.
+
+    Returns
+    -------
+    tuple
+        The deduplicated chunk and the updated list of runs.
+    """
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    _, first_positions = np.unique(hashes, return_index=True)
+    keep = np.zeros(len(df), dtype=bool)
+    keep[first_positions] = True
+    for run in seen_hashes:
+        positions = np.flatnonzero(keep)
+        found = np.searchsorted(run, hashes[positions])
+        seen = run[np.minimum(found, len(run) - 1)] == hashes[positions]
+        keep[positions[seen]] = False
+
+    runs = list(seen_hashes)
+    new_hashes = np.sort(hashes[keep])
+    if len(new_hashes):
+        runs.append(new_hashes)
+    while len(runs) > 1 and len(runs[-2]) <= len(runs[-1]):
+        last = runs.pop()
+        runs[-1] = np.sort(np.concatenate([runs[-1], last]))
+    return df.drop(index=df.index[~keep]), runs
+
+
+@measure_step
 def compute_monthly_yearly_expenditure(df):
     """
     Compute empty monthly and yearly expenditure values from one another
@@ -143,18 +323,61 @@ def get_common_columns(df1, df2, ignore_columns=None):
     return common_columns
 
 
-def get_grouped_dict(df, groupby, name):
-    """
-    Converts dataframe records to dictionary, grouped by a field.
+@measure_step
+def apply_schema(df, schema=None):
     """
-    grouped_dict = df.groupby(groupby).apply(
-        lambda x: x.to_dict(orient='records'), include_groups=False
-    ).reset_index(name=name)
-    return grouped_dict
+    Cast the columns of dataframe found in the schema registry to their compact dtypes.
 
+    A cast is only applied when it keeps every value, see `schema.py`. Other columns
+    and columns that already have their dtype are left as they are.
 
-def count_if_adult(series):
+    Returns
+    -------
+    float
+        Memory saved, in MB.
     """
-    Returns the count of values in the series where value >18
-    """
-    return series[series >= 18].count()
+    schema = schema or COLUMN_DTYPES
+    saved_bytes = 0
+    for col in df.columns:
+        if col not in schema or df[col].dtype == schema[col]:
+            continue
+        compact = to_compact_dtype(df[col], schema[col])
+        if compact is not None:
+            saved_bytes += df[col].memory_usage(index=False, deep=True) - \
+                compact.memory_usage(index=False, deep=True)
+            df[col] = compact
+    return saved_bytes / (1024 * 1024)
+
+
+def to_compact_dtype(series, dtype):
+    """
+    Returns the series cast to a compact dtype, or None if the cast would change any value.
+
+    An integer column with nulls is cast to float32 instead, when its values fit exactly.
+    """
+    if dtype == 'category':
+        if pd.api.types.is_object_dtype(series.dtype):
+            return series.astype('category')
+        return None
+
+    if not pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        return None
+    values = series.to_numpy()
+    target = np.dtype(dtype)
+    if target.kind == 'i' and series.isna().any():
+        target = np.dtype('float32')
+    if target.itemsize >= values.dtype.itemsize and target.kind == values.dtype.kind:
+        return None
+
+    if target.kind == 'i':
+        limits = np.iinfo(target)
+        if len(values) and (values.min() < limits.min or values.max() > limits.max):
+            return None
+        if values.dtype.kind in 'iu':
+            # Integers within range keep their values
+            return pd.Series(values.astype(target), index=series.index, name=series.name)
+    with np.errstate(invalid='ignore', over='ignore'):
+        compact_values = values.astype(target)
+        if not np.array_equal(compact_values.astype(values.dtype), values, equal_nan=values.dtype.kind == 'f'):
+            return None
+    return pd.Series(compact_values, index=series.index, name=series.name)
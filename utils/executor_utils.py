@@ -0,0 +1,181 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import time
+
+from utils.logger_utils import get_logger
+from utils.metrics_utils import enable_peak_rss_reset, run_measured
+
+
+def run_dag(tasks, workers=1, initializer=None, initargs=(), progress=None, metrics=None, profile_dir=None):
+    """
+    Runs a graph of tasks, each one as soon as the tasks it depends on have completed.
+
+    Task functions run on a pool of `workers` processes, so they must be module-level
+    functions with picklable arguments and results. The 'prepare' and 'complete' hooks
+    run in the calling process. With a single worker the tasks run one at a time in
+    this process, in the order of `tasks`.
+
+    When a task fails, the tasks depending on it are not run, while the other tasks
+    still run to completion. The error of the first failed task in the order of `tasks`
+    is then raised, so the reported error does not depend on which worker finished first.
+
+    Parameters
+    ----------
+    tasks : dict
+        Dictionary of task names to dictionaries with the keys:
+
+        - 'func': function to run.
+        - 'args': tuple of arguments of `func` (default: no arguments).
+        - 'deps': list of names of the tasks to complete first (default: none).
+        - 'prepare': function called without arguments once the dependencies have
+          completed. Returns the arguments of `func`, or None to skip the task.
+        - 'complete': function called with the result of `func`.
+    workers : int (default=1)
+        Number of worker processes.
+    initializer : callable (default=None)
+        Function called at the start of every worker process, e.g. to configure logging.
+    initargs : tuple (default=())
+        Arguments of `initializer`.
+    progress : callable (default=None)
+        Function called with the task name, its status ('running', 'skipped', 'completed',
+        'failed' or 'blocked') and the seconds it ran for, whenever a task changes status.
+    metrics : dict (default=None)
+        If given, every task is measured with `run_measured` and its metrics are stored
+        in this dictionary under the task name.
+    profile_dir : str (default=None)
+        Directory of the cProfile statistics of every task, one `.prof` file per task.
+        Tasks are not profiled if not specified. Only used with `metrics`.
+
+    Returns
+    -------
+    dict
+        Result of each task, None for skipped tasks.
+
+    Raises
+    ------
+    ValueError
+        If a task depends on an unknown task or the dependencies form a cycle.
+    Exception
+        The error of the first failed task.
+
+    """
+    logger = get_logger(__name__)
+    progress = progress or (lambda name, status, seconds: None)
+
+    for name, task in tasks.items():
+        unknown = [dep for dep in task.get('deps', []) if dep not in tasks]
+        if unknown:
+            raise ValueError(f'Task {name} depends on unknown tasks {unknown}')
+
+    results = {}
+    errors = {}
+    blocked = set()
+    running = {}
+    waiting = list(tasks)
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                   initargs=(initializer, initargs)) if workers > 1 else None
+
+    def start(name):
+        """
+        Submits a task whose dependencies have completed, or runs it here with a single worker.
+        """
+        task = tasks[name]
+        try:
+            args = task['prepare']() if 'prepare' in task else task.get('args', ())
+            if args is None:
+                logger.info(f'Task {name} skipped')
+                results[name] = None
+                progress(name, 'skipped', 0)
+            elif executor is not None:
+                running[executor.submit(*get_call(name, task, args))] = (name, time.perf_counter())
+                progress(name, 'running', 0)
+            else:
+                start_time = time.perf_counter()
+                progress(name, 'running', 0)
+                try:
+                    func, *call_args = get_call(name, task, args)
+                    result = func(*call_args)
+                except Exception as error:
+                    fail(name, error, start_time)
+                else:
+                    finish(name, result, start_time)
+        except Exception as error:
+            fail(name, error, None)
+
+    def get_call(name, task, args):
+        """
+        Returns the function and arguments running a task, measured if `metrics` is given.
+        """
+        if metrics is None:
+            return (task['func'], *args)
+        profile_file = os.path.join(profile_dir, name.replace(':', '_') + '.prof') if profile_dir else None
+        return (run_measured, name, task['func'], args, profile_file)
+
+    def finish(name, result, start_time):
+        """
+        Records the result of a task that ran successfully.
+        """
+        if metrics is not None:
+            result, metrics[name] = result
+        if 'complete' in tasks[name]:
+            tasks[name]['complete'](result)
+        results[name] = result
+        seconds = round(time.perf_counter() - start_time, 4)
+        logger.info(f'Task {name} completed in {seconds}s')
+        progress(name, 'completed', seconds)
+
+    def fail(name, error, start_time):
+        """
+        Records the error of a failed task.
+        """
+        errors[name] = error
+        seconds = round(time.perf_counter() - start_time, 4) if start_time else 0
+        progress(name, 'failed', seconds)
+
+    try:
+        while waiting or running:
+            progressed = False
+            for name in list(waiting):
+                deps = tasks[name].get('deps', [])
+                if any(dep in errors or dep in blocked for dep in deps):
+                    logger.error(f'Task {name} not run: a task it depends on failed')
+                    waiting.remove(name)
+                    blocked.add(name)
+                    progress(name, 'blocked', 0)
+                    progressed = True
+                elif all(dep in results for dep in deps):
+                    waiting.remove(name)
+                    start(name)
+                    progressed = True
+
+            if running:
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    name, start_time = running.pop(future)
+                    try:
+                        finish(name, future.result(), start_time)
+                    except Exception as error:
+                        fail(name, error, start_time)
+            elif not progressed:
+                raise ValueError(f'Tasks {waiting} have cyclic dependencies')
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    for name in tasks:
+        if name in errors:
+            logger.error(f'Task {name} failed: {errors[name]}')
+    for name in tasks:
+        if name in errors:
+            raise errors[name]
+    return results
+
+
+def init_worker(initializer=None, initargs=()):
+    """
+    Initializes a worker process of `run_dag`. Workers only run tasks, so their measurements
+    may reset their peak RSS, see `enable_peak_rss_reset`. Then `initializer` runs.
+    """
+    enable_peak_rss_reset()
+    if initializer is not None:
+        initializer(*initargs)
@@ -1,22 +1,169 @@
+import glob
+import io
 import json
 import config
+import numpy as np
 import pandas as pd
 import os
+import shutil
+from urllib.parse import quote, unquote
+
+from schema import NUMERIC_COLUMN_DTYPES, RAW_COLUMN_DTYPES, RAW_NA_VALUES, STRING_COLUMNS
+from utils.columnar_utils import read_columnar, read_columnar_meta, write_columnar
+from utils.dataframe_utils import apply_schema
+from utils.metrics_utils import get_path_size, record_io
+
+
+# Value of the partition directory of rows whose partition column is null
+NULL_PARTITION = '__null__'
+# Formats of the part files of a partitioned dataset, in order of preference
+PART_EXTENSIONS = ('.col', '.tsv', '.csv')
 
 
 def load_merged_data():
     """
     Load merged data.
 
+    The whole document is parsed into memory. Use `iter_merged_data` to process
+    the households one at a time.
+
     Returns
     -------
     file
         Json file of merged data.
     """
-    merged_data = json.load(open(config.MERGED_JSON_PATH))
+    with open(config.MERGED_JSON_PATH) as f:
+        merged_data = json.load(f)
     return merged_data
 
 
+def iter_merged_data(filePath=None, read_size=1 << 20):
+    """
+    Load the households of a merged JSON file one at a time.
+
+    Only one household and one block of the file are held in memory at a time, so the
+    file may be larger than the available memory.
+
+    Parameters
+    ----------
+    filePath : str (default=None)
+        The path of the merged JSON file. Defaults to `config.MERGED_JSON_PATH`.
+    read_size : int (default=1 << 20)
+        Number of characters read from the file at a time.
+
+    Returns
+    -------
+    Iterator[dict]
+        The record of each household, with its persons and expenditure items.
+    """
+    filePath = filePath or config.MERGED_JSON_PATH
+    record_io(bytes_read=os.path.getsize(filePath))
+    for key, value in iter_json_items(filePath, 'data', read_size):
+        if key == 'data':
+            record_io(rows_in=1)
+            yield value
+
+
+def iter_json_items(filePath, array_key, read_size=1 << 20):
+    """
+    Incrementally parse a JSON object, yielding the items of one of its array values one at a time.
+
+    The file is read in blocks and every value is decoded as soon as it is complete, so
+    the layout of the file (line breaks, indentation) does not matter.
+
+    Parameters
+    ----------
+    filePath : str
+        The path of a JSON file holding an object.
+    array_key : str
+        Key of the array whose items are yielded one at a time.
+    read_size : int (default=1 << 20)
+        Number of characters read from the file at a time.
+
+    Returns
+    -------
+    Iterator[tuple]
+        (key, value) for each key of the object, or (array_key, item) for each item of the array.
+
+    Raises
+    ------
+    ValueError
+        If the file is not a JSON object, or `array_key` does not hold an array.
+    """
+    decoder = json.JSONDecoder()
+    with open(filePath, encoding='utf-8') as f:
+        buffer = ''
+        position = 0
+        eof = False
+
+        def fill():
+            # Drop the consumed characters and read the next block
+            nonlocal buffer, position, eof
+            block = f.read(read_size)
+            eof = not block
+            buffer = buffer[position:] + block
+            position = 0
+            return not eof
+
+        def skip_whitespace():
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n':
+                    position += 1
+                if position < len(buffer) or not fill():
+                    return
+
+        def next_char(expected):
+            nonlocal position
+            skip_whitespace()
+            char = buffer[position:position + 1]
+            if not char or char not in expected:
+                raise ValueError(
+                    f'Invalid JSON in {filePath}: expected one of {list(expected)}, found {char!r}')
+            position += 1
+            return char
+
+        def decode():
+            # A value is complete once a delimiter follows it or the file is fully read,
+            # since e.g. a number could continue in the next block
+            nonlocal position
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    if buffer[end:end + 1] in (' ', '\t', '\r', '\n', ',', ':', ']', '}') or eof:
+                        position = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        next_char('{')
+        if next_char('}"') == '}':
+            return
+        position -= 1
+        while True:
+            key = decode()
+            next_char(':')
+            if key != array_key:
+                yield key, decode()
+            else:
+                next_char('[')
+                skip_whitespace()
+                if buffer[position:position + 1] == ']':
+                    position += 1
+                else:
+                    while True:
+                        yield key, decode()
+                        if next_char(',]') == ']':
+                            break
+            if next_char(',}') == '}':
+                return
+            next_char('"')
+            position -= 1
+
+
 def load_cleaned_data():
     """
     Load cleaned data.
@@ -24,24 +171,47 @@ def load_cleaned_data():
     Returns
     -------
     dict
-        Dictionary of TSV files of cleaned data.
+        Dictionary of records of cleaned data.
     """
+    cleaned_paths = get_cleaned_paths()
     cleaned_data = {}
-    cleaned_data['Cleaned_Demographic_Data'] = pd.read_csv(
-        config.CLEANED_DEMOGRAPHICS_PATH, sep="\t").to_dict(orient='records')
-    cleaned_data['Cleaned_Expenditure_Data'] = pd.read_csv(
-        config.CLEANED_EXPENDITURE_PATH, sep="\t").to_dict(orient='records')
+    cleaned_data['Cleaned_Demographic_Data'] = load_dataframe(
+        cleaned_paths['demographic']).to_dict(orient='records')
+    cleaned_data['Cleaned_Expenditure_Data'] = load_dataframe(
+        cleaned_paths['expenditure']).to_dict(orient='records')
     return cleaned_data
 
 
-def load_dataframe(filePath):
+def get_cleaned_paths():
+    """
+    Returns the path of the cleaned demographic and expenditure data: the partitioned
+    dataset of the last batch clean if there is one, the cleaned file otherwise.
+    """
+    return {'demographic': config.CLEANED_DEMOGRAPHICS_PARTITIONS_PATH
+            if is_partitioned(config.CLEANED_DEMOGRAPHICS_PARTITIONS_PATH) else config.CLEANED_DEMOGRAPHICS_PATH,
+            'expenditure': config.CLEANED_EXPENDITURE_PARTITIONS_PATH
+            if is_partitioned(config.CLEANED_EXPENDITURE_PARTITIONS_PATH) else config.CLEANED_EXPENDITURE_PATH}
+
+
+def load_dataframe(filePath, columns=None, compact=True, filters=None):
     """
     Load data file in the specified format.
 
     Parameters
     ----------
     filePath : str
-        The path of the file to be loaded. Currently supported types are ('csv', 'json', 'tsv').
+        The path of the file to be loaded. Currently supported types are ('col', 'csv', 'json', 'tsv'),
+        and partitioned datasets written by `write_partitioned`, whose parts are concatenated.
+    columns : list (default=None)
+        Columns to load. All columns are loaded if not specified.
+        Columnar ('col') files only read the requested columns from disk.
+    compact : bool (default=True)
+        Cast known columns to the compact dtypes of the schema registry (`schema.py`).
+        String code columns of delimited files are read as strings either way, so
+        leading zeros are kept.
+    filters : dict (default=None)
+        Values of the partition columns to load, e.g. {'State': ['MEGHALAYA']}, see
+        `list_partition_files`. Only used for partitioned datasets.
 
     Returns
     -------
@@ -51,30 +221,442 @@ def load_dataframe(filePath):
     Raises
     ------
     ValueError
-        If the `fileType` is not one of the supported types ('csv', 'json', 'tsv').
+        If the `fileType` is not one of the supported types ('col', 'csv', 'json', 'tsv'),
+        or no partition of a partitioned dataset matches `filters`.
 
     """
 
+    if is_partitioned(filePath):
+        part_files = list_partition_files(filePath, filters)
+        if not part_files:
+            raise ValueError(f'No partition of {filePath} matches {filters}')
+        # Columns dropped as empty from some parts are null in their rows
+        loaded_data = pd.concat([load_dataframe(part_file, columns=columns, compact=False)
+                                 for part_file in part_files], ignore_index=True)
+        if compact:
+            apply_schema(loaded_data)
+        return loaded_data
+
     fileType = os.path.splitext(filePath)[1]
 
-    valid_filetypes = ('.csv', '.json', '.tsv')
+    valid_filetypes = ('.col', '.csv', '.json', '.tsv')
 
-    if fileType == '.csv':
-        loaded_data = pd.read_csv(filePath, sep=',')
-        return loaded_data
+    if fileType == '.col':
+        loaded_data = read_columnar(filePath, columns=columns)
+    elif fileType == '.csv':
+        loaded_data = pd.read_csv(filePath, sep=',', usecols=columns, dtype=get_read_dtypes())
     elif fileType == '.tsv':
-        loaded_data = pd.read_csv(filePath, sep='\t')
-        return loaded_data
+        loaded_data = pd.read_csv(filePath, sep='\t', usecols=columns, dtype=get_read_dtypes())
     elif fileType == '.json':
-        loaded_data = json.load(open(filePath))
-        loaded_data = pd.DataFrame(loaded_data['data'])
-        return loaded_data
+        with open(filePath) as f:
+            loaded_data = json.load(f)
+        loaded_data = pd.DataFrame(loaded_data['data'], columns=columns)
     else:
         raise ValueError(f'Invalid file type {fileType}. Allowed types are {
                          valid_filetypes}')
 
+    record_io(rows_in=len(loaded_data), bytes_read=get_read_size(filePath, columns))
+    if compact:
+        apply_schema(loaded_data)
+    return loaded_data
+
+
+def get_read_size(filePath, columns=None):
+    """
+    Returns the number of bytes read to load the columns of a file.
+    Only the files of the requested columns are read from a columnar directory.
+    """
+    if os.path.splitext(filePath)[1] != '.col' or columns is None:
+        return get_path_size(filePath)
+    return sum(os.path.getsize(os.path.join(filePath, column_meta['file']))
+               for column_meta in read_columnar_meta(filePath)['columns'] if column_meta['name'] in columns)
+
+
+def get_read_dtypes(dtype=None):
+    """
+    Returns the dtypes of delimited files, reading the string columns of the schema registry as strings.
+    """
+    return {**{col: str for col in STRING_COLUMNS}, **(dtype or {})}
+
+
+def iter_dataframe(filePath, chunk_size, dtype=None, columns=None, start=0, filters=None, offset=0):
+    """
+    Load a data file lazily in chunks of rows.
+
+    Parameters
+    ----------
+    filePath : str
+        The path of the file to be loaded. Currently supported types are ('col', 'csv', 'tsv'),
+        and partitioned datasets written by `write_partitioned`, read one part after the other.
+    chunk_size : int
+        Maximum number of rows in each chunk.
+    dtype : dict (default=None)
+        Column dtypes to enforce on delimited files, so that every chunk parses the same way.
+        String columns of the schema registry are read as strings unless given here.
+    columns : list (default=None)
+        Columns to load. All columns are loaded if not specified.
+    start : int (default=0)
+        Number of leading rows to skip.
+    filters : dict (default=None)
+        Values of the partition columns to load, see `load_dataframe`. Only used for partitioned datasets.
+    offset : int (default=0)
+        Byte offset of the first row to load from a delimited file, as yielded by
+        `iter_delimited`. Rows before it are neither read nor parsed.
+
+    Returns
+    -------
+    Iterator[pandas.DataFrame]
+        Chunks of the file, in file order. Delimited files keep their column order.
+        Chunks of a partitioned dataset do not span two parts.
+
+    Raises
+    ------
+    ValueError
+        If the file type is not one of the supported types ('col', 'csv', 'tsv').
+
+    """
+
+    if is_partitioned(filePath):
+        return iter_partitioned(filePath, chunk_size, dtype, columns, start, filters)
+
+    fileType = os.path.splitext(filePath)[1]
+
+    valid_filetypes = ('.col', '.csv', '.tsv')
+
+    if fileType in ('.csv', '.tsv'):
+        return (chunk for chunk, _ in iter_delimited(filePath, chunk_size, dtype, columns, start, offset))
+    if fileType != '.col':
+        raise ValueError(
+            f'Invalid file type {fileType} for chunked loading. Allowed types are {valid_filetypes}')
+
+    record_io(bytes_read=get_read_size(filePath, columns))
+    return iter_columnar(filePath, chunk_size, columns, start)
+
+
+def iter_delimited(filePath, chunk_size, dtype=None, columns=None, start=0, offset=0):
+    """
+    Load a delimited file lazily in chunks of rows, with the byte offset after each row.
+
+    The file is read from `offset` in lines, and each chunk of lines is parsed with the
+    header of the file, so paging through a file reads each row once instead of parsing
+    the rows before every page again. Rows must not span lines.
+
+    Parameters
+    ----------
+    filePath : str
+        The path of the file to be loaded. Currently supported types are ('csv', 'tsv').
+    chunk_size, dtype, columns
+        Same as for `iter_dataframe`.
+    start : int (default=0)
+        Number of rows to skip after `offset`. Skipped lines are not parsed.
+    offset : int (default=0)
+        Byte offset of the first row, as yielded for the row before it.
+        The first row is loaded if 0.
+
+    Returns
+    -------
+    Iterator[tuple]
+        Each chunk of the file, and a numpy array of the byte offset after each of its rows.
+
+    Raises
+    ------
+    ValueError
+        If `offset` is not the start of a row.
+
+    """
+    sep = ',' if os.path.splitext(filePath)[1] == '.csv' else '\t'
+    with open(filePath, 'rb') as f:
+        header = f.readline()
+        if offset:
+            f.seek(offset - 1)
+            if offset < len(header) or f.read(1) != b'\n':
+                raise ValueError(f'Invalid offset {offset} in {filePath}')
+        for _ in range(start):
+            if not f.readline():
+                break
+        position = f.tell()
+        while True:
+            lines = []
+            offsets = []
+            while len(lines) < chunk_size:
+                line = f.readline()
+                if not line:
+                    break
+                position += len(line)
+                # Blank lines hold no row
+                if line.strip():
+                    lines.append(line)
+                    offsets.append(position)
+            if not lines:
+                return
+            data = b''.join(lines)
+            record_io(bytes_read=len(data))
+            chunk = pd.read_csv(io.BytesIO(header + data), sep=sep,
+                                dtype=get_read_dtypes(dtype), usecols=columns)
+            yield chunk, np.array(offsets)
+
+
+def load_raw_dataframe(filePath, exclude_columns=None, typed=True):
+    """
+    Load a raw NSS file with its columns typed while parsing.
+
+    Known columns are parsed with the dtypes of `schema.RAW_COLUMN_DTYPES`: strings as
+    categories, keeping the leading zeros of codes, and numbers as int64 or float64, then
+    cast to their compact dtypes. Blank cells are read as nulls and excluded columns are
+    not parsed at all, so the frame holds no column or blank string that cleaning would
+    throw away.
+
+    Other files are loaded by `load_dataframe` without compact dtypes, as they were
+    before raw files were typed, and their excluded columns are dropped.
+
+    Parameters
+    ----------
+    filePath : str
+        The path of the raw file. Currently supported types are ('csv', 'json', 'tsv').
+        Only delimited ('csv', 'tsv') files are typed while parsing.
+    exclude_columns : list (default=None)
+        Columns that are not read, e.g. ['Blank', 'Spl_characters_for_OK_stamp'].
+    typed : bool (default=True)
+        Parse the known numeric columns as numbers. Otherwise their dtypes are inferred,
+        as by `load_dataframe`, which accepts cells that are not numbers.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The parsed data.
+
+    Raises
+    ------
+    ValueError
+        If the file type is not supported, or a cell of a known numeric column of a
+        delimited file is not a number while `typed` is True.
+
+    """
+    if os.path.splitext(filePath)[1] not in ('.csv', '.tsv'):
+        loaded_data = load_dataframe(filePath, compact=False)
+        return loaded_data.drop(columns=[col for col in exclude_columns or [] if col in loaded_data.columns])
+
+    loaded_data = pd.read_csv(filePath, **get_raw_read_options(filePath, exclude_columns=exclude_columns, typed=typed))
+    record_io(rows_in=len(loaded_data), bytes_read=get_path_size(filePath))
+    if typed:
+        apply_schema(loaded_data, NUMERIC_COLUMN_DTYPES)
+    return loaded_data
+
+
+def iter_raw_dataframe(filePath, chunk_size, dtype=None, exclude_columns=None, typed=True):
+    """
+    Load a raw NSS file lazily in chunks of rows, typed while parsing as by `load_raw_dataframe`.
+
+    Numeric columns are cast to their compact dtypes chunk by chunk, so a column may get
+    another dtype, or other categories, in each chunk unless it is given in `dtype`.
+
+    Parameters
+    ----------
+    filePath : str
+        The path of the raw file. Currently supported types are ('csv', 'tsv').
+    chunk_size : int
+        Maximum number of rows in each chunk.
+    dtype : dict (default=None)
+        Column dtypes parsed as they are, e.g. the dtypes found for the whole file by a first pass.
+    exclude_columns, typed
+        Same as for `load_raw_dataframe`.
+
+    Returns
+    -------
+    Iterator[pandas.DataFrame]
+        Chunks of the file, in file order.
+
+    Raises
+    ------
+    ValueError
+        Same as for `load_raw_dataframe`, while iterating for cells that are not numbers.
+
+    """
+    chunks = pd.read_csv(filePath, chunksize=chunk_size,
+                         **get_raw_read_options(filePath, dtype, exclude_columns, typed))
+    record_io(bytes_read=get_path_size(filePath))
+    compact_dtypes = {col: col_dtype for col, col_dtype in NUMERIC_COLUMN_DTYPES.items()
+                      if col not in (dtype or {})}
+    if not typed or not compact_dtypes:
+        return chunks
+    return compact_chunks(chunks, compact_dtypes)
+
+
+def load_raw_increment(filePath, offset, exclude_columns=None, typed=True):
+    """
+    Load the rows appended to a raw NSS file after a byte offset, typed as by `load_raw_dataframe`.
+
+    Only complete lines are read, so a row that is still being written is left for the
+    next read. The rows are parsed with the header of the file.
+
+    Parameters
+    ----------
+    filePath : str
+        The path of the raw file. Currently supported types are ('csv', 'tsv').
+    offset : int
+        Byte offset of the first appended row, the end of the rows read before.
+    exclude_columns, typed
+        Same as for `load_raw_dataframe`.
+
+    Returns
+    -------
+    tuple
+        The appended rows, and the byte offset after the last complete line read.
+
+    Raises
+    ------
+    ValueError
+        Same as for `load_raw_dataframe`.
+
+    """
+    with open(filePath, 'rb') as f:
+        header = f.readline()
+        f.seek(offset)
+        data = f.read()
+    data = data[:data.rfind(b'\n') + 1]
+    loaded_data = pd.read_csv(io.BytesIO(header + data),
+                              **get_raw_read_options(filePath, exclude_columns=exclude_columns, typed=typed))
+    record_io(rows_in=len(loaded_data), bytes_read=len(data))
+    if typed:
+        apply_schema(loaded_data, NUMERIC_COLUMN_DTYPES)
+    return loaded_data, offset + len(data)
+
+
+def compact_chunks(chunks, schema):
+    """
+    Yields chunks cast to the compact dtypes of `schema`, see `apply_schema`.
+    """
+    for chunk in chunks:
+        apply_schema(chunk, schema)
+        yield chunk
+
+
+def get_raw_read_options(filePath, dtype=None, exclude_columns=None, typed=True):
+    """
+    Returns the `pd.read_csv` options of a raw NSS file, see `load_raw_dataframe`.
+    """
+    fileType = os.path.splitext(filePath)[1]
+    valid_filetypes = ('.csv', '.tsv')
+    if fileType not in valid_filetypes:
+        raise ValueError(
+            f'Invalid file type {fileType} for raw files. Allowed types are {valid_filetypes}')
+
+    exclude_columns = set(exclude_columns or [])
+    read_dtypes = {**RAW_COLUMN_DTYPES, **(dtype or {})} if typed else get_read_dtypes(dtype)
+    return {'sep': ',' if fileType == '.csv' else '\t',
+            'dtype': read_dtypes,
+            'usecols': lambda col: col not in exclude_columns,
+            'na_values': RAW_NA_VALUES}
+
+
+def iter_columnar(filePath, chunk_size, columns=None, start=0):
+    """
+    Load a columnar directory lazily in chunks of rows, see `iter_dataframe`.
+    """
+    nrows = read_columnar_meta(filePath)['nrows']
+    for chunk_start in range(start, nrows, chunk_size):
+        yield read_columnar(filePath, columns=columns, start=chunk_start, stop=chunk_start + chunk_size)
+
+
+def iter_partitioned(dataset_dir, chunk_size, dtype=None, columns=None, start=0, filters=None):
+    """
+    Load the parts of a partitioned dataset lazily in chunks of rows, see `iter_dataframe`.
+    """
+    for part_file in list_partition_files(dataset_dir, filters):
+        if start:
+            rows = count_rows(part_file)
+            if start >= rows:
+                start -= rows
+                continue
+        yield from iter_dataframe(part_file, chunk_size, dtype, columns, start)
+        start = 0
+
+
+def count_rows(filePath):
+    """
+    Returns the number of rows of a columnar directory or a delimited file, without loading it.
+    """
+    if os.path.splitext(filePath)[1] == '.col':
+        return read_columnar_meta(filePath)['nrows']
+    with open(filePath, 'rb') as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+
+def get_stored_columns(filePath):
+    """
+    Returns the column names of a columnar directory or a delimited file, without loading it.
+    """
+    if os.path.splitext(filePath)[1] == '.col':
+        return [column_meta['name'] for column_meta in read_columnar_meta(filePath)['columns']]
+    return list(pd.read_csv(filePath, sep=',' if filePath.endswith('.csv') else '\t', nrows=0).columns)
+
+
+def iter_json_records(filePath, offset=0):
+    """
+    Load the records of a merged JSON file one at a time, without parsing them.
+
+    The file must have the layout of `write_merged_json`, with one record per line.
+
+    Parameters
+    ----------
+    filePath : str
+        The path of the merged JSON file.
+    offset : int (default=0)
+        Byte offset of the first record to load, as yielded for the previous record.
+        The first record is loaded if 0.
+
+    Returns
+    -------
+    Iterator[tuple]
+        The JSON string of each record, and the byte offset of the record after it.
+
+    Raises
+    ------
+    ValueError
+        If `offset` is not the start of a record.
+
+    """
+    with open(filePath, 'rb') as f:
+        if offset:
+            f.seek(offset - 1)
+            if f.read(1) != b'\n':
+                raise ValueError(f'Invalid offset {offset} in {filePath}')
+        else:
+            # Skip the schema line
+            f.readline()
+        for line in f:
+            if line.startswith(b']'):
+                return
+            yield line.rstrip(b'\r\n').rstrip(b',').decode('utf-8'), f.tell()
+
+
+def estimate_chunk_rows(filePath, max_memory_mb, overhead=4, sample_rows=1000):
+    """
+    Estimate how many rows of a file can be processed at once within a memory budget.
+
+    Parameters
+    ----------
+    filePath : str
+        The path of the delimited file to be processed.
+    max_memory_mb : int or float
+        Memory budget for one chunk, in megabytes.
+    overhead : int (default=4)
+        Number of working copies of a chunk expected to be alive at once while processing it.
+    sample_rows : int (default=1000)
+        Number of leading rows used to measure the in-memory size of a row.
 
-def write_file(input_df, output_file, output_type):
+    Returns
+    -------
+    int
+        Number of rows per chunk (at least `sample_rows`).
+    """
+    sample_df = next(iter(iter_dataframe(filePath, sample_rows)))
+    row_bytes = sample_df.memory_usage(index=True, deep=True).sum() / max(len(sample_df), 1)
+    chunk_rows = int(max_memory_mb * 1024 * 1024 / (row_bytes * overhead))
+    return max(chunk_rows, sample_rows)
+
+
+def write_file(input_df, output_file, output_type, append=False):
     """
     Write a given DataFrame to a file in the specified format.
 
@@ -85,7 +667,9 @@ def write_file(input_df, output_file, output_type):
     output_file : str
         The path of the output file where the data will be saved.
     output_type : str
-        The type of the output file. Currently supports only 'tsv'.
+        The type of the output file. Currently supports 'col' (typed columnar directory) and 'tsv'.
+    append : bool (default=False)
+        Append rows (without a header) to an existing file instead of overwriting it.
 
     Raises
     ------
@@ -93,9 +677,502 @@ def write_file(input_df, output_file, output_type):
         If the `output_type` is not a valid file type.
 
     """
-    valid_filetypes = ('tsv')
-    if output_type == 'tsv':
-        input_df.to_csv(output_file, sep="\t", index=False)
+    valid_filetypes = ('col', 'tsv')
+    size_before = get_path_size(output_file) if append else 0
+    if output_type == 'col':
+        write_columnar(input_df, output_file, append=append)
+    elif output_type == 'tsv':
+        if append:
+            input_df.to_csv(output_file, sep="\t", index=False,
+                            mode='a', header=False)
+        else:
+            input_df.to_csv(output_file, sep="\t", index=False)
     else:
         raise ValueError(f'Invalid file type {output_type}. Allowed types are{
                          valid_filetypes}')
+    record_io(bytes_written=get_path_size(output_file) - size_before)
+
+
+def write_stage_output(input_df, output_file, append=False):
+    """
+    Write the output of a pipeline stage in the format given by the file extension.
+    A TSV copy is exported next to it when `config.EXPORT_TSV` is set.
+
+    Parameters
+    ----------
+    input_df : pandas.DataFrame
+        The DataFrame to be written.
+    output_file : str
+        The path of the output file, e.g. `config.MERGED_TABLE_PATH`.
+    append : bool (default=False)
+        Append rows to existing outputs instead of overwriting them.
+
+    """
+    base_path, extension = os.path.splitext(output_file)
+    output_type = extension[1:]
+    record_io(rows_out=len(input_df))
+    write_file(input_df, output_file, output_type, append=append)
+    if config.EXPORT_TSV and output_type != 'tsv':
+        write_file(input_df, base_path + '.tsv', 'tsv', append=append)
+
+
+def is_partitioned(filePath):
+    """
+    Returns True if the path is a partitioned dataset, a directory without a file extension.
+    """
+    return os.path.isdir(filePath) and not os.path.splitext(filePath)[1]
+
+
+def format_partition_value(value):
+    """
+    Returns the string a value of a partition column is stored as in directory names.
+    """
+    if pd.isna(value):
+        return NULL_PARTITION
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        value = int(value)
+    return str(value)
+
+
+def get_partition_dir(dataset_dir, partition_by, values):
+    """
+    Returns the directory of a partition, e.g. '<dataset_dir>/State=MEGHALAYA/Round=68'.
+    """
+    return os.path.join(dataset_dir, *(f'{col}={quote(format_partition_value(value), safe=" ")}'
+                                       for col, value in zip(partition_by, values)))
+
+
+def write_partitioned(input_df, dataset_dir, partition_by, part_name, append=False):
+    """
+    Write the rows of a DataFrame to a partitioned dataset.
+
+    Rows are grouped by the values of the partition columns, and each group is written
+    with `write_stage_output` to a part file named `part_name` in the directory of its
+    partition, e.g. 'State=MEGHALAYA/Round=68/<part_name>.col'. The partition columns are
+    kept in the part files. Several writers, e.g. one per raw file, share a dataset by
+    writing parts of different names.
+
+    Parameters
+    ----------
+    input_df : pandas.DataFrame
+        The DataFrame to be written.
+    dataset_dir : str
+        The path of the dataset directory.
+    partition_by : list
+        Columns the rows are partitioned by, outermost first.
+    part_name : str
+        Name of the part files, without extension.
+    append : bool (default=False)
+        Append the rows to the existing parts of that name instead of overwriting them.
+
+    Returns
+    -------
+    dict
+        Number of rows written to each partition, by partition directory relative to `dataset_dir`.
+
+    Raises
+    ------
+    ValueError
+        If a partition column is missing from `input_df`.
+
+    """
+    missing = [col for col in partition_by if col not in input_df.columns]
+    if missing:
+        raise ValueError(f'Partition columns {missing} not found in data')
+
+    written = {}
+    for values, part_df in input_df.groupby(list(partition_by), dropna=False, observed=True, sort=True):
+        partition_dir = get_partition_dir(dataset_dir, partition_by, values)
+        os.makedirs(partition_dir, exist_ok=True)
+        part_file = get_part_file(partition_dir, part_name)
+        write_stage_output(part_df, part_file, append=append and os.path.exists(part_file))
+        written[os.path.relpath(partition_dir, dataset_dir)] = len(part_df)
+    return written
+
+
+def get_part_file(partition_dir, part_name):
+    """
+    Returns the path of a part file of a partition, in `config.INTERMEDIATE_FORMAT`.
+    """
+    return os.path.join(partition_dir, f'{part_name}.{config.INTERMEDIATE_FORMAT}')
+
+
+def list_partition_files(dataset_dir, filters=None):
+    """
+    Returns the part files of a partitioned dataset, ordered by partition then part name.
+
+    A part stored in several formats, e.g. with its TSV copy, is listed once, columnar first.
+
+    Parameters
+    ----------
+    dataset_dir : str
+        The path of the dataset directory.
+    filters : dict (default=None)
+        Values to keep for some partition columns, e.g. {'State': ['MEGHALAYA'], 'Round': [68]}.
+        Partitions of other values are not read. All partitions are listed if not specified.
+
+    Returns
+    -------
+    list
+        Paths of the part files.
+
+    Raises
+    ------
+    ValueError
+        If a column of `filters` is not a partition column of the dataset.
+
+    """
+    filters = {col: {format_partition_value(value) for value in values}
+               for col, values in (filters or {}).items()}
+    partition_columns = set()
+    part_files = []
+    for root, dirs, files in os.walk(dataset_dir):
+        partitions = [name for name in dirs if '=' in name]
+        parts = {}
+        for name in sorted(set(dirs) - set(partitions)) + sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension in PART_EXTENSIONS:
+                parts.setdefault(stem, os.path.join(root, name))
+        part_files += [parts[stem] for stem in sorted(parts)]
+
+        dirs[:] = []
+        for name in sorted(partitions):
+            col, value = name.split('=', 1)
+            partition_columns.add(col)
+            if col not in filters or unquote(value) in filters[col]:
+                dirs.append(name)
+
+    unknown = [col for col in filters if col not in partition_columns]
+    if unknown and partition_columns:
+        raise ValueError(
+            f'Invalid partition columns {unknown}. Partition columns are {sorted(partition_columns)}')
+    return part_files
+
+
+def remove_partition_parts(dataset_dir, part_names=None, keep=None, remove_empty=True):
+    """
+    Remove the part files named in `part_names` from every partition of a dataset, or
+    the parts not named in `keep`, with their copies in other formats. Partitions left
+    without parts are removed with `remove_empty`, which is not safe while other writers
+    add parts to the dataset.
+    """
+    partition_dirs = []
+    for root, dirs, files in os.walk(dataset_dir):
+        for name in dirs + files:
+            stem, extension = os.path.splitext(name)
+            if extension not in PART_EXTENSIONS:
+                continue
+            if (part_names is not None and stem in part_names) or (keep is not None and stem not in keep):
+                path = os.path.join(root, name)
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+        dirs[:] = [name for name in dirs if '=' in name]
+        partition_dirs.append(root)
+
+    if not remove_empty:
+        return
+    # Innermost partitions first
+    for partition_dir in reversed(partition_dirs[1:]):
+        if not os.listdir(partition_dir):
+            os.rmdir(partition_dir)
+
+
+def find_files(patterns, base_dir):
+    """
+    Returns the files matching file names or glob patterns, in sorted order without duplicates.
+
+    Parameters
+    ----------
+    patterns : str or list
+        File name or glob pattern, e.g. 'Block_4_*.tsv', or a list of them. Relative
+        patterns are relative to `base_dir`.
+    base_dir : str
+        The directory of relative patterns, e.g. `config.RAW_DATA_DIR`.
+
+    Returns
+    -------
+    list
+        Paths of the matching files.
+
+    Raises
+    ------
+    FileNotFoundError
+        If a pattern matches no file.
+
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    files = set()
+    for pattern in patterns:
+        matches = [path for path in glob.glob(os.path.join(base_dir, pattern)) if os.path.isfile(path)]
+        if not matches:
+            raise FileNotFoundError(f'No file matches {pattern} in {base_dir}')
+        files.update(matches)
+    return sorted(files)
+
+
+def write_merged_json(households_df, demographic_df, expenditure_df, output_file, batch_size=10000, index_file=None):
+    """
+    Stream nested merged data to a JSON file, one household at a time.
+
+    The file has the `orient='table'` layout read by `load_merged_data`: a schema and a
+    `data` list with one record per household, holding its persons under
+    'Demographic_Data' and its expenditure items under 'Expenditure_Data'. Each household
+    record is written on its own line. All frames are sorted by HHID, so the records of a
+    batch of households are contiguous slices that are serialized in bulk.
+
+    Parameters
+    ----------
+    households_df : pandas.DataFrame
+        Household level columns, one row per household.
+    demographic_df : pandas.DataFrame
+        Demographic data with household level columns removed (except HHID).
+    expenditure_df : pandas.DataFrame
+        Expenditure data with household level columns removed (except HHID).
+    output_file : str
+        The path of the output JSON file.
+    batch_size : int (default=10000)
+        Number of households serialized at once, which bounds the extra memory used.
+    index_file : str (default=None)
+        Path of a `.npy` index of the byte offset and length of each household record,
+        sorted by HHID, as read by `load_households`. Not written if not specified.
+
+    """
+    households_df = sort_by_column(households_df, 'HHID')
+    nested_dfs = {'Demographic_Data': sort_by_column(demographic_df, 'HHID'),
+                  'Expenditure_Data': sort_by_column(expenditure_df, 'HHID')}
+    nested_keys = {name: df['HHID'].to_numpy()
+                   for name, df in nested_dfs.items()}
+
+    # Categorical columns are described as plain strings
+    schema_df = households_df.head(0).astype(
+        {col: object for col, dtype in households_df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)})
+    schema_df = schema_df.assign(
+        **{name: pd.Series(dtype=object) for name in nested_dfs})
+    schema = pd.io.json.build_table_schema(schema_df, index=False)
+
+    offsets = np.empty(len(households_df), dtype=np.int64)
+    lengths = np.empty(len(households_df), dtype=np.int64)
+
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(('{"schema":' + json.dumps(schema,
+                 separators=(',', ':')) + ',"data":[').encode('utf-8'))
+        separator = b'\n'
+        for start in range(0, len(households_df), batch_size):
+            batch_df = households_df.iloc[start:start + batch_size]
+            hhids = batch_df['HHID'].to_numpy()
+
+            # Slice and serialize the nested records of the whole batch at once
+            nested_parts = []
+            for name, df in nested_dfs.items():
+                lower = np.searchsorted(nested_keys[name], hhids, side='left')
+                upper = np.searchsorted(nested_keys[name], hhids, side='right')
+                records = to_json_lines(
+                    df.iloc[lower[0]:upper[-1]].drop(columns='HHID'))
+                nested_parts.append(
+                    (name, records, lower - lower[0], upper - lower[0]))
+
+            for position, household in enumerate(to_json_lines(batch_df)):
+                nested_json = ''.join(f',"{name}":[' + ','.join(records[lower[position]:upper[position]]) + ']'
+                                      for name, records, lower, upper in nested_parts)
+                record = (household[:-1] + nested_json + '}').encode('utf-8')
+                f.write(separator)
+                offsets[start + position] = f.tell()
+                lengths[start + position] = len(record)
+                f.write(record)
+                separator = b',\n'
+        f.write(b'\n]}')
+
+    if index_file is not None:
+        hhids = households_df['HHID'].to_numpy()
+        index = np.empty(len(hhids), dtype=[('HHID', hhids.dtype if hhids.dtype != object else str(hhids.astype(str).dtype)),
+                                            ('offset', np.int64), ('length', np.int64)])
+        index['HHID'] = hhids
+        index['offset'] = offsets
+        index['length'] = lengths
+        with open(index_file + '.tmp', 'wb') as index_f:
+            np.save(index_f, index)
+        os.replace(index_file + '.tmp', index_file)
+        record_io(bytes_written=os.path.getsize(index_file))
+    os.replace(tmp_file, output_file)
+    record_io(bytes_written=os.path.getsize(output_file))
+
+
+def concat_merged_json(parts, output_file, index_file=None):
+    """
+    Concatenate merged JSON files written by `write_merged_json` into one, e.g. the
+    outputs of a partitioned merge. Records are copied as bytes, in the order of the parts.
+
+    Parameters
+    ----------
+    parts : list
+        List of (JSON file, index file) tuples. The schema of the first part is kept.
+    output_file : str
+        The path of the output JSON file.
+    index_file : str (default=None)
+        Path of the index of the output file, sorted by HHID, as read by `load_households`.
+        The parts must have index files if specified.
+
+    """
+    footer = b'\n]}'
+    indexes = []
+    written = False
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        for position, (part_file, part_index_file) in enumerate(parts):
+            with open(part_file, 'rb') as part:
+                # The header is the first line, each record starts on a new line
+                header = part.readline()[:-1]
+                body_size = os.path.getsize(part_file) - len(header) - len(footer)
+                if position == 0:
+                    f.write(header)
+                if body_size <= 0:
+                    continue
+                if written:
+                    f.write(b',')
+                written = True
+                shift = f.tell() - len(header)
+                part.seek(len(header))
+                remaining = body_size
+                while remaining:
+                    block = part.read(min(remaining, 1 << 20))
+                    f.write(block)
+                    remaining -= len(block)
+            if index_file is not None:
+                part_index = np.load(part_index_file)
+                part_index['offset'] += shift
+                indexes.append(part_index)
+        f.write(footer)
+
+    if index_file is not None:
+        index = np.concatenate(indexes) if indexes else np.load(parts[0][1])
+        index = index[np.argsort(index['HHID'], kind='stable')]
+        with open(index_file + '.tmp', 'wb') as index_f:
+            np.save(index_f, index)
+        os.replace(index_file + '.tmp', index_file)
+        record_io(bytes_written=os.path.getsize(index_file))
+    os.replace(tmp_file, output_file)
+    record_io(bytes_written=os.path.getsize(output_file))
+
+
+def append_merged_json(part_file, output_file, part_index_file=None, index_file=None):
+    """
+    Append the records of a merged JSON file written by `write_merged_json` to another one
+    in place, e.g. the households of an incremental merge. Only the footer of the output
+    file is rewritten, the records of the part are copied after its last record.
+
+    Parameters
+    ----------
+    part_file : str
+        The path of the JSON file whose records are appended. Its schema is not checked.
+    output_file : str
+        The path of the JSON file the records are appended to.
+    part_index_file : str (default=None)
+        Path of the index of the part file.
+    index_file : str (default=None)
+        Path of the index of the output file, sorted by HHID, as read by `load_households`.
+        The appended records are merged into it if specified.
+
+    Raises
+    ------
+    ValueError
+        If the output file does not end with the footer written by `write_merged_json`.
+
+    """
+    footer = b'\n]}'
+    with open(part_file, 'rb') as part:
+        header = part.readline()[:-1]
+        body_size = os.path.getsize(part_file) - len(header) - len(footer)
+        if body_size <= 0:
+            return
+        with open(output_file, 'r+b') as f:
+            f.seek(-len(footer), os.SEEK_END)
+            if f.read() != footer:
+                raise ValueError(f'{output_file} is not a merged JSON file')
+            f.seek(-len(footer), os.SEEK_END)
+            # A file without records ends its header with the opening bracket of the list
+            f.seek(-1, os.SEEK_CUR)
+            has_records = f.read(1) != b'['
+            if has_records:
+                f.write(b',')
+            shift = f.tell() - len(header)
+            part.seek(len(header))
+            remaining = body_size
+            while remaining:
+                block = part.read(min(remaining, 1 << 20))
+                f.write(block)
+                remaining -= len(block)
+            f.write(footer)
+            f.truncate()
+    record_io(bytes_written=body_size + len(footer) + 1)
+
+    if index_file is not None:
+        part_index = np.load(part_index_file)
+        part_index['offset'] += shift
+        index = np.concatenate([np.load(index_file), part_index])
+        index = index[np.argsort(index['HHID'], kind='stable')]
+        with open(index_file + '.tmp', 'wb') as index_f:
+            np.save(index_f, index)
+        os.replace(index_file + '.tmp', index_file)
+        record_io(bytes_written=os.path.getsize(index_file))
+
+
+def load_households(hhids, index_file=None, data_file=None):
+    """
+    Load the merged records of households by HHID, seeking straight to each record.
+
+    Parameters
+    ----------
+    hhids : list
+        HHIDs of the households to load.
+    index_file : str (default=None)
+        Path of the index written by `write_merged_json`. Defaults to `config.MERGED_INDEX_PATH`.
+    data_file : str (default=None)
+        Path of the merged JSON file. Defaults to `config.MERGED_JSON_PATH`.
+
+    Returns
+    -------
+    dict
+        JSON string of the record of each household found, keyed by the requested HHID.
+
+    Raises
+    ------
+    ValueError
+        If an HHID does not have the type of the indexed HHIDs, or the index does not match the data file.
+
+    """
+    index = np.load(index_file or config.MERGED_INDEX_PATH, mmap_mode='r')
+    keys = index['HHID']
+    try:
+        requested = np.asarray(hhids).astype(keys.dtype)
+    except ValueError:
+        raise ValueError(f'Invalid HHIDs {hhids}. Expected values of type {keys.dtype}')
+    positions = np.minimum(np.searchsorted(keys, requested), max(len(keys) - 1, 0))
+
+    households = {}
+    with open(data_file or config.MERGED_JSON_PATH, 'rb') as f:
+        for hhid, key, position in zip(hhids, requested, positions):
+            if len(keys) == 0 or keys[position] != key:
+                continue
+            f.seek(int(index['offset'][position]))
+            record = f.read(int(index['length'][position]))
+            if not (record.startswith(b'{') and record.endswith(b'}')):
+                raise ValueError('The household index does not match the merged data file')
+            households[hhid] = record.decode('utf-8')
+    return households
+
+
+def to_json_lines(df):
+    """
+    Returns the rows of a DataFrame as a list of JSON object strings.
+    """
+    if len(df) == 0:
+        return []
+    return df.to_json(orient='records', lines=True).rstrip('\n').split('\n')
+
+
+def sort_by_column(df, column):
+    """
+    Returns the DataFrame stably sorted by a column, keeping the original order within equal values.
+    """
+    return df.iloc[np.argsort(df[column].to_numpy(), kind='stable')]
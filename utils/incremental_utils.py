@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+
+import config
+from utils.cache_utils import file_signature
+
+
+class IncrementConflictError(ValueError):
+    """
+    Raised when appended rows cannot be folded into the outputs of the previous runs,
+    e.g. they add rows to an already merged household. The pipeline then runs in full.
+    """
+
+
+def get_increment_path(name):
+    """
+    Returns the path of an intermediate output of incremental runs, e.g. 'merged_increment.col'.
+    """
+    return os.path.join(config.INCREMENTAL_DIR, f'{name}.{config.INTERMEDIATE_FORMAT}')
+
+
+def load_incremental_state():
+    """
+    Load the state recorded by the last incremental run.
+
+    Returns
+    -------
+    dict or None
+        The state, None if no incremental run has completed.
+    """
+    if not os.path.exists(config.INCREMENTAL_STATE_PATH):
+        return None
+    with open(config.INCREMENTAL_STATE_PATH) as f:
+        return json.load(f)
+
+
+def save_incremental_state(state):
+    """
+    Save the state of an incremental run.
+    """
+    os.makedirs(config.INCREMENTAL_DIR, exist_ok=True)
+    tmp_path = config.INCREMENTAL_STATE_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, config.INCREMENTAL_STATE_PATH)
+
+
+def clear_incremental_state():
+    """
+    Forget the last incremental run, e.g. before its outputs are modified, so a failed
+    run is never taken as the start of the next one.
+    """
+    if os.path.exists(config.INCREMENTAL_STATE_PATH):
+        os.remove(config.INCREMENTAL_STATE_PATH)
+
+
+def get_file_marks(path, offset=None):
+    """
+    Returns the marks of the rows of a raw file read so far: their end offset and hashes of
+    the header line and of the `config.INCREMENTAL_TAIL_BYTES` bytes before the offset.
+
+    Parameters
+    ----------
+    path : str
+        Path of the raw file.
+    offset : int (default=None)
+        Byte offset after the last row read. Defaults to the size of the file.
+
+    Returns
+    -------
+    dict
+        The path, 'offset', 'header' and 'tail' of the file.
+    """
+    offset = os.path.getsize(path) if offset is None else offset
+    tail_start = max(offset - config.INCREMENTAL_TAIL_BYTES, 0)
+    with open(path, 'rb') as f:
+        header = hashlib.sha256(f.readline()).hexdigest()
+        f.seek(tail_start)
+        tail = hashlib.sha256(f.read(offset - tail_start)).hexdigest()
+    return {'path': path, 'offset': offset, 'header': header, 'tail': tail}
+
+
+def is_appended(path, marks):
+    """
+    Returns True if a raw file still holds the rows described by `marks`, with rows only
+    appended after them. Rewritten, truncated or replaced files need a full run.
+    """
+    if marks is None or marks['path'] != path or not os.path.exists(path):
+        return False
+    if os.path.getsize(path) < marks['offset']:
+        return False
+    return get_file_marks(path, marks['offset']) == marks
+
+
+def get_output_signatures(paths):
+    """
+    Returns the signature of each output appended to by incremental runs, see `file_signature`.
+    Outputs rewritten by another run no longer match the signatures recorded by the last incremental run.
+    """
+    return {path: file_signature(path) for path in paths}
@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+import threading
+import time
+import uuid
+
+from utils.logger_utils import get_logger
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue holds its maximum number of pending jobs.
+    """
+
+
+class JobQueue:
+    """
+    Runs submitted jobs in the background and keeps their status.
+
+    Jobs run one at a time on a single worker thread, since every pipeline run writes
+    the same output files. A job submitted with the same parameters as a queued or
+    running job is merged into that job.
+
+    Parameters
+    ----------
+    func : callable
+        Function running a job. It is called with the job parameters as keyword arguments
+        and a `progress` callback taking a stage name, its status and its seconds.
+    max_pending : int
+        Maximum number of jobs waiting to run. Further submissions raise `QueueFullError`.
+    history_size : int
+        Number of finished jobs whose status is kept.
+    """
+
+    def __init__(self, func, max_pending, history_size):
+        self.func = func
+        self.max_pending = max_pending
+        self.history_size = history_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='pipeline-job')
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._in_flight = {}
+
+    def submit(self, params):
+        """
+        Queues a job, or returns the queued or running job with the same parameters.
+
+        Parameters
+        ----------
+        params : dict
+            Keyword arguments of the job function.
+
+        Returns
+        -------
+        tuple
+            Status of the job, and True if it was merged into an existing job.
+
+        Raises
+        ------
+        QueueFullError
+            If `max_pending` jobs are already waiting to run.
+        """
+        key = json.dumps(params, sort_keys=True, default=repr)
+        with self._lock:
+            if key in self._in_flight:
+                return copy.deepcopy(self._jobs[self._in_flight[key]]), True
+
+            pending = sum(
+                1 for job in self._jobs.values() if job['status'] == 'queued')
+            if pending >= self.max_pending:
+                raise QueueFullError(
+                    f'{pending} jobs are waiting to run. Retry later.')
+
+            job = {
+                'job_id': uuid.uuid4().hex,
+                'status': 'queued',
+                'params': params,
+                'running_stages': [],
+                'stages': {},
+                'result': None,
+                'error': None,
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+            }
+            self._jobs[job['job_id']] = job
+            self._in_flight[key] = job['job_id']
+            self._evict()
+
+        self._executor.submit(self._run, job['job_id'], key)
+        return copy.deepcopy(job), False
+
+    def get(self, job_id):
+        """
+        Returns the status of a job, or None if it is unknown.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job else None
+
+    def list(self):
+        """
+        Returns the status of all known jobs, oldest first.
+        """
+        with self._lock:
+            return [copy.deepcopy(job) for job in self._jobs.values()]
+
+    def _run(self, job_id, key):
+        logger = get_logger(__name__)
+
+        with self._lock:
+            job = self._jobs[job_id]
+            job['status'] = 'running'
+            job['started_at'] = time.time()
+            params = job['params']
+
+        try:
+            result = self.func(**params,
+                               progress=lambda stage, status, seconds: self._progress(job_id, stage, status, seconds))
+            status, error = 'completed', None
+        except Exception as e:
+            logger.error(f'Job {job_id} failed: {e}')
+            result, status, error = None, 'failed', str(e)
+
+        with self._lock:
+            job['status'] = status
+            job['result'] = result
+            job['error'] = error
+            job['running_stages'] = []
+            job['finished_at'] = time.time()
+            self._in_flight.pop(key, None)
+
+    def _progress(self, job_id, stage, status, seconds):
+        with self._lock:
+            job = self._jobs[job_id]
+            job['stages'][stage] = {'status': status, 'seconds': seconds}
+            if status == 'running':
+                job['running_stages'].append(stage)
+            elif stage in job['running_stages']:
+                job['running_stages'].remove(stage)
+
+    def _evict(self):
+        """
+        Forgets the oldest finished jobs beyond `history_size`.
+        """
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job['status'] in ('completed', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.history_size)]:
+            del self._jobs[job_id]
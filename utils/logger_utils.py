@@ -12,12 +12,18 @@ def get_now_date_time():
     return dt_string
 
 
-def configure_logger():
+def configure_logger(log_file=None):
     """
-    Run basic configuration of logger.
+    Run basic configuration of logger, and return the path of the log file.
+    Worker processes pass the path of the main process, so they log to the same file.
     """
-    logging.basicConfig(filename=f'logs/pipeline_{get_now_date_time()}.log',
+    log_file = log_file or f'logs/pipeline_{get_now_date_time()}.log'
+    logging.basicConfig(filename=log_file,
                         encoding='utf-8', format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.baseFilename
+    return log_file
 
 
 def get_logger(name, level='debug'):
@@ -0,0 +1,282 @@
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import functools
+import json
+import os
+import pstats
+import resource
+import shutil
+import sys
+import threading
+import time
+
+import config
+import pandas as pd
+
+
+# Measurements open in each thread, innermost last, so requests served while a
+# pipeline job runs are not counted in its stages
+_local = threading.local()
+# Whether outer measurements reset the peak RSS of this process, see `enable_peak_rss_reset`
+_peak_rss_reset = False
+
+
+def get_active_measurements():
+    """
+    Returns the measurements open in the current thread, innermost last.
+    """
+    if not hasattr(_local, 'active'):
+        _local.active = []
+    return _local.active
+
+
+@contextmanager
+def measure(name):
+    """
+    Measures the block as a stage: wall time, CPU time, rows and bytes read and written,
+    and peak RSS of the process. CPU time includes the child processes that exited in
+    the block, such as chart rendering workers.
+
+    Rows and bytes are counted by `record_io` calls made in the block, and the cleaning
+    steps decorated with `measure_step` are recorded under 'steps'. In processes that only
+    run pipeline stages, the peak RSS is reset at the start of an outer measurement where
+    the platform allows it, see `enable_peak_rss_reset`. Elsewhere it is the peak of the
+    process so far.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+
+    Returns
+    -------
+    dict
+        The metrics of the block, filled in when the block exits.
+    """
+    active = get_active_measurements()
+    if not active and _peak_rss_reset:
+        reset_peak_rss()
+    metrics = {'name': name, 'wall_seconds': 0, 'cpu_seconds': 0, 'rows_in': 0, 'rows_out': 0,
+               'bytes_read': 0, 'bytes_written': 0, 'peak_rss_mb': 0, 'steps': {}}
+    active.append(metrics)
+    start_wall, start_cpu = time.perf_counter(), get_cpu_seconds()
+    try:
+        yield metrics
+    finally:
+        active.remove(metrics)
+        metrics['wall_seconds'] = round(time.perf_counter() - start_wall, 4)
+        metrics['cpu_seconds'] = round(get_cpu_seconds() - start_cpu, 4)
+        metrics['peak_rss_mb'] = round(get_peak_rss_mb(), 2)
+        for step in metrics['steps'].values():
+            step['wall_seconds'] = round(step['wall_seconds'], 4)
+            step['cpu_seconds'] = round(step['cpu_seconds'], 4)
+
+
+def record_io(rows_in=0, rows_out=0, bytes_read=0, bytes_written=0):
+    """
+    Adds rows and bytes read or written to the open measurements. Does nothing outside of one.
+    """
+    for metrics in get_active_measurements():
+        metrics['rows_in'] += rows_in
+        metrics['rows_out'] += rows_out
+        metrics['bytes_read'] += bytes_read
+        metrics['bytes_written'] += bytes_written
+
+
+def measure_step(func):
+    """
+    Decorator recording the calls of a cleaning step in the innermost open measurement.
+
+    The step function takes a dataframe as first argument. Rows out are counted from the
+    returned dataframe, or from the argument for steps that modify it in place.
+    """
+    @functools.wraps(func)
+    def wrapper(df, *args, **kwargs):
+        active = get_active_measurements()
+        if not active:
+            return func(df, *args, **kwargs)
+
+        rows_in = len(df)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        result = func(df, *args, **kwargs)
+        output = result[0] if isinstance(result, tuple) else result
+        rows_out = len(output) if isinstance(output, pd.DataFrame) else len(df)
+
+        step = active[-1]['steps'].setdefault(func.__name__, {
+            'calls': 0, 'wall_seconds': 0, 'cpu_seconds': 0, 'rows_in': 0, 'rows_out': 0})
+        step['calls'] += 1
+        step['wall_seconds'] += time.perf_counter() - start_wall
+        step['cpu_seconds'] += time.process_time() - start_cpu
+        step['rows_in'] += rows_in
+        step['rows_out'] += rows_out
+        return result
+    return wrapper
+
+
+def run_measured(name, func, args, profile_file=None):
+    """
+    Runs a stage function in a measurement, optionally under cProfile.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    func : callable
+        Stage function.
+    args : tuple
+        Arguments of `func`.
+    profile_file : str (default=None)
+        Path of the cProfile statistics of the stage. The stage is not profiled if not specified.
+
+    Returns
+    -------
+    tuple
+        The result of `func` and the metrics of the stage.
+    """
+    profiler = cProfile.Profile() if profile_file else None
+    with measure(name) as metrics:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result = func(*args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    if profiler is not None:
+        os.makedirs(os.path.dirname(profile_file), exist_ok=True)
+        profiler.dump_stats(profile_file)
+        metrics['profile_file'] = profile_file
+        metrics['top_functions'] = get_top_functions(profiler)
+    return result, metrics
+
+
+def get_top_functions(profiler, count=20):
+    """
+    Returns the functions of a profile with the highest cumulative time.
+    """
+    stats = pstats.Stats(profiler)
+    functions = []
+    for (file, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+        functions.append({'function': f'{function} ({file}:{line})', 'calls': calls,
+                          'total_seconds': round(total, 4), 'cumulative_seconds': round(cumulative, 4)})
+    functions.sort(key=lambda item: item['cumulative_seconds'], reverse=True)
+    return functions[:count]
+
+
+def get_cpu_seconds():
+    """
+    Returns the user and system CPU time of this process and its exited child processes.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def enable_peak_rss_reset():
+    """
+    Lets outer measurements reset the peak RSS of this process, so each stage reports its own peak.
+
+    Only call it in processes that run nothing but pipeline stages, such as the pipeline
+    command line and its worker processes. The reset clears the peak of the whole process,
+    so in the API server it would also clear the memory used by other requests and jobs.
+    """
+    global _peak_rss_reset
+    _peak_rss_reset = True
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of this process, on Linux. Elsewhere the peak covers the whole process lifetime.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident memory of this process since the last reset, in MB.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def get_path_size(path):
+    """
+    Returns the size of a file, or of all files in a directory, in bytes. 0 if the path does not exist.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, file))
+                   for root, _, files in os.walk(path) for file in files)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def new_run_id():
+    """
+    Returns the id of a new pipeline run, which sorts in start order.
+    """
+    return datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+
+def write_run_report(report):
+    """
+    Writes the JSON report of a run to `config.METRICS_DIR` and removes the oldest
+    reports, with their profiles, beyond `config.METRICS_HISTORY_SIZE`.
+
+    Returns
+    -------
+    str
+        The path of the report.
+    """
+    os.makedirs(config.METRICS_DIR, exist_ok=True)
+    report_file = os.path.join(config.METRICS_DIR, f"run_{report['run_id']}.json")
+    with open(report_file + '.tmp', 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(report_file + '.tmp', report_file)
+
+    for run_id in list_run_ids()[config.METRICS_HISTORY_SIZE:]:
+        os.remove(os.path.join(config.METRICS_DIR, f'run_{run_id}.json'))
+        shutil.rmtree(os.path.join(config.METRICS_DIR, run_id), ignore_errors=True)
+    return report_file
+
+
+def list_run_ids():
+    """
+    Returns the ids of the runs with a report, newest first.
+    """
+    if not os.path.isdir(config.METRICS_DIR):
+        return []
+    return sorted((file[len('run_'):-len('.json')] for file in os.listdir(config.METRICS_DIR)
+                   if file.startswith('run_') and file.endswith('.json')), reverse=True)
+
+
+def load_run_report(run_id):
+    """
+    Returns the report of a run, or None if it is unknown.
+    """
+    report_file = os.path.join(config.METRICS_DIR, f'run_{run_id}.json')
+    if os.path.basename(report_file) != f'run_{run_id}.json' or not os.path.exists(report_file):
+        return None
+    with open(report_file) as f:
+        return json.load(f)
+
+
+def summarize_run_report(report):
+    """
+    Returns the headline figures of a run report, with the wall time of each stage.
+    """
+    summary = {key: report.get(key) for key in ('run_id', 'started_at', 'status', 'action',
+                                                'wall_seconds', 'cpu_seconds', 'peak_rss_mb')}
+    summary['stages'] = {name: stage.get('wall_seconds')
+                         for name, stage in report.get('stages', {}).items()}
+    return summary
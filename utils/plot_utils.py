@@ -1,11 +1,28 @@
-import matplotlib.pyplot as plt
+import matplotlib
+from matplotlib.figure import Figure
 import config
 import numpy as np
+import os
 import pandas as pd
 import seaborn as sns
 
 from utils.dataframe_utils import drop_unknown, drop_indexes
 
+# pandas and seaborn import pyplot; keep it on the non-interactive backend in every process
+matplotlib.use('Agg')
+
+# Columns of the merged data used by the charts
+CHART_COLUMNS = {
+    'Demographic_Data': ['State', 'Sex', 'Age', 'General_Education', 'MGNREG_jobcard', 'MGNREG_work'],
+    'Expenditure_Data': ['State', 'Item_Group_Srl_No', 'Value_of_Consumption_Last_30_Day'],
+}
+
+# Order of literacy levels in the stacked histogram
+LITERACY_LEVELS = ['Not literate', 'Literate without formal schooling: egs/ nfec/ aec',
+                   'Literate: below primary', 'Literate: primary', 'Literate: middle',
+                   'Literate: secondary', 'Literate: higher secondary', 'Literate: graduate',
+                   'Literate: diploma/certificate course']
+
 
 def get_visualization(filepath):
     """
@@ -15,27 +32,84 @@ def get_visualization(filepath):
         return f.read()
 
 
-def plot_stacked_bar_chart(expenditure_df):
+def get_chart_tasks(demographic_df, expenditure_df):
     """
-    Plots a stacked bar chart representing Statewise Average Expenditure by item category
+    Computes the values of every chart and returns the tasks rendering them.
+
+    The plot functions only use their own Figure and Axes objects, so the tasks can
+    run in any order and in parallel. Their arguments are the small tables of plotted
+    values, not the merged data.
 
     Parameters
     ----------
+    demographic_df : Dataframe
+        The demographic data to be plotted
     expenditure_df : Dataframe
         The expenditure data to be plotted
-    """
 
-    # Calculate plot values
-    statewise_avg_exp_by_category = expenditure_df.groupby(['State', 'Item_Group_Srl_No'])[
+    Returns
+    -------
+    list
+        List of (plot function, arguments) tuples. The last argument is the output file.
+    """
+    tasks = [
+        (plot_stacked_bar_chart, (get_stacked_bar_chart_data(expenditure_df),
+                                  os.path.join(config.CHARTS_DIR, 'statewise-expenditure-stacked-bar.png'))),
+        (plot_grouped_bar_chart, (get_grouped_bar_chart_data(demographic_df),
+                                  os.path.join(config.CHARTS_DIR, 'genderwise-educationlevel-grouped-bar.png'))),
+    ]
+
+    # Separate pie charts for each state
+    jobcard_df = get_pie_chart_data(demographic_df, 'MGNREG_jobcard')
+    for state, values in jobcard_df.iterrows():
+        tasks.append((plot_pie_chart, (values.to_numpy(), list(jobcard_df.columns),
+                                       'Registered in MGNREG Jobcard - ' + state, False,
+                                       os.path.join(config.CHARTS_DIR, 'MGNREG-registered-' + state + '-pie.png'))))
+    worked_df = get_pie_chart_data(demographic_df, 'MGNREG_work')
+    for state, values in worked_df.iterrows():
+        tasks.append((plot_pie_chart, (values.to_numpy(), list(worked_df.columns),
+                                       'Found Work Through MGNREG - ' + state, True,
+                                       os.path.join(config.CHARTS_DIR, 'MGNREG-worked-' + state + '-pie.png'))))
+
+    tasks += [
+        (plot_stacked_histogram, (get_stacked_histogram_data(demographic_df),
+                                  os.path.join(config.CHARTS_DIR, 'age-educationlevel-stacked-histogram.png'))),
+        (plot_heatmap, (get_heatmap_data(expenditure_df),
+                        os.path.join(config.CHARTS_DIR, 'statewise-expenditure-heatmap.png'))),
+    ]
+    return tasks
+
+
+def get_stacked_bar_chart_data(expenditure_df):
+    """
+    Returns the Statewise Average Expenditure by item category, with states as rows and categories as columns.
+    """
+    statewise_avg_exp_by_category = expenditure_df.groupby(['State', 'Item_Group_Srl_No'], observed=True)[
         'Value_of_Consumption_Last_30_Day'].mean().reset_index()
-    pivot_df = statewise_avg_exp_by_category.pivot(
+    return statewise_avg_exp_by_category.pivot(
         index="State", columns="Item_Group_Srl_No", values="Value_of_Consumption_Last_30_Day").fillna(0)
+
+
+def plot_stacked_bar_chart(pivot_df, output_file):
+    """
+    Plots a stacked bar chart representing Statewise Average Expenditure by item category
+
+    Parameters
+    ----------
+    pivot_df : Dataframe
+        The average expenditure by state and item category, from `get_stacked_bar_chart_data`
+    output_file : str
+        Path of the chart image
+    """
+
+    # Calculate plot values
     states = pivot_df.index
     categories = pivot_df.columns
     values = [pivot_df[cat] for cat in categories]
 
     # Plot the chart
-    fig, ax = plt.subplots(figsize=(12, 7))
+    fig = Figure(figsize=(12, 7))
+    ax = fig.subplots()
 
     ax.bar(states, values[0], label=categories[0], width=0.4)
     for i in range(1, len(categories)):
@@ -50,27 +124,34 @@ def plot_stacked_bar_chart(expenditure_df):
     ax.legend(title="Item Groups", bbox_to_anchor=(1.05, 1), loc='upper left')
 
     # Layout adjustment
-    plt.tight_layout()
-    plt.savefig(config.CHARTS_DIR+'/statewise-expenditure-stacked-bar.png')
-    plt.close(fig)
+    fig.tight_layout()
+    fig.savefig(output_file)
+
+
+def get_grouped_bar_chart_data(demographic_df):
+    """
+    Returns the number of individuals by Education Level and Sex.
+    """
+    sex_education_df = demographic_df[['Sex', 'General_Education']]
+    return pd.crosstab(
+        sex_education_df.General_Education, sex_education_df.Sex).reset_index()
 
 
-def plot_grouped_bar_chart(demographic_df):
+def plot_grouped_bar_chart(sex_education_df, output_file):
     """
     Plots a grouped bar chart representing Genderwise Education Level
 
     Parameters
     ----------
-    demographic_df : Dataframe
-        The demographic data to be plotted
+    sex_education_df : Dataframe
+        The number of individuals by education level and sex, from `get_grouped_bar_chart_data`
+    output_file : str
+        Path of the chart image
     """
-    # Calculate plot values
-    sex_education_df = demographic_df[['Sex', 'General_Education']].copy()
-    sex_education_df = pd.crosstab(
-        sex_education_df.General_Education, sex_education_df.Sex).reset_index()
 
     # Plot the chart
-    fig, ax = plt.subplots(figsize=(6, 5))
+    fig = Figure(figsize=(6, 5))
+    ax = fig.subplots()
     sex_education_df.plot(x='General_Education', kind='barh', stacked=False,
                           title='Gender and Education Level', ax=ax, colormap='icefire')
 
@@ -78,125 +159,98 @@ def plot_grouped_bar_chart(demographic_df):
     ax.legend(title="Genders", bbox_to_anchor=(1.05, 1), loc='upper left')
     ax.set_xlabel("No of Individuals", fontsize=12)
     ax.set_ylabel("Education Level", fontsize=12)
-    plt.savefig(config.CHARTS_DIR +
-                '/genderwise-educationlevel-grouped-bar.png', bbox_inches='tight')
-    plt.close(fig)
+    fig.savefig(output_file, bbox_inches='tight')
 
 
-def plot_pie_charts(demographic_df):
+def get_pie_chart_data(demographic_df, column):
     """
-    Plots pie charts representing Statewise MGNREG data
-
-    Parameters
-    ----------
-    demographic_df : Dataframe
-        The demographic data to be plotted
+    Returns the number of individuals by State and the values of an MGNREG column, excluding 'Unknown'.
     """
+    state_mgnreg_df = drop_unknown(demographic_df[['State', column]].copy())
+    return pd.crosstab(state_mgnreg_df.State, state_mgnreg_df[column])
+
 
-    # Calculate plot values for MGNREG_jobcard
-    state_mgnreg_jobcard_df = demographic_df[[
-        'State', 'MGNREG_jobcard']].copy()
-    state_mgnreg_jobcard_df = drop_unknown(state_mgnreg_jobcard_df)
-    state_mgnreg_jobcard_df = pd.crosstab(
-        state_mgnreg_jobcard_df.State, state_mgnreg_jobcard_df.MGNREG_jobcard).reset_index()
-
-    # Plot separate pie charts for each state
-    for ind in range(len(state_mgnreg_jobcard_df)):
-
-        # Calculate plot values
-        state = state_mgnreg_jobcard_df.loc[ind].values[0]
-        mgnreg_jobcard_data = state_mgnreg_jobcard_df.loc[ind].values[1:]
-        chart_labels = state_mgnreg_jobcard_df.columns[1:]
-
-        # Plot pie chart
-        wp = {'linewidth': 2, 'edgecolor': 'white'}
-        plt.figure(figsize=(3, 3))
-        plt.pie(mgnreg_jobcard_data, autopct='%1.0f%%', labels=chart_labels,
-                wedgeprops=wp, colors=sns.color_palette('viridis'))
-
-        # Set title and layout
-        plt.title('Registered in MGNREG Jobcard - '+state, wrap=True)
-        plt.tight_layout()
-        plt.savefig(config.CHARTS_DIR+'/MGNREG-registered-'+state+'-pie.png')
-        plt.close()
-
-    # Calculate plot values for MGNREG_worked
-    statewise_mgnreg_worked = demographic_df[['State', 'MGNREG_work']].copy()
-    statewise_mgnreg_worked = drop_unknown(statewise_mgnreg_worked)
-    statewise_mgnreg_worked = pd.crosstab(
-        statewise_mgnreg_worked.State, statewise_mgnreg_worked.MGNREG_work).reset_index()
-
-    # Plot separate pie charts for each state
-    for ind in range(len(statewise_mgnreg_worked)):
-
-        # Calculate plot values
-        state = statewise_mgnreg_worked.loc[ind].values[0]
-        mgnreg_worked_data = statewise_mgnreg_worked.loc[ind].values[1:]
-        chart_labels = statewise_mgnreg_worked.columns[1:]
-
-        # Plot pie chart
-        wp = {'linewidth': 2, 'edgecolor': 'white'}
-        plt.figure(figsize=(3, 3))
-        plt.pie(mgnreg_worked_data, autopct='%1.0f%%', wedgeprops=wp,
-                colors=sns.color_palette('viridis'))
-
-        # Set title and layout
-        plt.title('Found Work Through MGNREG - '+state, wrap=True)
-        plt.legend(loc='lower center', labels=chart_labels,
-                   bbox_to_anchor=(0.5, -0.2))
-        plt.tight_layout(pad=0.1)
-        plt.savefig(config.CHARTS_DIR+'/MGNREG-worked-'+state+'-pie.png')
-        plt.close()
-
-
-def plot_stacked_histogram(demographic_df):
+def plot_pie_chart(values, labels, title, legend, output_file):
     """
-    Plots stacked histogram representing age distribution and education level.
+    Plots a pie chart of the MGNREG data of a state
 
     Parameters
     ----------
-    demographic_df : Dataframe
-        The demographic data to be plotted
+    values : array
+        The number of individuals for each label
+    labels : list
+        The labels of the values
+    title : str
+        Title of the chart
+    legend : bool
+        Show the labels in a legend below the chart instead of next to the wedges
+    output_file : str
+        Path of the chart image
     """
 
-    # Calculate plot data
+    # Plot pie chart
+    wp = {'linewidth': 2, 'edgecolor': 'white'}
+    fig = Figure(figsize=(3, 3))
+    ax = fig.subplots()
+    ax.pie(values, autopct='%1.0f%%', labels=None if legend else labels,
+           wedgeprops=wp, colors=sns.color_palette('viridis'))
+
+    # Set title and layout
+    ax.set_title(title, wrap=True)
+    if legend:
+        ax.legend(loc='lower center', labels=labels,
+                  bbox_to_anchor=(0.5, -0.2))
+        fig.tight_layout(pad=0.1)
+    else:
+        fig.tight_layout()
+    fig.savefig(output_file)
+
+
+def get_stacked_histogram_data(demographic_df):
+    """
+    Returns the number of individuals by age range (rows) and literacy level (columns).
+    Levels absent from the data, e.g. in a few partitions of a batch, have no individuals.
+    """
     age_education_df = demographic_df[['Age', 'General_Education']].copy()
     bins = range(0, 100, 10)
     age_education_df['Age_Bin'] = pd.cut(
         age_education_df['Age'], bins=bins, right=False)
     grouped = age_education_df.groupby(
         ['Age_Bin', 'General_Education'], observed=False).size().unstack(fill_value=0)
-    grouped = grouped[['Not literate', 'Literate without formal schooling:  EGS/ NFEC/ AEC',
-                       'Literate:  below primary', 'Literate:  primary', 'Literate:  middle',
-                       'Literate:  secondary', 'Literate:  higher secondary', 'Literate:  graduate',
-                       'Literate:  diploma/certificate course']]
-
-    # Plot the chart
-    grouped.plot(kind='bar', stacked=True,
-                 colormap='viridis',    figsize=(10, 6))
-
-    # Customize plot
-    plt.title('Age Distribution by Literacy Level', fontsize=14)
-    plt.xlabel('Age Range', fontsize=12)
-    plt.ylabel('Count', fontsize=12)
-    plt.xticks(rotation=0)
-    plt.legend(title='Literacy Level')
-    plt.tight_layout()
-    plt.savefig(config.CHARTS_DIR+'/age-educationlevel-stacked-histogram.png')
-    plt.close()
+    return grouped.reindex(columns=LITERACY_LEVELS, fill_value=0)
 
 
-def plot_heatmap(expenditure_df):
+def plot_stacked_histogram(grouped, output_file):
     """
-    Plots a heatmap representing statewise expenditure per item category.
+    Plots stacked histogram representing age distribution and education level.
 
     Parameters
     ----------
-    demographic_df : Dataframe
-        The demographic data to be plotted
+    grouped : Dataframe
+        The number of individuals by age range and literacy level, from `get_stacked_histogram_data`
+    output_file : str
+        Path of the chart image
     """
 
-    # Process the data to be plotted
+    # Plot the chart
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    grouped.plot(kind='bar', stacked=True, colormap='viridis', ax=ax)
+
+    # Customize plot
+    ax.set_title('Age Distribution by Literacy Level', fontsize=14)
+    ax.set_xlabel('Age Range', fontsize=12)
+    ax.set_ylabel('Count', fontsize=12)
+    ax.tick_params(axis='x', labelrotation=0)
+    ax.legend(title='Literacy Level')
+    fig.tight_layout()
+    fig.savefig(output_file)
+
+
+def get_heatmap_data(expenditure_df):
+    """
+    Returns the average expenditure by item category (rows) and state (columns).
+    """
     state_category_exp_df = expenditure_df[[
         'State', 'Item_Group_Srl_No', 'Value_of_Consumption_Last_30_Day']]
     state_category_exp_df = pd.crosstab(state_category_exp_df.Item_Group_Srl_No, state_category_exp_df.State,
@@ -206,16 +260,30 @@ def plot_heatmap(expenditure_df):
         state_category_exp_df, ['monthly', 'Monthly', 'Sub-total']).reset_index()
     state_category_exp_df.set_index('Item_Group_Srl_No', inplace=True)
     state_category_exp_df.fillna(0, inplace=True)
+    return state_category_exp_df
+
+
+def plot_heatmap(state_category_exp_df, output_file):
+    """
+    Plots a heatmap representing statewise expenditure per item category.
+
+    Parameters
+    ----------
+    state_category_exp_df : Dataframe
+        The average expenditure by item category and state, from `get_heatmap_data`
+    output_file : str
+        Path of the chart image
+    """
 
     # Create the heatmap
-    plt.figure(figsize=(10, 15))
+    fig = Figure(figsize=(10, 15))
+    ax = fig.subplots()
     sns.heatmap(state_category_exp_df, annot=True,
-                fmt=".2f", cmap="YlGnBu", linewidths=0.5)
+                fmt=".2f", cmap="YlGnBu", linewidths=0.5, ax=ax)
 
     # Add labels and title
-    plt.title('Average Expenditure by State and Category', fontsize=16)
-    plt.xlabel('State', fontsize=12)
-    plt.ylabel('Category', fontsize=12)
-    plt.tight_layout()
-    plt.savefig(config.CHARTS_DIR+'/statewise-expenditure-heatmap.png')
-    plt.close()
+    ax.set_title('Average Expenditure by State and Category', fontsize=16)
+    ax.set_xlabel('State', fontsize=12)
+    ax.set_ylabel('Category', fontsize=12)
+    fig.tight_layout()
+    fig.savefig(output_file)
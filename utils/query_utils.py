@@ -0,0 +1,310 @@
+from collections import OrderedDict
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from scripts.data_aggregation import compute_aggregation, get_output_columns, get_required_columns, get_spec_key
+from utils.columnar_utils import read_columnar_meta
+from utils.dataframe_utils import apply_schema
+from utils.file_utils import load_dataframe
+from utils.response_utils import file_version
+
+
+# Operators of filters, written as `column__operator=value` ('eq' may be left out)
+FILTER_OPERATORS = ('eq', 'ne', 'gt', 'gte', 'lt', 'lte')
+
+
+class QueryTable:
+    """
+    Typed in-memory copy of a table file, indexed for filter queries.
+
+    String columns are stored as categoricals with sorted categories, so every column
+    compares as numbers. Each column is indexed by its sort order on first use, so a
+    filter is a binary search instead of a scan.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The table to query.
+    """
+
+    def __init__(self, df):
+        df = df.copy()
+        for col in df.columns:
+            if df[col].dtype == object:
+                df[col] = pd.Categorical(df[col])
+            elif isinstance(df[col].dtype, pd.CategoricalDtype) and not df[col].cat.categories.is_monotonic_increasing:
+                df[col] = df[col].cat.reorder_categories(
+                    df[col].cat.categories.sort_values())
+        self.df = df
+        self._indexes = {}
+
+    def query(self, filters=None, sort=None, top=None, columns=None):
+        """
+        Returns the rows matching all filters, sorted and limited.
+
+        Parameters
+        ----------
+        filters : list (default=None)
+            List of (column, operator, value) tuples, with values as strings. The 'eq'
+            operator takes a list of values, any of which may match.
+        sort : list (default=None)
+            Columns to sort by, descending if prefixed with '-'. Rows keep the file
+            order if not specified.
+        top : int (default=None)
+            Maximum number of rows, after sorting.
+        columns : list (default=None)
+            Columns to return. All columns are returned if not specified.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The matching rows, with string columns as plain objects.
+
+        Raises
+        ------
+        ValueError
+            If a column, operator or value is invalid.
+        """
+        self._check_columns([col for col, _, _ in filters or []] +
+                            [col.lstrip('-') for col in sort or []] + (columns or []))
+
+        positions = None
+        for col, op, value in filters or []:
+            matches = self._filter(col, op, value)
+            positions = matches if positions is None else np.intersect1d(
+                positions, matches, assume_unique=True)
+        result_df = self.df if positions is None else self.df.iloc[np.sort(positions)]
+
+        if sort:
+            result_df = result_df.sort_values(by=[col.lstrip('-') for col in sort],
+                                              ascending=[not col.startswith('-') for col in sort],
+                                              kind='stable', na_position='last')
+        if top is not None:
+            result_df = result_df.head(top)
+        if columns:
+            result_df = result_df[columns]
+
+        return result_df.astype({col: object for col in result_df.columns
+                                 if isinstance(result_df[col].dtype, pd.CategoricalDtype)})
+
+    def _filter(self, col, op, value):
+        """
+        Returns the positions of the rows of a column matching a filter.
+        """
+        if op not in FILTER_OPERATORS:
+            raise ValueError(
+                f'Invalid filter operator {op}. Allowed operators are {list(FILTER_OPERATORS)}')
+        order, keys, first, last = self._index(col)
+
+        if op in ('eq', 'ne'):
+            values = value if isinstance(value, list) else [value]
+            parts = []
+            for item in values:
+                key = self._to_key(col, item)
+                lower = np.searchsorted(keys[first:last], key, side='left') + first
+                upper = np.searchsorted(keys[first:last], key, side='right') + first
+                parts.append(order[lower:upper])
+            matches = np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=order.dtype)
+            if op == 'ne':
+                return np.setdiff1d(order[first:last], matches, assume_unique=True)
+            return matches
+
+        key = self._to_key(col, value)
+        valid_keys = keys[first:last]
+        if op == 'gt':
+            return order[first + np.searchsorted(valid_keys, key, side='right'):last]
+        if op == 'gte':
+            return order[first + np.searchsorted(valid_keys, key, side='left'):last]
+        if op == 'lt':
+            return order[first:first + np.searchsorted(valid_keys, key, side='left')]
+        return order[first:first + np.searchsorted(valid_keys, key, side='right')]
+
+    def _index(self, col):
+        """
+        Returns the sort order of a column, its sorted keys and the range of non-null keys.
+        """
+        if col not in self._indexes:
+            series = self.df[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                keys = series.cat.codes.to_numpy()
+                nulls = keys < 0
+            else:
+                keys = series.to_numpy()
+                nulls = series.isna().to_numpy()
+            # Nulls first, then the other rows by key
+            valid = np.flatnonzero(~nulls)
+            order = np.concatenate([np.flatnonzero(nulls),
+                                    valid[np.argsort(keys[valid], kind='stable')]])
+            self._indexes[col] = (order, keys[order], int(nulls.sum()), len(order))
+        return self._indexes[col]
+
+    def _to_key(self, col, value):
+        """
+        Converts a filter value to the key type of a column. A string value of a
+        categorical column maps to the position it would have among the categories.
+        """
+        dtype = self.df[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            categories = dtype.categories
+            if pd.api.types.is_numeric_dtype(categories.dtype):
+                value = self._to_number(col, value, categories.dtype)
+            position = categories.searchsorted(value, side='left')
+            if position < len(categories) and categories[position] == value:
+                return position
+            # Between two categories: compares above the lower and below the upper one
+            return position - 0.5
+        if pd.api.types.is_bool_dtype(dtype):
+            if value.lower() not in ('true', 'false'):
+                raise ValueError(f'Invalid value {value} for boolean column {col}')
+            return value.lower() == 'true'
+        return self._to_number(col, value, dtype)
+
+    @staticmethod
+    def _to_number(col, value, dtype):
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError(f'Invalid value {value} for numeric column {col}')
+        if pd.api.types.is_integer_dtype(dtype) and number.is_integer():
+            return int(number)
+        return number
+
+    def _check_columns(self, columns):
+        missing = [col for col in columns if col not in self.df.columns]
+        if missing:
+            raise ValueError(f'Columns {list(dict.fromkeys(missing))} not found')
+
+
+class QueryTableCache:
+    """
+    Least recently used cache of `QueryTable` copies of table files, each tied to the version of its file.
+
+    Parameters
+    ----------
+    max_tables : int
+        Maximum number of cached tables.
+    """
+
+    def __init__(self, max_tables):
+        self.max_tables = max_tables
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Returns the query table of a file, loading it again if the file has changed.
+        """
+        version = file_version(path)
+        with self._lock:
+            cached = self._tables.get(path)
+            if cached is not None and cached[0] == version:
+                self._tables.move_to_end(path)
+                return cached[1]
+
+        table = QueryTable(load_dataframe(path))
+        with self._lock:
+            self._tables[path] = (version, table)
+            self._tables.move_to_end(path)
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+        return table
+
+
+class AggregationCache:
+    """
+    Memory-resident copy of the merged table, and least recently used cache of the
+    aggregations computed on it, each tied to the version of the table.
+
+    Columns of a columnar table are loaded on first use and kept, along with the
+    factorized group keys, so a new spec only loads and factorizes what earlier specs
+    did not. Rewriting the table drops the copy and every cached result.
+
+    Parameters
+    ----------
+    path : str
+        Path of the merged table.
+    max_results : int
+        Maximum number of cached results.
+    """
+
+    def __init__(self, path, max_results):
+        self.path = path
+        self.max_results = max_results
+        self._results = OrderedDict()
+        self._version = None
+        self._df = None
+        self._key_cache = {}
+        self._lock = threading.Lock()
+        self._table_lock = threading.Lock()
+
+    def aggregate(self, spec):
+        """
+        Returns the aggregation of the merged table by a normalized spec (see `normalize_spec`).
+
+        Returns
+        -------
+        tuple
+            The aggregated dataframe, with columns in the order of the spec, and True
+            if it was cached.
+
+        Raises
+        ------
+        ValueError
+            If a column of the spec is not in the merged table, or a function does not
+            fit the dtype of its column, see `compile_agg_params`.
+        """
+        key = get_spec_key(spec)
+        version = file_version(self.path)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] == version:
+                self._results.move_to_end(key)
+                return self._order_columns(cached[1], spec), True
+
+        with self._table_lock:
+            version = self._load_columns(get_required_columns([spec]))
+            result_df = compute_aggregation(self._df, spec, self._key_cache)
+
+        with self._lock:
+            if self._version != version:
+                return self._order_columns(result_df, spec), False
+            self._results[key] = (version, result_df)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return self._order_columns(result_df, spec), False
+
+    def _load_columns(self, columns):
+        """
+        Loads the columns of the merged table that are not in memory yet, reloading the
+        table if it has changed. Returns the version of the table in memory.
+        """
+        version = file_version(self.path)
+        if version != self._version:
+            with self._lock:
+                self._results.clear()
+                self._version, self._df, self._key_cache = version, None, {}
+
+        is_columnar = os.path.isdir(self.path)
+        if self._df is None and not is_columnar:
+            self._df = load_dataframe(self.path, compact=False)
+            apply_schema(self._df)
+        available = ([column_meta['name'] for column_meta in read_columnar_meta(self.path)['columns']]
+                     if is_columnar else list(self._df.columns))
+        missing = [col for col in columns if col not in available]
+        if missing:
+            raise ValueError(f'Columns {missing} not found in the merged data')
+
+        to_load = [col for col in columns if self._df is None or col not in self._df.columns]
+        if to_load:
+            loaded_df = load_dataframe(self.path, columns=to_load, compact=False)
+            apply_schema(loaded_df)
+            self._df = loaded_df if self._df is None else pd.concat([self._df, loaded_df], axis=1)
+        return version
+
+    @staticmethod
+    def _order_columns(result_df, spec):
+        return result_df[spec['groupby'] + get_output_columns(spec['agg_params'])]
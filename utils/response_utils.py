@@ -0,0 +1,114 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+import os
+import threading
+
+from utils.columnar_utils import META_FILE
+from utils.file_utils import is_partitioned, list_partition_files
+
+
+def file_version(path):
+    """
+    Returns the inode, size and modification time of a file, which change whenever the file is rewritten.
+
+    A columnar directory is versioned by its metadata file, which is replaced on every write.
+    A partitioned dataset is versioned by its number of parts, their total size and the
+    latest modification time of a part.
+
+    Parameters
+    ----------
+    path : str
+        Path of a file, columnar directory or partitioned dataset.
+
+    Returns
+    -------
+    tuple
+        Inode, size and modification time in nanoseconds.
+    """
+    if is_partitioned(path):
+        versions = [file_version(part_file) for part_file in list_partition_files(path)]
+        return (len(versions), sum(size for _, size, _ in versions),
+                max((mtime for _, _, mtime in versions), default=0))
+    if os.path.isdir(path):
+        path = os.path.join(path, META_FILE)
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def get_etag(version):
+    """
+    Returns the ETag header value of a response built from files with the given versions.
+    """
+    return '"' + hashlib.sha1(repr(version).encode('utf-8')).hexdigest() + '"'
+
+
+class ResponseCache:
+    """
+    Least recently used cache of serialized responses, each tied to the version of its source files.
+
+    An entry is only returned for the version it was built from, so rewriting a source
+    file invalidates it. The gzip-compressed body is built on first use and counted in
+    the memory limit along with the body.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory limit of the cached bodies. Least recently used entries are evicted beyond it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, name, version):
+        """
+        Returns the entry of a response for the given version of its files, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            if entry['version'] != version:
+                self._remove(name)
+                return None
+            self._entries.move_to_end(name)
+            return entry
+
+    def put(self, name, version, body):
+        """
+        Stores a serialized response and returns its entry. Bodies larger than the memory limit are returned without being stored.
+        """
+        entry = {'version': version, 'etag': get_etag(version),
+                 'body': body, 'gzip': None}
+        with self._lock:
+            self._remove(name)
+            if len(body) <= self.max_bytes:
+                self._entries[name] = entry
+                self._size += len(body)
+                self._evict()
+        return entry
+
+    def get_gzip(self, name, entry):
+        """
+        Returns the gzip-compressed body of an entry, compressing it on first use.
+        """
+        if entry['gzip'] is None:
+            compressed = gzip.compress(entry['body'], compresslevel=6)
+            with self._lock:
+                entry['gzip'] = compressed
+                if self._entries.get(name) is entry:
+                    self._size += len(compressed)
+                    self._evict()
+        return entry['gzip']
+
+    def _remove(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._size -= len(entry['body']) + len(entry['gzip'] or b'')
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))